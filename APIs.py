@@ -1,11 +1,39 @@
 # Import Libraries
 from abc import ABC, abstractmethod
-import spotipy
-import requests
-from googleapiclient.discovery import build
+from collections import Counter
+import os, random, time
+from concurrent.futures import ThreadPoolExecutor
+# googleapiclient is only imported by YoutubeAPI, so users of
+# SpotifyAPI don't pay for it
 
 # Import Files
+from ArtistGraph import get_artist_graph
 from Auths import SpotifyAuth, YouTubeAuth, LastFMAuth
+from Caches import LRUCache, get_response_cache, get_video_id_cache
+from Clients import get_lastfm_client, get_spotify_client
+from Metrics import get_metrics, traced
+from RateLimits import get_rate_limiter
+
+# most tracks Spotify accepts in one playlist request
+PLAYLIST_CHUNK = 100
+# most track IDs the Spotify tracks endpoint accepts at once
+TRACKS_CHUNK = 50
+# inserts sent in one YouTube batch request
+YOUTUBE_BATCH = 50
+# YouTube errors worth retrying
+TRANSIENT_STATUSES = {409, 429, 500, 502, 503, 504}
+# set to point the YouTube client at a Replay.py stand-in server
+YOUTUBE_API_URL = os.getenv("YOUTUBE_API_URL")
+
+'''
+Name: _is_transient
+Parameters: error
+Returns: True or False
+Purpose: Checks if a YouTube HttpError is worth retrying.
+'''
+def _is_transient(error):
+    from googleapiclient.errors import HttpError
+    return isinstance(error, HttpError) and error.resp.status in TRANSIENT_STATUSES
 
 class APIBase(ABC):
     def __init__(self, name):
@@ -25,67 +53,219 @@ and perform functions that work explicitly within Spotify.
 Inherits from the base class - APIBase. 
 '''
 class SpotifyAPI(APIBase):
-    def __init__(self):
+    def __init__(self, sp=None):
         '''
         Name: __init__
-        Parameters: None
+        Parameters: sp=None
         Returns: None
         Purpose: Initialises any variables needed for this class such as
-        any authentication variables needed for api calls.
+        any authentication variables needed for api calls. sp defaults
+        to the shared SpotifyClient, which refreshes its own token.
         '''
         super().__init__("Spotify")
         self.SpotifyAuth = SpotifyAuth()
 
         self.access_token = self.SpotifyAuth.get_access_token()
-        self.spotify = spotipy.Spotify(auth=self.access_token)
-
-        try:
-            self.user_id = self.spotify.current_user()['id']
-        except spotipy.exceptions.SpotifyException:
-            print("[DEBUG] Token was expired. Refreshing now...")
-            self.access_token = self.SpotifyAuth.get_access_token()
-            self.spotify = spotipy.Spotify(auth=self.access_token)
-            self.user_id = self.spotify.current_user()['id']
+        self.spotify = sp if sp is not None else get_spotify_client(self.SpotifyAuth)
+        self.user_id = self.spotify.current_user()['id']
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="spotifyapi")
+        self.cache = get_response_cache()
+        self.track_info_lru = LRUCache(maxsize=2048, name="track_info")
 
     '''
     Name: refresh_spotify
     Parameters: None
     Returns: None
-    Purpose: Refreshes the access token using the .get_access_token method
-    in the SpotifyAuth class. 
+    Purpose: Gets the current access token using the .get_access_token method
+    in the SpotifyAuth class. The shared client already sends the current
+    token with every request, so it doesn't need rebuilding.
     '''
     def refresh_spotify(self):
         self.access_token = self.SpotifyAuth.get_access_token()
-        self.spotify = spotipy.Spotify(auth=self.access_token)
 
     '''
     Name: add_to_playlist
-    Parameters: playlist_name, track_uris
+    Parameters: playlist_name, track_uris, sync=False
     Returns: playlist
     Purpose: Adds tracks generating my the rec algorithms from another class,
     to a playlist within the user's Spotify account using the Spotify Web API methods,
     also provides a playlist name for the playlist.
+    Tracks are sent in chunks of 100. With sync=True an existing playlist
+    with the same name is updated with sync_playlist instead of a new
+    one being created.
     '''
-    def add_to_playlist(self, playlist_name, track_uris):
+    @traced("export", target="spotify")
+    def add_to_playlist(self, playlist_name, track_uris, sync=False):
+        track_uris = [uri for uri in track_uris or [] if uri]
         if not track_uris:
             raise ValueError("track uris missing.")
 
         self.refresh_spotify()
 
-        playlist = self.spotify.user_playlist_create(
+        if sync:
+            return self.sync_playlist(playlist_name, track_uris)
+
+        playlist = self._create_playlist(playlist_name)
+        self._add_items(playlist["id"], track_uris)
+        print(f"[DEBUG] Playlist created: {playlist_name}")
+        print(f"[DEBUG] Spotify playlist URL: {playlist['external_urls']['spotify']}")
+        return playlist
+
+    '''
+    Name: _create_playlist
+    Parameters: playlist_name
+    Returns: playlist
+    Purpose: Creates an empty private playlist.
+    '''
+    def _create_playlist(self, playlist_name):
+        return self.spotify.user_playlist_create(
             user = self.user_id,
             name = playlist_name,
             public = False,
             description = "Created by Lucy's song recommendation system."
         )
 
-        playlist_url = playlist["external_urls"]["spotify"]
+    '''
+    Name: _add_items
+    Parameters: playlist_id, track_uris, position=None
+    Returns: snapshot_id
+    Purpose: Adds tracks in chunks of PLAYLIST_CHUNK, the most Spotify
+    accepts in one request, starting at position (or the end).
+    '''
+    def _add_items(self, playlist_id, track_uris, position=None):
+        snapshot_id = None
+        for start in range(0, len(track_uris), PLAYLIST_CHUNK):
+            chunk = track_uris[start:start + PLAYLIST_CHUNK]
+            at = None if position is None else position + start
+            snapshot_id = self.spotify.playlist_add_items(playlist_id, chunk, position=at)["snapshot_id"]
+        return snapshot_id
 
-        self.spotify.playlist_add_items(playlist["id"], track_uris)
-        print(f"[DEBUG] Playlist created: {playlist_name}")
-        print(f"[DEBUG] Spotify playlist URL: {playlist_url}")
+    '''
+    Name: find_playlist
+    Parameters: playlist_name
+    Returns: playlist or None
+    Purpose: Finds one of the user's own playlists by name, ignoring case.
+    '''
+    def find_playlist(self, playlist_name):
+        page = self.spotify.current_user_playlists(limit=50)
+        while page:
+            for playlist in page["items"]:
+                if (playlist and playlist["name"].lower() == playlist_name.lower()
+                        and playlist["owner"]["id"] == self.user_id):
+                    return playlist
+            page = self.spotify.next(page) if page.get("next") else None
+        return None
+
+    '''
+    Name: get_playlist_uris
+    Parameters: playlist_id
+    Returns: uris
+    Purpose: Gets the track URIs of a playlist in order. The first page
+    gives the total, then the rest of the pages are fetched at once.
+    '''
+    def get_playlist_uris(self, playlist_id):
+        fields = "items(track(uri)),total"
+
+        def fetch(offset):
+            return self.spotify.playlist_items(playlist_id, fields=fields, limit=PLAYLIST_CHUNK,
+                                               offset=offset, additional_types=("track",))
+
+        first = fetch(0)
+        pages = [first] + list(self.executor.map(
+            fetch, range(PLAYLIST_CHUNK, first["total"], PLAYLIST_CHUNK)))
+        return [item["track"]["uri"] if item.get("track") else None
+                for page in pages for item in page["items"]]
+
+    '''
+    Name: sync_playlist
+    Parameters: playlist_name, track_uris
+    Returns: playlist
+    Purpose: Makes the playlist called playlist_name contain exactly
+    track_uris, in order, creating it if it doesn't exist. Only the
+    differences are sent: tracks that aren't wanted any more are removed,
+    the kept tracks are moved into the new order and the new tracks are
+    inserted where they belong, all in chunks of PLAYLIST_CHUNK.
+    '''
+    def sync_playlist(self, playlist_name, track_uris):
+        target = list(dict.fromkeys(track_uris))
+        playlist = self.find_playlist(playlist_name)
+        if playlist is None:
+            playlist = self._create_playlist(playlist_name)
+            self._add_items(playlist["id"], target)
+            print(f"[DEBUG] Playlist created: {playlist_name}")
+            print(f"[DEBUG] Spotify playlist URL: {playlist['external_urls']['spotify']}")
+            return playlist
+
+        playlist_id = playlist["id"]
+        current = self.get_playlist_uris(playlist_id)
+        if None in current:
+            # items without a URI can't be removed or tracked by position, so start over
+            self.spotify.playlist_replace_items(playlist_id, target[:PLAYLIST_CHUNK])
+            self._add_items(playlist_id, target[PLAYLIST_CHUNK:])
+            print(f"[DEBUG] Playlist replaced: {playlist_name}")
+            return playlist
+
+        target_set = set(target)
+        counts = Counter(current)
+
+        # duplicates are removed as well and added back once
+        removes = [uri for uri in counts if (uri not in target_set or counts[uri] > 1)]
+        removed = set(removes)
+        # removing all occurrences doesn't depend on order, so the chunks go out together
+        list(self.executor.map(
+            lambda start: self.spotify.playlist_remove_all_occurrences_of_items(
+                playlist_id, removes[start:start + PLAYLIST_CHUNK]),
+            range(0, len(removes), PLAYLIST_CHUNK)))
+
+        order = [uri for uri in current if uri not in removed]
+        kept = set(order)
+        moves = self._reorder(playlist_id, order, [uri for uri in target if uri in kept])
+
+        adds = 0
+        position = 0
+        while position < len(target):
+            if target[position] in kept:
+                position += 1
+                continue
+            run_end = position
+            while run_end < len(target) and target[run_end] not in kept:
+                run_end += 1
+            self._add_items(playlist_id, target[position:run_end], position=position)
+            adds += run_end - position
+            position = run_end
+
+        print(f"[DEBUG] Playlist synced: {playlist_name} "
+              f"({adds} added, {len(removes)} removed, {moves} moved)")
+        print(f"[DEBUG] Spotify playlist URL: {playlist['external_urls']['spotify']}")
         return playlist
 
+    '''
+    Name: _reorder
+    Parameters: playlist_id, order, target
+    Returns: moves
+    Purpose: Moves tracks so order matches target, where both hold the
+    same tracks. Runs of tracks that are already next to each other are
+    moved in one request. order is updated as the moves are made.
+    '''
+    def _reorder(self, playlist_id, order, target):
+        moves = 0
+        snapshot_id = None
+        for i, uri in enumerate(target):
+            if order[i] == uri:
+                continue
+            start = order.index(uri, i)
+            length = 1
+            while (start + length < len(order) and i + length < len(target)
+                   and order[start + length] == target[i + length]):
+                length += 1
+
+            snapshot_id = self.spotify.playlist_reorder_items(
+                playlist_id, range_start=start, insert_before=i,
+                range_length=length, snapshot_id=snapshot_id)["snapshot_id"]
+            order[i:i] = [order.pop(start) for _ in range(length)]
+            moves += 1
+        return moves
+
     '''
     Name: get_user_info
     Parameters:
@@ -105,13 +285,52 @@ class SpotifyAPI(APIBase):
     Name: get_track_info
     Parameters: uri
     Returns: name, artists
-    Purpose: Gets name and artist of a single track uri using spotify.track.
+    Purpose: Gets name and artist of a single track uri using get_tracks_info.
     '''
     def get_track_info(self, uri):
-        track = self.spotify.track(uri)
-        name = track["name"]
-        artists = ", ".join([artist["name"] for artist in track["artists"]])
-        return name, artists
+        info = self.get_tracks_info([uri])
+        if uri not in info:
+            raise ValueError(f"Track not found on Spotify: {uri}")
+        return info[uri]
+
+    '''
+    Name: get_tracks_info
+    Parameters: uris
+    Returns: info
+    Purpose: Gets the name and artists of many tracks at once as
+    {uri: (name, artists)}. Tracks are looked up in the in-memory LRU,
+    then the on-disk cache, and the rest are fetched TRACKS_CHUNK at a
+    time with spotify.tracks. Tracks Spotify can't find are left out.
+    '''
+    def get_tracks_info(self, uris):
+        info = {}
+        missing = []
+        for uri in dict.fromkeys(uris):
+            cached = self.track_info_lru.get(uri)
+            if cached is None:
+                data, _ = self.cache.get("spotify.track", {"uri": uri})
+                if data is not None:
+                    cached = tuple(data)
+                    self.track_info_lru.set(uri, cached)
+            if cached is None:
+                missing.append(uri)
+            else:
+                info[uri] = cached
+
+        for start in range(0, len(missing), TRACKS_CHUNK):
+            chunk = missing[start:start + TRACKS_CHUNK]
+            tracks = self.spotify.tracks(chunk)["tracks"]
+            for uri, track in zip(chunk, tracks):
+                if track is None:
+                    continue
+                name = track["name"]
+                artists = ", ".join([artist["name"] for artist in track["artists"]])
+                info[uri] = (name, artists)
+                self.track_info_lru.set(uri, info[uri])
+                self.cache.set("spotify.track", {"uri": uri}, [name, artists])
+
+        return info
+
 '''
 Name: YoutubeAPI
 Purpose: This is a constructor to instantiate a YouTube API object with
@@ -121,18 +340,31 @@ Inherits from the base class - APIBase
 class YoutubeAPI(APIBase):
     '''
     Name: __init__
-    Parameters: None
+    Parameters: interactive=None
     Returns: None
     Purpose: Initialises any variables needed for this class such as
-    any authentication variables needed for api calls.
+    any authentication variables needed for api calls. With
+    interactive=False it raises YouTubeAuthError rather than opening
+    a browser to log in.
     '''
-    def __init__(self):
+    def __init__(self, interactive=None):
+        from googleapiclient.discovery import build
+
         super().__init__("Youtube")
         self.YoutubeAuth = YouTubeAuth()
-        self.YoutubeAuth.authenticate()
+        self.YoutubeAuth.authenticate(interactive=interactive)
         credentials = self.YoutubeAuth.get_credentials()
-        self.youtube = build('youtube', 'v3', credentials=credentials)
+        if YOUTUBE_API_URL:
+            self.youtube = build('youtube', 'v3', credentials=credentials, static_discovery=True,
+                                 client_options={"api_endpoint": YOUTUBE_API_URL})
+        else:
+            # use the discovery document bundled with googleapiclient
+            # instead of downloading it every time
+            self.youtube = build('youtube', 'v3', credentials=credentials, static_discovery=True)
         self.video_id = None
+        self.video_id_cache = get_video_id_cache()
+        self.playlist_index = None
+        self.limiter = get_rate_limiter()
 
     '''
     Name: set_video
@@ -151,12 +383,12 @@ class YoutubeAPI(APIBase):
     Purpose: Searches for videos on YouTube API.
     '''
     def search_video(self, query):
-        search = self.youtube.search().list(
+        search = self._execute("search.list", self.youtube.search().list(
             q=query,
             part="id,snippet",
             type="video",
             maxResults=1
-        ).execute()
+        ))
 
         if not search["items"]:
             return None
@@ -165,22 +397,21 @@ class YoutubeAPI(APIBase):
     '''
     Name: create_playlist
     Parameters: playlist_name
-    Returns: new_playlist["id"]
+    Returns: playlist id
     Purpose: Creates a blank playlist with no songs currently 
     on it within the user's Spotify account. 
+    If the user already has a playlist with this title (ignoring case)
+    its id is returned instead, using the playlist index.
     '''
     def create_playlist(self, playlist_name):
-        playlists = self.youtube.playlists().list(
-            part="snippet",
-            mine=True,
-            maxResults=50
-        ).execute()
+        if self.playlist_index is None:
+            self.refresh_playlist_index()
 
-        for playlist in playlists.get("items", []):
-            if playlist["snippet"]["title"].lower() == playlist_name.lower():
-                return playlist["id"]
+        playlist_id = self.playlist_index.get(playlist_name.lower())
+        if playlist_id:
+            return playlist_id
 
-        new_playlist = self.youtube.playlists().insert(
+        new_playlist = self._execute("playlists.insert", self.youtube.playlists().insert(
             part="snippet,status",
             body={
                 "snippet": {
@@ -191,23 +422,78 @@ class YoutubeAPI(APIBase):
                     "privacyStatus": "private",
                 }
             }
-        ).execute()
+        ))
+        self.playlist_index[playlist_name.lower()] = new_playlist["id"]
         return new_playlist["id"]
 
+    '''
+    Name: refresh_playlist_index
+    Parameters: None
+    Returns: self.playlist_index
+    Purpose: Lists every one of the user's playlists, 50 per page, into
+    a lowercase title -> playlist id index. This is done once per
+    session; playlists created by create_playlist are added to it.
+    '''
+    def refresh_playlist_index(self):
+        index = {}
+        request = self.youtube.playlists().list(
+            part="snippet",
+            mine=True,
+            maxResults=50,
+            fields="nextPageToken,items(id,snippet/title)"
+        )
+        while request is not None:
+            response = self._execute("playlists.list", request)
+            for playlist in response.get("items", []):
+                # keep the first playlist if several share a title
+                index.setdefault(playlist["snippet"]["title"].lower(), playlist["id"])
+            request = self.youtube.playlists().list_next(request, response)
+
+        self.playlist_index = index
+        return self.playlist_index
+
     '''
     Name: uris_to_ids
-    Parameters: sp, uris
+    Parameters: sp, uris, track_info=None
     Returns: video_ids
     Purpose: Method to convert the spotify URIs to 
     the YouTube video ids by searching youtube for the id. 
+    Each URI is checked in the video ID cache first, and searches
+    (including ones with no result) are stored there afterwards.
+    track_info is an optional {uri: (name, artists)} from the
+    recommender; any other names are fetched in bulk from sp.
     '''
-    def uris_to_ids(self, sp, uris):
+    @traced("video_lookup")
+    def uris_to_ids(self, sp, uris, track_info=None):
+        found_ids = {}
+        pending = []
+        for uri in dict.fromkeys(uris):
+            vid, found = self.video_id_cache.get(uri)
+            if found:
+                found_ids[uri] = vid
+            else:
+                pending.append(uri)
+
+        if pending:
+            info = dict(track_info or {})
+            unknown = [uri for uri in pending if uri not in info]
+            if unknown:
+                info.update(sp.get_tracks_info(unknown))
+
+            for uri in pending:
+                if uri not in info:
+                    print(f"[WARNING] No track info for {uri}, skipping.")
+                    continue
+                name, artists = info[uri]
+                query = f"{name} {artists} official music video"
+
+                vid = self.search_video(query)
+                self.video_id_cache.set(uri, vid)
+                found_ids[uri] = vid
+
         video_ids = []
         for uri in uris:
-            name, artists = sp.get_track_info(uri)
-            query = f"{name} {artists} official music video"
-
-            vid = self.search_video(query)
+            vid = found_ids.get(uri)
             if vid:
                 video_ids.append(vid)
 
@@ -215,48 +501,159 @@ class YoutubeAPI(APIBase):
 
     ''' 
     Name: add_to_playlist
-    Parameters: playlist_name, video_ids
+    Parameters: playlist_name, video_ids, summary=False
     Returns: {
             "playlistId": playlist_id,
             "playlist_url": f"https://www.youtube.com/playlist?list={playlist_id}",
-            "added_videos": len(video_ids),
-            "responses": responses
+            "added_videos": added,
+            "failed": failed video ids,
+            "responses": responses (left out when summary is True)
         }
     Purpose: Uses my previous method create_playlist
     to create a blank playlist add then add the correct
     video_ids to the newly generated playlist. 
+    The videos are inserted with insert_videos. With summary=True
+    only the counts and failed IDs are returned, not every response.
     '''
-    def add_to_playlist(self, playlist_name, video_ids):
+    @traced("export", target="youtube")
+    def add_to_playlist(self, playlist_name, video_ids, summary=False):
         if isinstance(video_ids, str):
             video_ids = [video_ids]
 
         playlist_id = self.create_playlist(playlist_name)
 
-        responses = []
-        for vid in video_ids:
-            request = self.youtube.playlistItems().insert(
-                part="snippet",
-                body={
-                    "snippet": {
-                        "playlistId": playlist_id,
-                        "resourceId": {
-                            "kind": "youtube#video",
-                            "videoId": vid
-                        }
-                    }
-                }
-            )
-            responses.append(request.execute())
+        responses, failed = self.insert_videos(playlist_id, video_ids, keep_responses=not summary)
 
         print(f"[DEBUG] Playlist created: {playlist_name}")
         print(f"[DEBUG] Youtube Playlist URL: https://www.youtube.com/playlist?list={playlist_id}")
+        if failed:
+            print(f"[WARNING] {len(failed)} videos couldn't be added: {failed}")
 
-        return {
+        result = {
             "playlistId": playlist_id,
             "playlist_url": f"https://www.youtube.com/playlist?list={playlist_id}",
-            "added_videos": len(video_ids),
-            "responses": responses
+            "added_videos": len(video_ids) - len(failed),
+            "failed": failed,
         }
+        if not summary:
+            result["responses"] = responses
+        return result
+
+    '''
+    Name: insert_videos
+    Parameters: playlist_id, video_ids, keep_responses=True, max_retries=3, backoff=1
+    Returns: responses, failed
+    Purpose: Inserts the videos into the playlist using batch requests
+    of YOUTUBE_BATCH inserts each. Inserts that fail with a transient
+    error (409, 429 or 5xx) are retried in a later batch with
+    exponential backoff. Returns the responses in video order (None
+    for failures, or left empty unless keep_responses) and the IDs of
+    the videos that couldn't be added.
+    '''
+    def insert_videos(self, playlist_id, video_ids, keep_responses=True, max_retries=3, backoff=1):
+        from googleapiclient.errors import HttpError
+
+        responses = [None] * len(video_ids)
+        failed = set()
+        pending = list(range(len(video_ids)))
+        metrics = get_metrics()
+
+        for attempt in range(max_retries + 1):
+            retry = []
+            last_attempt = attempt == max_retries
+
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if isinstance(exception, HttpError) and exception.resp.status == 429:
+                    metrics.inc("songrec_rate_limited_total", provider="youtube")
+                if exception is None:
+                    responses[index] = response
+                elif _is_transient(exception) and not last_attempt:
+                    metrics.inc("songrec_retries_total", provider="youtube",
+                                reason=str(exception.resp.status))
+                    retry.append(index)
+                else:
+                    print(f"[ERROR] Couldn't add video {video_ids[index]}: {exception}")
+                    failed.add(index)
+
+            for start in range(0, len(pending), YOUTUBE_BATCH):
+                chunk = pending[start:start + YOUTUBE_BATCH]
+                batch = self._new_batch(callback)
+                for index in chunk:
+                    batch.add(self._insert_request(playlist_id, video_ids[index]),
+                              request_id=str(index))
+                try:
+                    self._execute("playlistItems.insert", batch, count=len(chunk))
+                except (HttpError, OSError) as e:
+                    # the whole batch failed, so none of its callbacks ran
+                    if last_attempt or (isinstance(e, HttpError) and not _is_transient(e)):
+                        print(f"[ERROR] Batch insert failed: {e}")
+                        failed.update(chunk)
+                    else:
+                        metrics.inc("songrec_retries_total", len(chunk), provider="youtube", reason="batch")
+                        retry.extend(chunk)
+
+            pending = sorted(retry)
+            if not pending:
+                break
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            print(f"[WARNING] Retrying {len(pending)} inserts in {delay:.1f}s")
+            time.sleep(delay)
+
+        if not keep_responses:
+            responses = []
+        return responses, [video_ids[index] for index in sorted(failed)]
+
+    '''
+    Name: _execute
+    Parameters: endpoint, request, count=1
+    Returns: response
+    Purpose: Sends a request (or batch of count requests) through the
+    rate limiter and times it.
+    '''
+    def _execute(self, endpoint, request, count=1):
+        self.limiter.acquire("youtube", endpoint, count=count)
+        try:
+            with get_metrics().external_call("youtube", endpoint):
+                return request.execute()
+        finally:
+            self.YoutubeAuth.save_if_refreshed()
+
+    '''
+    Name: _new_batch
+    Parameters: callback
+    Returns: batch
+    Purpose: Starts a batch request. The client library always sends
+    batches to the discovery document's root URL, so when
+    YOUTUBE_API_URL is set the batch URL has to be pointed there too.
+    '''
+    def _new_batch(self, callback):
+        if YOUTUBE_API_URL:
+            from googleapiclient.http import BatchHttpRequest
+
+            return BatchHttpRequest(callback=callback, batch_uri=YOUTUBE_API_URL.rstrip("/") + "/batch")
+        return self.youtube.new_batch_http_request(callback=callback)
+
+    '''
+    Name: _insert_request
+    Parameters: playlist_id, video_id
+    Returns: request
+    Purpose: Builds (but doesn't send) a playlistItems insert.
+    '''
+    def _insert_request(self, playlist_id, video_id):
+        return self.youtube.playlistItems().insert(
+            part="snippet",
+            body={
+                "snippet": {
+                    "playlistId": playlist_id,
+                    "resourceId": {
+                        "kind": "youtube#video",
+                        "videoId": video_id
+                    }
+                }
+            }
+        )
+
     '''
     Name: get_user_info
     Parameters: None
@@ -264,10 +661,10 @@ class YoutubeAPI(APIBase):
     Purpose: 
     '''
     def get_user_info(self):
-        channels_response = self.youtube.channels().list(
+        channels_response = self._execute("channels.list", self.youtube.channels().list(
             part="snippet,contentDetails,statistics",
             mine=True
-        ).execute()
+        ))
 
         if channels_response['items']:
             user_info = channels_response['items'][0]["snippet"]
@@ -292,19 +689,28 @@ class LastFMAPI():
     def __init__(self):
         self.LastFMAuth = LastFMAuth()
         self.api_key = self.LastFMAuth.get_credentials()
+        self.lastfm = get_lastfm_client(self.api_key)
+        self.graph = get_artist_graph()
 
     '''
     Name: find_similar_artists
-    Parameters: artist
+    Parameters: artist, hops=1
     Returns: sim_names
     Purpose: Using the parameter artist, it searches last.fm
-    to find similar artists to the original artist. 
-    '''
-    def find_similar_artists(self, artist):
-        url = f"http://ws.audioscrobbler.com/2.0/?method=artist.getsimilar&artist={artist}&api_key={self.api_key}&format=json"
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            similars = data.get("similarartists", {}).get("artist", [])
-            sim_names = [sim['name'] for sim in similars]
-            return sim_names
\ No newline at end of file
+    to find similar artists to the original artist. Results come from
+    the local artist graph, so last.fm is only asked if the artist is
+    unseen or stale. With hops > 1 the further neighbours in the
+    graph are added after the direct ones.
+    '''
+    def find_similar_artists(self, artist, hops=1):
+        if self.graph.refresh(self.lastfm, [artist]):
+            self.graph.save()
+
+        sim_names = [name for name, _ in self.graph.similar(artist)]
+        if not sim_names and self.graph.is_stale(artist):
+            return None
+
+        if hops > 1:
+            further = [name for name, _ in self.graph.neighbourhood([artist], hops=hops)]
+            sim_names = list(dict.fromkeys(sim_names + further))
+        return sim_names
@@ -0,0 +1,362 @@
+# Import Libraries
+import argparse, os, threading, time
+import numpy as np
+
+# Import Files
+from Caches import DAY, memoized, normalise
+from Clients import LastFMError
+
+GRAPH_FILE = os.getenv("ARTIST_GRAPH_FILE", "artist_graph.npz")
+GRAPH_MAX_AGE = 7 * DAY
+
+_NO_EDGES = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+
+'''
+Name: pack_names
+Parameters: names
+Returns: offsets, blob
+Purpose: Packs names into one UTF-8 byte array and the offsets where
+each name starts, which is much smaller than a fixed-width string
+array sized for the longest name.
+'''
+def pack_names(names):
+    encoded = [name.encode("utf-8") for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+'''
+Name: unpack_names
+Parameters: offsets, blob
+Returns: names
+Purpose: The reverse of pack_names.
+'''
+def unpack_names(offsets, blob):
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+
+'''
+Name: ArtistGraph
+Purpose: A local graph of artist -> similar artist edges weighted by
+Last.fm's match score. On disk it is stored as CSR arrays (indptr,
+indices, weights) with the names packed as UTF-8 bytes plus offsets,
+so it loads quickly and stays small. An artist's edges are only
+fetched again from Last.fm once they are older than max_age, and
+always straight from Last.fm since the graph is their cache.
+'''
+class ArtistGraph():
+    '''
+    Name: __init__
+    Parameters: path=GRAPH_FILE, max_age=GRAPH_MAX_AGE
+    Returns: None
+    Purpose: Loads the graph from disk if it has been saved before.
+    '''
+    def __init__(self, path=GRAPH_FILE, max_age=GRAPH_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.names = []
+        self.index = {}
+        self.fetched_at = []
+        self.edges = {}
+        self.dirty = False
+        self.version = 0
+        if os.path.exists(path):
+            self.load()
+
+    '''
+    Name: load
+    Parameters: None
+    Returns: None
+    Purpose: Reads the CSR arrays back into per-artist edge lists.
+    Graphs saved with the old fixed-width names array still load.
+    '''
+    def load(self):
+        with np.load(self.path) as data:
+            if "name_offsets" in data:
+                names = unpack_names(data["name_offsets"], data["name_bytes"])
+            else:
+                names = data["names"].tolist()
+            fetched_at = data["fetched_at"].tolist()
+            indptr = data["indptr"]
+            indices = data["indices"]
+            weights = data["weights"]
+
+        with self.lock:
+            self.names = names
+            self.index = {normalise(name): i for i, name in enumerate(names)}
+            self.fetched_at = fetched_at
+            self.edges = {}
+            for i in range(len(names)):
+                start, end = indptr[i], indptr[i + 1]
+                if end > start:
+                    self.edges[i] = (indices[start:end], weights[start:end])
+            self.dirty = False
+            self.version += 1
+
+    '''
+    Name: to_csr
+    Parameters: None
+    Returns: indptr, indices, weights
+    Purpose: Packs every artist's edges into CSR arrays.
+    '''
+    def to_csr(self):
+        with self.lock:
+            parts = [self.edges.get(i, _NO_EDGES) for i in range(len(self.names))]
+            indptr = np.zeros(len(parts) + 1, dtype=np.int64)
+            np.cumsum([len(indices) for indices, _ in parts], out=indptr[1:])
+            if not parts:
+                return indptr, _NO_EDGES[0], _NO_EDGES[1]
+
+            indices = np.concatenate([indices for indices, _ in parts]).astype(np.int32, copy=False)
+            weights = np.concatenate([weights for _, weights in parts]).astype(np.float32, copy=False)
+            return indptr, indices, weights
+
+    '''
+    Name: snapshot
+    Parameters: None
+    Returns: version, names, indptr, indices, weights
+    Purpose: Returns a consistent copy of the graph for scoring.
+    '''
+    def snapshot(self):
+        with self.lock:
+            return (self.version, list(self.names)) + self.to_csr()
+
+    '''
+    Name: save
+    Parameters: force=False
+    Returns: None
+    Purpose: Writes the graph to disk if it has changed. It is written
+    to a temporary file first and then swapped in, so a crash can't
+    leave a half-written graph behind.
+    '''
+    def save(self, force=False):
+        with self.lock:
+            if not self.dirty and not force:
+                return
+            indptr, indices, weights = self.to_csr()
+            name_offsets, name_bytes = pack_names(self.names)
+            fetched_at = np.array(self.fetched_at, dtype=np.float64)
+            self.dirty = False
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, name_offsets=name_offsets, name_bytes=name_bytes,
+                     fetched_at=fetched_at, indptr=indptr, indices=indices, weights=weights)
+        os.replace(temp_path, self.path)
+
+    '''
+    Name: _node
+    Parameters: name
+    Returns: i
+    Purpose: Returns the index of an artist, adding it if it's new.
+    '''
+    def _node(self, name):
+        key = normalise(name)
+        i = self.index.get(key)
+        if i is None:
+            i = len(self.names)
+            self.names.append(name)
+            self.fetched_at.append(0.0)
+            self.index[key] = i
+        return i
+
+    '''
+    Name: is_stale
+    Parameters: name
+    Returns: True or False
+    Purpose: An artist is stale if their similar artists have never
+    been fetched or were fetched more than max_age ago.
+    '''
+    def is_stale(self, name):
+        with self.lock:
+            i = self.index.get(normalise(name))
+            if i is None:
+                return True
+            return time.time() - self.fetched_at[i] > self.max_age
+
+    '''
+    Name: set_similar
+    Parameters: name, similars
+    Returns: None
+    Purpose: Replaces an artist's edges with (name, match) pairs.
+    '''
+    def set_similar(self, name, similars):
+        with self.lock:
+            i = self._node(name)
+            indices = np.array([self._node(sim) for sim, _ in similars], dtype=np.int32)
+            weights = np.array([match for _, match in similars], dtype=np.float32)
+            self.edges[i] = (indices, weights)
+            self.fetched_at[i] = time.time()
+            self.dirty = True
+            self.version += 1
+
+    '''
+    Name: set_similar_from_lastfm
+    Parameters: name, data
+    Returns: similars
+    Purpose: Stores the edges from an artist.getsimilar response and
+    returns them as (name, match) pairs.
+    '''
+    def set_similar_from_lastfm(self, name, data):
+        similars = []
+        for sim in data.get("similarartists", {}).get("artist", []):
+            try:
+                match = float(sim.get("match", 0))
+            except (TypeError, ValueError):
+                match = 0.0
+            similars.append((sim["name"], match))
+        self.set_similar(name, similars)
+        return similars
+
+    '''
+    Name: similar
+    Parameters: name
+    Returns: similars
+    Purpose: Returns an artist's stored (name, match) pairs, closest first.
+    '''
+    def similar(self, name):
+        with self.lock:
+            i = self.index.get(normalise(name))
+            if i is None:
+                return []
+            indices, weights = self.edges.get(i, _NO_EDGES)
+            pairs = [(self.names[j], float(w)) for j, w in zip(indices.tolist(), weights.tolist())]
+        return sorted(pairs, key=lambda x: x[1], reverse=True)
+
+    '''
+    Name: refresh
+    Parameters: lastfm, names
+    Returns: refreshed
+    Purpose: Fetches artist.getsimilar only for the artists in names
+    that are unseen or stale, and returns how many were refreshed. It
+    uses lastfm.fetch rather than call, since the response cache keeps
+    artist.getsimilar longer than max_age and would hand back the same
+    old edges.
+    '''
+    def refresh(self, lastfm, names):
+        refreshed = 0
+        for name in names:
+            if not self.is_stale(name):
+                continue
+            try:
+                data = memoized(("lastfm.fetch", "artist.getsimilar", normalise(name)),
+                                lastfm.fetch, "artist.getsimilar", artist=name)
+            except LastFMError as e:
+                print(f"[WARNING] Failed to get similar artists for {name}: {e}")
+                continue
+            self.set_similar_from_lastfm(name, data)
+            refreshed += 1
+        return refreshed
+
+    '''
+    Name: stalest
+    Parameters: limit
+    Returns: names
+    Purpose: Returns up to limit fetched artists whose edges are older
+    than max_age, oldest first, for incremental background refreshes.
+    '''
+    def stalest(self, limit):
+        cutoff = time.time() - self.max_age
+        with self.lock:
+            stale = [(at, i) for i, at in enumerate(self.fetched_at) if 0 < at < cutoff]
+            stale.sort()
+            return [self.names[i] for _, i in stale[:limit]]
+
+    '''
+    Name: neighbourhood
+    Parameters: seeds, hops=2, limit=50
+    Returns: [(name, score)]
+    Purpose: Finds artists within hops edges of the seed artists using
+    only the local graph. An artist's score is the best product of
+    match weights along any path to it.
+    '''
+    def neighbourhood(self, seeds, hops=2, limit=50):
+        with self.lock:
+            seed_nodes = {self.index[normalise(s)] for s in seeds if normalise(s) in self.index}
+            frontier = {i: 1.0 for i in seed_nodes}
+            visited = set(seed_nodes)
+            scores = {}
+
+            for _ in range(hops):
+                reached = {}
+                for node, score in frontier.items():
+                    indices, weights = self.edges.get(node, _NO_EDGES)
+                    for j, w in zip(indices.tolist(), weights.tolist()):
+                        if j in seed_nodes:
+                            continue
+                        if score * w > reached.get(j, 0.0):
+                            reached[j] = score * w
+
+                for j, score in reached.items():
+                    if score > scores.get(j, 0.0):
+                        scores[j] = score
+                frontier = {j: s for j, s in reached.items() if j not in visited}
+                visited.update(frontier)
+
+            ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:limit]
+            return [(self.names[j], score) for j, score in ranked]
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns the number of artists, fetched artists and edges.
+    '''
+    def stats(self):
+        with self.lock:
+            return {
+                "artists": len(self.names),
+                "fetched": sum(1 for at in self.fetched_at if at > 0),
+                "stale": len(self.stalest(len(self.names))),
+                "edges": sum(len(indices) for indices, _ in self.edges.values()),
+            }
+
+_graph = None
+_graph_lock = threading.Lock()
+
+'''
+Name: get_artist_graph
+Parameters: None
+Returns: _graph
+Purpose: Returns the shared ArtistGraph, loading it on first use.
+'''
+def get_artist_graph():
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = ArtistGraph()
+        return _graph
+
+'''
+Name: main
+Parameters: argv=None
+Returns: None
+Purpose: Command line tool to show graph stats or refresh the
+stalest artists, e.g. "python ArtistGraph.py refresh --limit 100".
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or refresh the local artist graph.")
+    parser.add_argument("--path", default=GRAPH_FILE)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show graph size")
+    refresh_parser = commands.add_parser("refresh", help="re-fetch the stalest artists")
+    refresh_parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    graph = ArtistGraph(args.path)
+    if args.command == "stats":
+        print(graph.stats())
+    elif args.command == "refresh":
+        from Auths import LastFMAuth
+        from Clients import get_lastfm_client
+
+        lastfm = get_lastfm_client(LastFMAuth().get_credentials())
+        count = graph.refresh(lastfm, graph.stalest(args.limit))
+        graph.save()
+        print(f"Refreshed {count} artists.")
+
+if __name__ == '__main__':
+    main()
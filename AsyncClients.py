@@ -0,0 +1,423 @@
+# Import Libraries
+import asyncio, atexit, threading, weakref
+from urllib.parse import urlsplit
+import aiohttp
+from spotipy.exceptions import SpotifyException
+
+# Import Files
+from Auths import get_token_provider
+from Caches import ResponseCache, amemoized, get_response_cache
+from Clients import (IP_API_URL, IPIFY_URL, LASTFM_URL, OPENWEATHER_URL,
+                     SPOTIFY_API_URL, LastFMError)
+from Metrics import endpoint_label, get_metrics, task_factory
+from RateLimits import get_rate_limiter
+
+# most requests allowed in flight at once per host
+HOST_LIMITS = {
+    urlsplit(LASTFM_URL).netloc: 5,
+    urlsplit(SPOTIFY_API_URL).netloc: 10,
+}
+DEFAULT_HOST_LIMIT = 4
+
+# rate limiter provider for each host (keyed by host:port so that
+# stand-in servers on one machine still map to the right provider)
+HOST_PROVIDERS = {
+    urlsplit(LASTFM_URL).netloc: "lastfm",
+    urlsplit(SPOTIFY_API_URL).netloc: "spotify",
+    urlsplit(OPENWEATHER_URL).netloc: "openweather",
+    urlsplit(IP_API_URL).netloc: "ip-api",
+    urlsplit(IPIFY_URL).netloc: "ipify",
+}
+
+'''
+Name: _close_with_loop
+Parameters: session
+Returns: None
+Purpose: Async generator that closes a session when its loop shuts
+down. asyncio.run() calls aclose() on every async generator still
+open in the loop before closing it, so the session is closed while
+its loop can still run the close.
+'''
+async def _close_with_loop(session):
+    try:
+        yield
+    finally:
+        await session.close()
+
+'''
+Name: AsyncHTTP
+Purpose: A shared aiohttp client for the async recommendation engine.
+It keeps one keep-alive connection pool and one set of per-host
+limits per event loop, so threads running their own loops never share
+or reset each other's, and waits out 429s.
+'''
+class AsyncHTTP():
+    '''
+    Name: __init__
+    Parameters: host_limits=None, timeout=10, max_retries=3
+    Returns: None
+    Purpose: Stores the per-host limits. Sessions are created on first
+    use in each loop because they have to belong to a running loop.
+    '''
+    def __init__(self, host_limits=None, timeout=10, max_retries=3):
+        self.host_limits = dict(HOST_LIMITS if host_limits is None else host_limits)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # loop -> {"session", "semaphores", "closer"}
+        self._loops = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.limiter = get_rate_limiter()
+
+    '''
+    Name: _loop_state
+    Parameters: None
+    Returns: state
+    Purpose: Returns the running loop's session and semaphores,
+    creating them the first time the loop makes a request. Entries for
+    loops that have been closed are dropped.
+    '''
+    async def _loop_state(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for old_loop in [l for l in self._loops if l.is_closed()]:
+                del self._loops[old_loop]
+            state = self._loops.get(loop)
+            if state is not None and not state["session"].closed:
+                return state
+
+            connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            state = {"session": session, "semaphores": {}, "closer": _close_with_loop(session)}
+            self._loops[loop] = state
+        # starting the generator registers it with the loop's shutdown
+        await state["closer"].__anext__()
+        return state
+
+    '''
+    Name: _semaphore
+    Parameters: state, host
+    Returns: semaphore
+    Purpose: Returns the semaphore that caps concurrency for a host in
+    one loop.
+    '''
+    def _semaphore(self, state, host):
+        semaphore = state["semaphores"].get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.host_limits.get(host, DEFAULT_HOST_LIMIT))
+            state["semaphores"][host] = semaphore
+        return semaphore
+
+    '''
+    Name: get
+    Parameters: url, params=None, headers=None
+    Returns: status, headers, data
+    Purpose: Sends a GET request and decodes the JSON body (data is
+    None if the body isn't JSON). Every attempt goes through the rate
+    limiter, and a 429 pauses the host's provider for Retry-After
+    before retrying.
+    '''
+    async def get(self, url, params=None, headers=None):
+        state = await self._loop_state()
+        session = state["session"]
+        if params is not None:
+            params = {name: str(value) for name, value in params.items()}
+        host = urlsplit(url).netloc
+        provider = HOST_PROVIDERS.get(host, host)
+        endpoint = params.get("method") if params else None
+        metrics = get_metrics()
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.aacquire(provider, endpoint)
+            async with self._semaphore(state, host):
+                with metrics.external_call(provider, endpoint or f"GET {endpoint_label(url)}"):
+                    async with session.get(url, params=params, headers=headers) as response:
+                        status = response.status
+                        response_headers = dict(response.headers)
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            data = None
+
+            if status == 429:
+                metrics.inc("songrec_rate_limited_total", provider=provider)
+            if status != 429 or attempt == self.max_retries:
+                return status, response_headers, data
+            metrics.inc("songrec_retries_total", provider=provider, reason="429")
+
+            try:
+                retry_after = float(response_headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1
+            print(f"[WARNING] {host} rate limit hit, waiting {retry_after}s")
+            self.limiter.pause(provider, retry_after)
+
+    '''
+    Name: close
+    Parameters: None
+    Returns: None
+    Purpose: Closes the running loop's session and its connections.
+    '''
+    async def close(self):
+        with self._lock:
+            state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state["closer"].aclose()
+
+'''
+Name: AsyncLastFMClient
+Purpose: The async version of Clients.LastFMClient. It shares the
+same on-disk response cache and raises the same LastFMError.
+'''
+class AsyncLastFMClient():
+    '''
+    Name: __init__
+    Parameters: api_key, http, cache=None
+    Returns: None
+    Purpose: Keeps the api key, the shared AsyncHTTP and the cache.
+    '''
+    def __init__(self, api_key, http, cache=None):
+        self.api_key = api_key
+        self.http = http
+        self.cache = cache
+        self._refreshing = set()
+        self._tasks = set()
+
+    '''
+    Name: call
+    Parameters: method, **params
+    Returns: data
+    Purpose: Returns the response for a Last.fm API method, served
+    from the run memo or the cache when possible. Stale entries are
+    returned straight away and refreshed in a background task.
+    '''
+    async def call(self, method, **params):
+        key = ("lastfm", self.api_key, ResponseCache.make_key(method, params))
+        return await amemoized(key, self._call, method, params)
+
+    '''
+    Name: _call
+    Parameters: method, params
+    Returns: data
+    Purpose: Looks the response up in the cache, fetching it on a miss.
+    '''
+    async def _call(self, method, params):
+        if self.cache is None:
+            return await self.fetch(method, **params)
+
+        data, state = self.cache.get(method, params)
+        if state == "stale":
+            key = self.cache.make_key(method, params)
+            if key not in self._refreshing:
+                self._refreshing.add(key)
+                task = asyncio.ensure_future(self._refresh(key, method, params))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        if data is not None:
+            return data
+
+        data = await self.fetch(method, **params)
+        self.cache.set(method, params, data)
+        return data
+
+    '''
+    Name: _refresh
+    Parameters: key, method, params
+    Returns: None
+    Purpose: Re-fetches a stale cache entry.
+    '''
+    async def _refresh(self, key, method, params):
+        try:
+            self.cache.set(method, params, await self.fetch(method, **params))
+        except LastFMError as e:
+            print(f"[WARNING] Couldn't refresh cached {method}: {e}")
+        finally:
+            self._refreshing.discard(key)
+
+    '''
+    Name: fetch
+    Parameters: method, **params
+    Returns: data
+    Purpose: Calls a Last.fm API method and returns the decoded JSON,
+    raising LastFMError on any failure.
+    '''
+    async def fetch(self, method, **params):
+        query = {"method": method, **params, "api_key": self.api_key, "format": "json"}
+        try:
+            status, _, data = await self.http.get(LASTFM_URL, params=query)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise LastFMError(method, str(e) or type(e).__name__) from e
+
+        if isinstance(data, dict) and "error" in data:
+            raise LastFMError(method, data.get("message", "Unknown error"), status, data["error"])
+        if status != 200:
+            raise LastFMError(method, f"HTTP {status}", status)
+        if data is None:
+            raise LastFMError(method, "Response was not valid JSON", status)
+
+        return data
+
+'''
+Name: AsyncSpotifyClient
+Purpose: The handful of Spotify Web API endpoints the recommenders
+use, called through the shared AsyncHTTP. Errors are raised as
+spotipy's SpotifyException so sync and async callers handle them alike.
+'''
+class AsyncSpotifyClient():
+    '''
+    Name: __init__
+    Parameters: spotify_auth, http
+    Returns: None
+    Purpose: Keeps the SpotifyAuth used to get a bearer token and the
+    shared AsyncHTTP.
+    '''
+    def __init__(self, spotify_auth, http):
+        self.spotify_auth = spotify_auth
+        self.http = http
+
+    '''
+    Name: _get
+    Parameters: path, params=None
+    Returns: data
+    Purpose: Sends an authorised GET to the Spotify Web API. If the
+    token is rejected with a 401 it is refreshed (off the event loop)
+    and the request is sent once more.
+    '''
+    async def _get(self, path, params=None):
+        for attempt in range(2):
+            headers = {"Authorization": f"Bearer {self.spotify_auth.get_access_token()}"}
+            try:
+                status, response_headers, data = await self.http.get(
+                    SPOTIFY_API_URL + path, params=params, headers=headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise SpotifyException(599, -1, f"{path}: {str(e) or type(e).__name__}") from e
+
+            if status != 401 or attempt == 1:
+                break
+            print("[DEBUG] Spotify token was rejected. Refreshing now...")
+            await asyncio.get_running_loop().run_in_executor(
+                None, get_token_provider(self.spotify_auth).refresh)
+
+        if status >= 400:
+            error = data.get("error") if isinstance(data, dict) else None
+            message = error.get("message") if isinstance(error, dict) else f"HTTP {status}"
+            raise SpotifyException(status, -1, f"{path}: {message}", headers=response_headers)
+        return data
+
+    '''
+    Name: search
+    Parameters: q, type="track", limit=10
+    Returns: results
+    Purpose: Same as spotipy's Spotify.search.
+    '''
+    async def search(self, q, type="track", limit=10):
+        return await self._get("search", {"q": q, "type": type, "limit": limit})
+
+    '''
+    Name: artist_top_tracks
+    Parameters: artist_id, country="US"
+    Returns: results
+    Purpose: Same as spotipy's Spotify.artist_top_tracks.
+    '''
+    async def artist_top_tracks(self, artist_id, country="US"):
+        return await self._get(f"artists/{artist_id}/top-tracks", {"market": country})
+
+    '''
+    Name: current_user_top_artists
+    Parameters: limit=20, time_range="medium_term"
+    Returns: results
+    Purpose: Same as spotipy's Spotify.current_user_top_artists.
+    '''
+    async def current_user_top_artists(self, limit=20, time_range="medium_term"):
+        return await self._get("me/top/artists", {"limit": limit, "time_range": time_range})
+
+    '''
+    Name: me
+    Parameters: None
+    Returns: user_info
+    Purpose: Same as spotipy's Spotify.me.
+    '''
+    async def me(self):
+        return await self._get("me")
+
+_http = AsyncHTTP()
+_async_lastfm_clients = {}
+_async_lock = threading.Lock()
+_engine_loop = None
+_engine_thread = None
+
+'''
+Name: get_async_http
+Parameters: None
+Returns: _http
+Purpose: Returns the AsyncHTTP shared by every async client.
+'''
+def get_async_http():
+    return _http
+
+'''
+Name: get_async_lastfm_client
+Parameters: api_key
+Returns: client
+Purpose: Returns the shared AsyncLastFMClient for this api key.
+'''
+def get_async_lastfm_client(api_key):
+    with _async_lock:
+        client = _async_lastfm_clients.get(api_key)
+        if client is None:
+            client = AsyncLastFMClient(api_key, _http, cache=get_response_cache())
+            _async_lastfm_clients[api_key] = client
+        return client
+
+'''
+Name: get_engine_loop
+Parameters: None
+Returns: _engine_loop
+Purpose: Returns the event loop the async recommendation engine runs
+on, starting it in a background thread on first use. Every sync
+caller shares it, so concurrent jobs share one connection pool and
+one set of per-host limits. Every task on it counts its own CPU time,
+so spans don't pick up the CPU of other tasks that ran meanwhile.
+'''
+def get_engine_loop():
+    global _engine_loop, _engine_thread
+    with _async_lock:
+        if _engine_loop is None:
+            _engine_loop = asyncio.new_event_loop()
+            # each task keeps its own CPU clock for the profiler
+            _engine_loop.set_task_factory(task_factory)
+            _engine_thread = threading.Thread(target=_engine_loop.run_forever,
+                                              name="async-engine", daemon=True)
+            _engine_thread.start()
+            atexit.register(_stop_engine_loop)
+        return _engine_loop
+
+'''
+Name: run_sync
+Parameters: coro
+Returns: result
+Purpose: Runs a coroutine on the engine loop and blocks until it
+finishes. The coroutine runs in a copy of the caller's context, so the
+run memo, trace spans and rate limit lane carry over.
+'''
+def run_sync(coro):
+    loop = get_engine_loop()
+    if threading.current_thread() is _engine_thread:
+        coro.close()
+        raise RuntimeError("run_sync can't be called from the engine loop, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+'''
+Name: _stop_engine_loop
+Parameters: None
+Returns: None
+Purpose: Closes the engine loop's session and stops the loop when the
+program exits.
+'''
+def _stop_engine_loop():
+    try:
+        asyncio.run_coroutine_threadsafe(_http.close(), _engine_loop).result(timeout=5)
+    except Exception as e:
+        print(f"[WARNING] Couldn't close the async HTTP session: {e}")
+    _engine_loop.call_soon_threadsafe(_engine_loop.stop)
@@ -1,10 +1,68 @@
-import os, pickle
+import os, pickle, sys, tempfile, threading, time
 from abc import ABC, abstractmethod
-from flask.cli import load_dotenv
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 
-load_dotenv()
+from Metrics import get_metrics
+
+# python-dotenv is used directly since going through flask.cli imports
+# all of flask; like flask, a missing .env support package is ignored
+try:
+    from dotenv import find_dotenv, load_dotenv
+    load_dotenv(find_dotenv(usecwd=True))
+except ImportError:
+    pass
+
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com/")
+
+'''
+Name: write_pickle
+Parameters: path, obj
+Returns: None
+Purpose: Pickles obj to path atomically by writing a temporary file
+next to it and renaming it into place, so a crash or another thread
+reading at the same time never sees a half written token file.
+'''
+def write_pickle(path, obj):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".pickle", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(obj, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+'''
+Name: YouTubeAuthError
+Purpose: Raised when the YouTube credentials can't be loaded or
+refreshed and logging in again would need a browser, e.g. in batch
+mode or the HTTP service, or when Google can't be reached to refresh
+them.
+'''
+class YouTubeAuthError(Exception):
+    pass
+
+'''
+Name: SpotifyAuthError
+Purpose: Raised when there is no usable Spotify token and logging in
+again would need someone to paste the redirect URL, e.g. in batch mode
+or the HTTP service, or when Spotify has revoked the refresh token.
+'''
+class SpotifyAuthError(Exception):
+    pass
+
+'''
+Name: _oauth_error
+Parameters: response
+Returns: error or None
+Purpose: Returns the "error" code of an OAuth error response, such as
+"invalid_grant", or None if the body isn't one.
+'''
+def _oauth_error(response):
+    try:
+        return response.json().get("error")
+    except (ValueError, AttributeError):
+        return None
 
 class AuthBase(ABC):
     def __init__(self):
@@ -28,13 +86,16 @@ Inherits from AuthBase(ABC).
 class SpotifyAuth(AuthBase):
     '''
     Name: __init__
-    Parameters: None
+    Parameters: interactive=None
     Returns: None
     Purpose: Initialises any variables needed for
     Spotify Authentication such as the client credentials.
+    interactive says whether the login prompt may be shown; None
+    decides when it is needed, by whether stdin is a terminal.
     '''
-    def __init__(self):
+    def __init__(self, interactive=None):
         super().__init__()
+        self.interactive = interactive
         self.client_id = os.getenv("spotify_client_id")
         self.client_secret = os.getenv("spotify_client_secret")
         self.redirect_uri = os.getenv("redirect_uri")
@@ -45,6 +106,7 @@ class SpotifyAuth(AuthBase):
         self.token_file = "spotify_token.pickle"
         self.access_token = None
         self.refresh_token = None
+        self.token_info = None
 
     '''
     Name: authenticate
@@ -61,11 +123,33 @@ class SpotifyAuth(AuthBase):
             if not self._is_token_expired(token_info):
                 self.access_token = token_info["access_token"]
                 self.refresh_token = token_info.get("refresh_token")
+                self.token_info = token_info
                 return self.access_token
-            else:
+            if token_info.get("refresh_token"):
                 return self._refresh_access_token(token_info["refresh_token"])
+            print("[WARNING] No Spotify refresh token found, logging in again.")
 
+        return self._login(code)
+
+    '''
+    Name: _login
+    Parameters: code=None
+    Returns: self.access_token
+    Purpose: Swaps an authorization code for a token and saves it,
+    asking the user to log in for the code if none is given. When the
+    process isn't interactive SpotifyAuthError is raised instead of
+    prompting.
+    '''
+    def _login(self, code=None):
         if code is None:
+            interactive = self.interactive
+            if interactive is None:
+                interactive = sys.stdin is not None and sys.stdin.isatty()
+            if not interactive:
+                raise SpotifyAuthError(
+                    f"Spotify token in {self.token_file} is missing or can't be refreshed; "
+                    "run the program interactively once to log in")
+
             from urllib.parse import urlencode
 
             params = {
@@ -74,7 +158,7 @@ class SpotifyAuth(AuthBase):
                 "redirect_uri": self.redirect_uri,
                 "scope": self.scope,
             }
-            auth_url = "https://accounts.spotify.com/authorize?" + urlencode(params)
+            auth_url = SPOTIFY_ACCOUNTS_URL + "authorize?" + urlencode(params)
             print("\n Please login to Spotify using this link")
             print(auth_url)
 
@@ -82,39 +166,41 @@ class SpotifyAuth(AuthBase):
             from urllib.parse import urlparse, parse_qs
             code = parse_qs(urlparse(redirected_url).query)["code"][0]
 
-            token_url = "https://accounts.spotify.com/api/token"
-            data = {
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": self.redirect_uri,
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-            }
+        token_url = SPOTIFY_ACCOUNTS_URL + "api/token"
+        data = {
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": self.redirect_uri,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
 
-            import requests, time
+        import requests, time
+        with get_metrics().external_call("spotify-accounts", "POST /api/token"):
             response = requests.post(token_url, data=data)
-            response.raise_for_status()
-            token_info = response.json()
+        response.raise_for_status()
+        token_info = response.json()
 
-            token_info["expires_at"] = int(time.time()) + token_info.get("expires_in", 3600)
+        token_info["expires_at"] = int(time.time()) + token_info.get("expires_in", 3600)
 
-            self.access_token = token_info["access_token"]
-            self.refresh_token = token_info.get("refresh_token")
+        self.access_token = token_info["access_token"]
+        self.refresh_token = token_info.get("refresh_token")
+        self.token_info = token_info
 
-            with open(self.token_file, "wb") as f:
-                pickle.dump(token_info, f)
+        write_pickle(self.token_file, token_info)
 
-            return self.access_token
+        return self.access_token
 
     '''
     Name: _refresh_access_token
     Parameters: refresh_token  
     Returns: self.access_token
     Purpose: This refreshes the access token since 
-    they can expire after a while, and this refreshes it.
+    they can expire after a while, and this refreshes it. Raises
+    SpotifyAuthError if Spotify rejects the refresh token.
     '''
     def _refresh_access_token(self, refresh_token):
-        token_url = "https://accounts.spotify.com/api/token"
+        token_url = SPOTIFY_ACCOUNTS_URL + "api/token"
         data = {
             "grant_type": "refresh_token",
             "refresh_token": refresh_token,
@@ -122,7 +208,10 @@ class SpotifyAuth(AuthBase):
             "client_secret": self.client_secret,
         }
         import requests, time
-        response = requests.post(token_url, data=data)
+        with get_metrics().external_call("spotify-accounts", "POST /api/token"):
+            response = requests.post(token_url, data=data)
+        if response.status_code == 400 and _oauth_error(response) == "invalid_grant":
+            raise SpotifyAuthError("Spotify rejected the refresh token, it may have been revoked; log in again")
         response.raise_for_status()
         token_info = response.json()
 
@@ -133,9 +222,9 @@ class SpotifyAuth(AuthBase):
 
         self.access_token = token_info["access_token"]
         self.refresh_token = token_info.get("refresh_token", refresh_token)
+        self.token_info = token_info
 
-        with open(self.token_file, "wb") as f:
-            pickle.dump(token_info, f)
+        write_pickle(self.token_file, token_info)
 
         return self.access_token
 
@@ -165,28 +254,194 @@ class SpotifyAuth(AuthBase):
     def get_credentials(self):
         return self.client_id, self.client_secret, self.access_token, self.scope
 
+    '''
+    Name: load_token_info
+    Parameters: None
+    Returns: token_info or None
+    Purpose: Reads the pickled token file, or returns None if the user
+    hasn't logged in yet.
+    '''
+    def load_token_info(self):
+        if not os.path.exists(self.token_file):
+            return None
+        with open(self.token_file, "rb") as f:
+            return pickle.load(f)
+
     '''
     Name: get_access_token
     Parameters: None
-    Returns: self.authenticate, self._refresh_access_token, token_info["access_token"]
-    Purpose: This gets the access token from the pickled token file and checks if expired
-    or if the access token exists, this then begins the .authenticate() method. 
+    Returns: access_token
+    Purpose: Returns the current access token from the process-wide
+    SpotifyTokenProvider, which keeps it in memory and refreshes it in
+    the background before it expires, so this normally does no file
+    or network I/O.
     '''
     def get_access_token(self):
-        if os.path.exists(self.token_file):
-            with open(self.token_file, "rb") as f:
-                token_info = pickle.load(f)
+        return get_token_provider(self).get_token()
+
+'''
+Name: SpotifyTokenProvider
+Purpose: Holds the Spotify token in memory for the whole process and
+refreshes it on a background timer shortly before expires_at, so
+callers get the current token without reading the pickle file or
+waiting on a refresh. Only the very first call, or a call after the
+token has actually expired, does the refresh in the foreground.
+'''
+class SpotifyTokenProvider():
+    '''
+    Name: __init__
+    Parameters: auth, refresh_margin=300, retry_delay=30
+    Returns: None
+    Purpose: Keeps the SpotifyAuth used to load and refresh the token.
+    The token is refreshed refresh_margin seconds before it expires,
+    and a failed background refresh is retried after retry_delay.
+    '''
+    def __init__(self, auth, refresh_margin=300, retry_delay=30):
+        self.auth = auth
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.token_info = None
+        self.timer = None
+
+    '''
+    Name: get_token
+    Parameters: None
+    Returns: access_token
+    Purpose: Returns the in-memory token while it is still valid,
+    otherwise loads or refreshes it.
+    '''
+    def get_token(self):
+        token_info = self.token_info
+        if token_info is not None and time.time() < token_info["expires_at"]:
+            return token_info["access_token"]
 
-            if self._is_token_expired(token_info):
-                refresh_token = token_info.get("refresh_token")
-                if not refresh_token:
-                    print("No refresh token found. Re-authentication required.")
-                    return self.authenticate()
-                return self._refresh_access_token(refresh_token)
-            else:
-                return token_info["access_token"]
+        with self.lock:
+            token_info = self.token_info
+            if token_info is None or time.time() >= token_info["expires_at"]:
+                self._load()
+            return self.token_info["access_token"]
 
-        return self.authenticate()
+    '''
+    Name: refresh
+    Parameters: None
+    Returns: access_token
+    Purpose: Refreshes the token now, for callers that have had it
+    rejected by Spotify before it was due to expire.
+    '''
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+            return self.token_info["access_token"]
+
+    '''
+    Name: _load
+    Parameters: None
+    Returns: None
+    Purpose: Loads the token from the token file, refreshing it if it
+    has expired, or runs the login flow if there isn't a usable one.
+    The login raises SpotifyAuthError rather than prompting when the
+    process isn't interactive.
+    '''
+    def _load(self):
+        token_info = self.auth.load_token_info()
+        if token_info is not None and not self.auth._is_token_expired(token_info):
+            self._set(token_info)
+            return
+
+        if token_info is not None and token_info.get("refresh_token"):
+            self.token_info = token_info
+            try:
+                self._refresh()
+                return
+            except SpotifyAuthError as e:
+                print(f"[WARNING] {e}")
+        elif token_info is not None:
+            print("[WARNING] No Spotify refresh token found, logging in again.")
+
+        self.auth._login()
+        self._set(self.auth.token_info)
+
+    '''
+    Name: _refresh
+    Parameters: None
+    Returns: None
+    Purpose: Swaps the refresh token for a new access token.
+    '''
+    def _refresh(self):
+        refresh_token = self.token_info.get("refresh_token") if self.token_info else None
+        if refresh_token is None:
+            self._load()
+            return
+        self.auth._refresh_access_token(refresh_token)
+        self._set(self.auth.token_info)
+
+    '''
+    Name: _set
+    Parameters: token_info
+    Returns: None
+    Purpose: Stores the token and schedules its background refresh.
+    '''
+    def _set(self, token_info):
+        if token_info is None:
+            raise SpotifyAuthError("Spotify authentication didn't return a token")
+        self.token_info = token_info
+        self._schedule(token_info["expires_at"] - self.refresh_margin - time.time())
+
+    '''
+    Name: _schedule
+    Parameters: delay
+    Returns: None
+    Purpose: Starts a daemon timer that refreshes the token after delay.
+    '''
+    def _schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    '''
+    Name: _background_refresh
+    Parameters: None
+    Returns: None
+    Purpose: Runs on the timer thread. A failed refresh is retried
+    later, and callers keep the old token until it actually expires.
+    If the refresh token was revoked, retrying can't help, so the timer
+    stops and the error is raised to the first caller after expiry.
+    '''
+    def _background_refresh(self):
+        try:
+            with self.lock:
+                if not self.token_info.get("refresh_token"):
+                    raise SpotifyAuthError("the Spotify token has no refresh token")
+                self._refresh()
+        except SpotifyAuthError as e:
+            print(f"[ERROR] Stopped refreshing the Spotify token in the background: {e}")
+            with self.lock:
+                self.timer = None
+        except Exception as e:
+            print(f"[WARNING] Spotify token refresh failed, retrying in {self.retry_delay}s: {e}")
+            with self.lock:
+                self._schedule(self.retry_delay)
+
+_token_providers = {}
+_token_providers_lock = threading.Lock()
+
+'''
+Name: get_token_provider
+Parameters: auth
+Returns: provider
+Purpose: Returns the SpotifyTokenProvider shared by every SpotifyAuth
+that uses the same token file.
+'''
+def get_token_provider(auth):
+    with _token_providers_lock:
+        provider = _token_providers.get(auth.token_file)
+        if provider is None:
+            provider = SpotifyTokenProvider(auth)
+            _token_providers[auth.token_file] = provider
+        return provider
 
 '''
 Name: YouTubeAuth
@@ -209,31 +464,119 @@ class YouTubeAuth(AuthBase):
         self.credentials = None
         self.client_secret_file = "client_secret.json"
         self.token_file = "youtube_token.pickle"
+        self.lock = threading.Lock()
+        self.saved_token = None
 
     '''
     Name: authenticate
-    Parameters: None
-    Returns: self.access_token   
+    Parameters: interactive=None
+    Returns: self.access_token
     Purpose: This is where the main authentication flow
-    happens which calls the other methods in the YouTube class 
-    in order to authenticate the user. 
+    happens which calls the other methods in the YouTube class
+    in order to authenticate the user. Saved credentials are used
+    if they are valid and silently refreshed if they have expired;
+    the browser login only runs as a last resort, and never when
+    interactive is False (it defaults to whether stdin is a terminal),
+    in which case YouTubeAuthError is raised instead. It is also raised
+    if Google couldn't be reached to refresh the token.
     '''
-    def authenticate(self):
-        if os.path.exists(self.token_file):
+    def authenticate(self, interactive=None):
+        if interactive is None:
+            interactive = sys.stdin is not None and sys.stdin.isatty()
+
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = self._load_credentials()
+
+            if self.credentials and not self.credentials.valid and self.credentials.refresh_token:
+                self._refresh_credentials()
+
+            if not self.credentials or not self.credentials.valid:
+                if not interactive:
+                    raise YouTubeAuthError(
+                        f"YouTube credentials in {self.token_file} are missing or can't be refreshed; "
+                        "run the program interactively once to log in")
+                from google_auth_oauthlib.flow import InstalledAppFlow
+
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.client_secret_file,
+                    scopes = self.scopes
+                )
+                self.credentials = flow.run_local_server(port=8080)
+                self._save_credentials()
+
+            self.access_token = self.credentials.token
+            return self.access_token
+
+    '''
+    Name: _load_credentials
+    Parameters: None
+    Returns: credentials or None
+    Purpose: Reads the pickled credentials, or returns None if there
+    aren't any or the file can't be read.
+    '''
+    def _load_credentials(self):
+        if not os.path.exists(self.token_file):
+            return None
+        try:
             with open(self.token_file, "rb") as token:
-                self.credentials = pickle.load(token)
-
-        if not self.credentials or not self.credentials.valid:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                self.client_secret_file,
-                scopes = self.scopes
-            )
-            self.credentials = flow.run_local_server(port=8080)
-            with open(self.token_file, "wb") as token:
-                pickle.dump(self.credentials, token)
-
-        self.access_token = self.credentials.token
-        return self.access_token
+                credentials = pickle.load(token)
+        except Exception as e:
+            print(f"[WARNING] Couldn't read {self.token_file}, logging in again: {e}")
+            return None
+        self.saved_token = credentials.token
+        return credentials
+
+    '''
+    Name: _refresh_credentials
+    Parameters: None
+    Returns: None
+    Purpose: Gets a new access token with the refresh token and saves
+    it. If Google rejects the refresh token the credentials are
+    dropped so the caller falls back to logging in. If Google can't be
+    reached they are kept for a later retry and YouTubeAuthError is
+    raised, since logging in again wouldn't help.
+    '''
+    def _refresh_credentials(self):
+        from google.auth.exceptions import RefreshError, TransportError
+        from google.auth.transport.requests import Request
+
+        try:
+            with get_metrics().external_call("google-oauth", "POST /token"):
+                self.credentials.refresh(Request())
+        except RefreshError as e:
+            print(f"[WARNING] YouTube token refresh was rejected: {e}")
+            self.credentials = None
+            return
+        except TransportError as e:
+            raise YouTubeAuthError(f"Couldn't reach Google to refresh the YouTube token: {e}") from e
+        print("[DEBUG] YouTube access token refreshed.")
+        self._save_credentials()
+
+    '''
+    Name: _save_credentials
+    Parameters: None
+    Returns: None
+    Purpose: Writes the credentials to the token file atomically.
+    '''
+    def _save_credentials(self):
+        write_pickle(self.token_file, self.credentials)
+        self.saved_token = self.credentials.token
+
+    '''
+    Name: save_if_refreshed
+    Parameters: None
+    Returns: None
+    Purpose: Saves the credentials if the API client refreshed the
+    access token itself (it does on a 401), so the next run starts
+    with the new token.
+    '''
+    def save_if_refreshed(self):
+        if self.credentials is None or self.credentials.token == self.saved_token:
+            return
+        with self.lock:
+            if self.credentials.token != self.saved_token:
+                self._save_credentials()
 
     '''
     Name: get_credentials
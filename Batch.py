@@ -0,0 +1,298 @@
+# Import Libraries
+import argparse, contextlib, contextvars, json, sys, threading, time, traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Import Files
+from Auths import LastFMAuth, SpotifyAuth, WeatherAPI
+from Clients import get_lastfm_client, get_spotify_client
+from Metrics import get_metrics
+from Profiling import add_profile_arguments, profiler_from_args
+from RateLimits import get_rate_limiter, lane
+
+RECOMMENDERS = ("genre", "user", "season", "weather")
+EXPORTS = (None, "spotify", "youtube", "both")
+
+'''
+Name: JobError
+Purpose: Raised when a job line is invalid, e.g. an unknown type or
+a missing genre.
+'''
+class JobError(Exception):
+    pass
+
+'''
+Name: read_jobs
+Parameters: lines
+Returns: jobs
+Purpose: Parses a JSONL job file into (line number, job or error)
+pairs. Blank lines are skipped and bad lines are kept as errors so
+they show up in the results instead of stopping the batch.
+'''
+def read_jobs(lines):
+    jobs = []
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise JobError("job must be a JSON object")
+        except (ValueError, JobError) as e:
+            jobs.append((number, JobError(f"line {number}: {e}")))
+            continue
+        job.setdefault("id", str(number))
+        jobs.append((number, job))
+    return jobs
+
+'''
+Name: BatchRunner
+Purpose: Runs recommendation jobs without any input() prompts. The
+Spotify and Last.fm clients are shared by every job, while each
+worker thread gets its own recommender objects since they keep the
+last run's tracks on the object.
+'''
+class BatchRunner():
+    '''
+    Name: __init__
+    Parameters: workers=4
+    Returns: None
+    Purpose: Loads the credentials and shared clients. The Spotify and
+    YouTube APIs are only created if a job exports to them.
+    '''
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.lastfm_key = LastFMAuth().get_credentials()
+        self.open_weather_key = WeatherAPI().get_credentials()
+        # nobody is there to paste a login redirect URL
+        self.spotify_auth = SpotifyAuth(interactive=False)
+        self.sp = get_spotify_client(self.spotify_auth)
+        get_lastfm_client(self.lastfm_key).warm_up()
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # googleapiclient's http object isn't thread safe
+        self.youtube_lock = threading.Lock()
+        self._spotify_api = None
+        self._youtube_api = None
+
+    '''
+    Name: recommender
+    Parameters: kind
+    Returns: recommender
+    Purpose: Returns this worker thread's recommender of the given kind.
+    '''
+    def recommender(self, kind):
+        from Recommendations import GenreRecs, SeasonRecs, UserRecs, WeatherRecs
+
+        recommenders = getattr(self.local, "recommenders", None)
+        if recommenders is None:
+            recommenders = self.local.recommenders = {}
+        if kind not in recommenders:
+            if kind == "genre":
+                recommenders[kind] = GenreRecs(self.lastfm_key, None, self.spotify_auth, self.sp)
+            elif kind == "user":
+                recommenders[kind] = UserRecs(self.lastfm_key, None, self.spotify_auth, self.sp)
+            elif kind == "season":
+                recommenders[kind] = SeasonRecs(self.lastfm_key, None, self.spotify_auth, self.sp)
+            else:
+                recommenders[kind] = WeatherRecs(self.open_weather_key, self.lastfm_key,
+                                                 self.spotify_auth, self.sp)
+        return recommenders[kind]
+
+    '''
+    Name: spotify_api
+    Parameters: None
+    Returns: self._spotify_api
+    Purpose: Creates the SpotifyAPI on first use.
+    '''
+    def spotify_api(self):
+        with self.lock:
+            if self._spotify_api is None:
+                from APIs import SpotifyAPI
+                self._spotify_api = SpotifyAPI(self.sp)
+            return self._spotify_api
+
+    '''
+    Name: youtube_api
+    Parameters: None
+    Returns: self._youtube_api
+    Purpose: Creates the YoutubeAPI on first use. Nobody is there to
+    log in through a browser, so it fails with YouTubeAuthError
+    instead if the saved credentials can't be refreshed.
+    '''
+    def youtube_api(self):
+        with self.lock:
+            if self._youtube_api is None:
+                from APIs import YoutubeAPI
+                self._youtube_api = YoutubeAPI(interactive=False)
+            return self._youtube_api
+
+    '''
+    Name: recommend
+    Parameters: job
+    Returns: recs, uris, playlist_name, track_info
+    Purpose: Runs the recommender the job asks for with its settings.
+    '''
+    def recommend(self, job):
+        kind = str(job.get("type", "")).lower()
+        if kind not in RECOMMENDERS:
+            raise JobError(f"unknown type {job.get('type')!r}, expected one of {RECOMMENDERS}")
+
+        recommender = self.recommender(kind)
+        if kind == "genre":
+            if not job.get("genre"):
+                raise JobError("genre jobs need a genre")
+            recs, uris, playlist_name = recommender.rec_algorithm(job["genre"], int(job.get("limit", 30)))
+        elif kind == "user":
+            recs, uris, playlist_name = recommender.rec_algorithm(
+                job.get("time_range", "medium_term"), int(job.get("top_artist_limit", 10)),
+                scoring=job.get("scoring", "rank"))
+        else:
+            recs, uris, playlist_name = recommender.rec_algorithm(None, None)
+
+        return recs, uris, job.get("playlist_name") or playlist_name, recommender.track_info
+
+    '''
+    Name: export
+    Parameters: target, playlist_name, uris, track_info
+    Returns: exported
+    Purpose: Adds the tracks to a Spotify and/or YouTube playlist.
+    '''
+    def export(self, target, playlist_name, uris, track_info):
+        exported = {}
+        uris = [uri for uri in uris if uri]
+        if not uris:
+            return exported
+
+        spotify_api = self.spotify_api() if target is not None else None
+        if target in ("spotify", "both"):
+            playlist = spotify_api.add_to_playlist(playlist_name, uris, sync=True)
+            exported["spotify"] = playlist["external_urls"]["spotify"]
+        if target in ("youtube", "both"):
+            youtube_api = self.youtube_api()
+            with self.youtube_lock:
+                video_ids = youtube_api.uris_to_ids(spotify_api, uris, track_info)
+                exported["youtube"] = youtube_api.add_to_playlist(playlist_name, video_ids, summary=True)
+        return exported
+
+    '''
+    Name: run_job
+    Parameters: job
+    Returns: result
+    Purpose: Runs one job in the batch rate limit lane and returns its
+    result record. Any error is caught and recorded so the rest of the
+    batch carries on.
+    '''
+    def run_job(self, job):
+        started = time.time()
+        result = {"id": job.get("id"), "type": job.get("type")}
+        try:
+            target = job.get("export")
+            if target not in EXPORTS:
+                raise JobError(f"unknown export {target!r}, expected one of {EXPORTS}")
+
+            with lane("batch"), get_metrics().span("job"):
+                recs, uris, playlist_name, track_info = self.recommend(job)
+                result.update({
+                    "ok": True,
+                    "playlist_name": playlist_name,
+                    "tracks": recs,
+                    "uris": uris,
+                })
+                if target:
+                    result["export"] = self.export(target, playlist_name, uris, track_info)
+        except Exception as e:
+            result.update({"ok": False, "error": f"{type(e).__name__}: {e}"})
+            if not isinstance(e, JobError):
+                result["traceback"] = traceback.format_exc()
+        result["seconds"] = round(time.time() - started, 3)
+        return result
+
+    '''
+    Name: run
+    Parameters: jobs, output
+    Returns: summary
+    Purpose: Runs the jobs on the worker pool and writes each result to
+    output as a JSON line as soon as that job finishes.
+    '''
+    def run(self, jobs, output):
+        summary = {"jobs": 0, "ok": 0, "failed": 0}
+
+        def write(result):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            summary["jobs"] += 1
+            summary["ok" if result["ok"] else "failed"] += 1
+            status = "done" if result["ok"] else f"failed ({result['error']})"
+            print(f"[INFO] Job {result['id']} {status} in {result['seconds']}s", file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as executor:
+            futures = []
+            for number, job in jobs:
+                if isinstance(job, Exception):
+                    write({"id": str(number), "ok": False, "error": str(job), "seconds": 0})
+                    continue
+                futures.append(executor.submit(contextvars.copy_context().run, self.run_job, job))
+
+            for future in as_completed(futures):
+                write(future.result())
+
+        summary["rate_limits"] = get_rate_limiter().stats()
+        return summary
+
+'''
+Name: main
+Parameters: argv=None
+Returns: None
+Purpose: Command line entry point for batch mode, e.g.
+"python Batch.py jobs.jsonl -o results.jsonl --workers 4". Each job
+line looks like {"id": "1", "type": "genre", "genre": "rock",
+"limit": 30, "export": "spotify"}.
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run song recommendation jobs from a JSONL file.")
+    parser.add_argument("jobs", help="JSONL file of jobs, or - for stdin")
+    # the recommenders print as they go, so results go to a file by default
+    parser.add_argument("-o", "--output", default="batch_results.jsonl",
+                        help="JSONL file to append results to, or - for stdout")
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("--metrics", help="write metrics here when done (.json for JSON, else Prometheus text)")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.jobs == "-":
+        jobs = read_jobs(sys.stdin)
+    else:
+        with open(args.jobs, encoding="utf-8") as f:
+            jobs = read_jobs(f)
+
+    results = sys.stdout
+    # with results on stdout everything the recommenders print goes to
+    # stderr instead, so stdout stays valid JSONL
+    quiet = contextlib.redirect_stdout(sys.stderr) if args.output == "-" else contextlib.nullcontext()
+    with quiet:
+        runner = BatchRunner(workers=args.workers)
+        profiler = profiler_from_args(args)
+        if profiler is not None:
+            profiler.start()
+        try:
+            if args.output == "-":
+                summary = runner.run(jobs, results)
+            else:
+                with open(args.output, "a", encoding="utf-8") as output:
+                    summary = runner.run(jobs, output)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                # stdout may be the results, so the report goes to stderr
+                profiler.print_report(file=sys.stderr)
+
+    if args.metrics:
+        get_metrics().write(args.metrics)
+    print(f"[INFO] {summary['ok']}/{summary['jobs']} jobs succeeded", file=sys.stderr)
+    if summary["failed"]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+# Import Libraries
+import argparse, json, math, os, random, subprocess, sys, tempfile, time
+
+# Import Files
+from Replay import StandIns
+
+SCENARIOS = ("genre", "user", "season", "weather", "uris_to_ids", "add_to_playlist")
+# kept outside the cassette directory, which holds real API responses
+# and is gitignored, so a recorded baseline can be committed
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "baseline.json")
+URIS_FILE = "uris.json"
+
+DEFAULT_SETTINGS = {
+    "genre": "rock",
+    "limit": 30,
+    "time_range": "medium_term",
+    "top_artist_limit": 10,
+    # every YouTube search costs 100 quota units when recording
+    "youtube_tracks": 10,
+    "playlist_name": "Benchmark Playlist",
+    "seed": 1,
+}
+
+# how much slower or bigger a run can be before it counts as a regression
+TIME_TOLERANCE = 0.25
+TIME_FLOOR = 0.05
+BYTES_TOLERANCE = 0.10
+
+'''
+Name: percentile
+Parameters: values, percent
+Returns: value
+Purpose: Nearest-rank percentile of a list of numbers.
+'''
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = max(0, math.ceil(percent / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+'''
+Name: run_scenario
+Parameters: scenario, settings
+Returns: result
+Purpose: Runs one scenario in this process and times it. Auth and
+client setup happen before the clock starts. This is run in a fresh
+child process for every repeat so no in-memory cache carries over.
+'''
+def run_scenario(scenario, settings):
+    from Auths import LastFMAuth, SpotifyAuth, WeatherAPI
+    from Clients import get_spotify_client
+
+    random.seed(settings["seed"])
+    lastfm_key = LastFMAuth().get_credentials()
+    # scenarios run in child processes, where nobody can answer a login prompt
+    spotify_auth = SpotifyAuth(interactive=False)
+    sp = get_spotify_client(spotify_auth)
+
+    if scenario in ("uris_to_ids", "add_to_playlist"):
+        from APIs import SpotifyAPI
+
+        with open(settings["uris_file"], encoding="utf-8") as f:
+            uris = json.load(f)
+        spotify_api = SpotifyAPI(sp)
+        if scenario == "uris_to_ids":
+            from APIs import YoutubeAPI
+
+            youtube_api = YoutubeAPI(interactive=False)
+            uris = uris[:settings["youtube_tracks"]]
+            started = time.perf_counter()
+            video_ids = youtube_api.uris_to_ids(spotify_api, uris)
+            return {"seconds": time.perf_counter() - started, "items": len([v for v in video_ids if v])}
+
+        started = time.perf_counter()
+        spotify_api.add_to_playlist(settings["playlist_name"], uris, sync=True)
+        return {"seconds": time.perf_counter() - started, "items": len(uris)}
+
+    from Recommendations import GenreRecs, SeasonRecs, UserRecs, WeatherRecs
+
+    if scenario == "genre":
+        recommender = GenreRecs(lastfm_key, None, spotify_auth, sp)
+        args = (settings["genre"], settings["limit"])
+    elif scenario == "user":
+        recommender = UserRecs(lastfm_key, None, spotify_auth, sp)
+        args = (settings["time_range"], settings["top_artist_limit"])
+    elif scenario == "season":
+        recommender = SeasonRecs(lastfm_key, None, spotify_auth, sp)
+        args = (None, None)
+    else:
+        recommender = WeatherRecs(WeatherAPI().get_credentials(), lastfm_key, spotify_auth, sp)
+        args = (None, None)
+
+    started = time.perf_counter()
+    _, uris, _ = recommender.rec_algorithm(*args)
+    seconds = time.perf_counter() - started
+
+    # the genre run's tracks are what the export scenarios replay
+    if scenario == "genre" and settings.get("save_uris"):
+        with open(settings["uris_file"], "w", encoding="utf-8") as f:
+            json.dump([uri for uri in uris if uri], f)
+    return {"seconds": seconds, "items": len(uris)}
+
+'''
+Name: Benchmark
+Purpose: Runs scenarios against the Replay.py stand-in servers and
+collects wall time, calls per provider/endpoint and bytes transferred
+for each one, then compares them with a stored baseline.
+'''
+class Benchmark():
+    '''
+    Name: __init__
+    Parameters: cassette_dir, settings=None, verbose=False, baseline_file=BASELINE_FILE
+    Returns: None
+    Purpose: Keeps the cassette directory, scenario settings and where
+    the baseline is stored.
+    '''
+    def __init__(self, cassette_dir, settings=None, verbose=False, baseline_file=BASELINE_FILE):
+        self.cassette_dir = cassette_dir
+        self.baseline_file = baseline_file
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.settings["uris_file"] = os.path.join(cassette_dir, URIS_FILE)
+        self.verbose = verbose
+
+    '''
+    Name: _run_child
+    Parameters: stand_ins, scenario, settings
+    Returns: result or None
+    Purpose: Runs a scenario in a child process pointed at the stand-in
+    servers, with empty cache and artist graph files.
+    '''
+    def _run_child(self, stand_ins, scenario, settings):
+        with tempfile.TemporaryDirectory(prefix="songrec-bench-") as scratch:
+            result_file = os.path.join(scratch, "result.json")
+            env = dict(os.environ, **stand_ins.environ(),
+                       SONGREC_CACHE_FILE=os.path.join(scratch, "songrec_cache.db"),
+                       ARTIST_GRAPH_FILE=os.path.join(scratch, "artist_graph.npz"))
+            output = None if self.verbose else subprocess.DEVNULL
+            code = subprocess.call(
+                [sys.executable, os.path.abspath(__file__), "_child", scenario, json.dumps(settings), result_file],
+                env=env, stdout=output, stderr=output)
+            if code != 0 or not os.path.exists(result_file):
+                print(f"[ERROR] Scenario {scenario} failed with exit code {code}")
+                return None
+            with open(result_file, encoding="utf-8") as f:
+                return json.load(f)
+
+    '''
+    Name: record
+    Parameters: scenarios=SCENARIOS
+    Returns: None
+    Purpose: Runs every scenario once against the real APIs through
+    recording stand-ins. The genre scenario runs first because its
+    tracks are saved for the export scenarios. Note that this really
+    adds tracks to a Spotify playlist and uses YouTube search quota.
+    '''
+    def record(self, scenarios=SCENARIOS):
+        os.makedirs(self.cassette_dir, exist_ok=True)
+        settings = dict(self.settings, save_uris=True)
+        ordered = sorted(scenarios, key=lambda name: name != "genre")
+        with StandIns(self.cassette_dir, "record") as stand_ins:
+            for scenario in ordered:
+                print(f"[INFO] Recording {scenario}")
+                self._run_child(stand_ins, scenario, settings)
+            print(json.dumps(stand_ins.stats(), indent=1))
+
+    '''
+    Name: run
+    Parameters: scenarios=SCENARIOS, repeat=5, latency=0.05, jitter=0.01
+    Returns: report
+    Purpose: Replays each scenario repeat times with the given latency
+    on every external call and summarises the runs.
+    '''
+    def run(self, scenarios=SCENARIOS, repeat=5, latency=0.05, jitter=0.01):
+        report = {"settings": {"repeat": repeat, "latency": latency, "jitter": jitter},
+                  "scenarios": {}}
+        with StandIns(self.cassette_dir, "replay", latency=latency, jitter=jitter,
+                      seed=self.settings["seed"]) as stand_ins:
+            for scenario in scenarios:
+                runs = []
+                for _ in range(repeat):
+                    stand_ins.reset()
+                    result = self._run_child(stand_ins, scenario, self.settings)
+                    if result is None:
+                        break
+                    runs.append((result, stand_ins.stats()))
+                report["scenarios"][scenario] = self._summarise(runs, repeat)
+        return report
+
+    '''
+    Name: _summarise
+    Parameters: runs, repeat
+    Returns: summary
+    Purpose: Turns a scenario's runs into wall time percentiles and the
+    highest call and byte counts seen in any run.
+    '''
+    def _summarise(self, runs, repeat):
+        if len(runs) < repeat:
+            return {"ok": False, "runs": len(runs)}
+
+        seconds = [result["seconds"] for result, _ in runs]
+        calls = {}
+        sent = received = misses = 0
+        for _, stats in runs:
+            for provider, counts in stats.items():
+                for endpoint, count in counts["endpoints"].items():
+                    name = f"{provider} {endpoint}"
+                    calls[name] = max(calls.get(name, 0), count)
+            sent = max(sent, sum(counts["bytes_sent"] for counts in stats.values()))
+            received = max(received, sum(counts["bytes_received"] for counts in stats.values()))
+            misses = max(misses, sum(counts["misses"] for counts in stats.values()))
+
+        return {
+            "ok": True,
+            "runs": len(runs),
+            "items": runs[0][0]["items"],
+            "wall": {
+                "p50": round(percentile(seconds, 50), 4),
+                "p95": round(percentile(seconds, 95), 4),
+                "mean": round(sum(seconds) / len(seconds), 4),
+                "min": round(min(seconds), 4),
+                "max": round(max(seconds), 4),
+            },
+            "calls": dict(sorted(calls.items())),
+            "total_calls": sum(calls.values()),
+            "bytes": {"sent": sent, "received": received},
+            "misses": misses,
+        }
+
+    '''
+    Name: baseline_path
+    Parameters: None
+    Returns: path
+    Purpose: Returns where the baseline is stored.
+    '''
+    def baseline_path(self):
+        return self.baseline_file
+
+    '''
+    Name: save_baseline
+    Parameters: report
+    Returns: None
+    Purpose: Stores a report's scenarios as the baseline for future
+    runs. Scenarios that weren't run keep their stored baseline.
+    '''
+    def save_baseline(self, report):
+        baseline = self.load_baseline() or {"scenarios": {}}
+        baseline = dict(report, scenarios=dict(baseline["scenarios"], **report["scenarios"]))
+        os.makedirs(os.path.dirname(self.baseline_path()) or ".", exist_ok=True)
+        with open(self.baseline_path(), "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=1)
+
+    '''
+    Name: load_baseline
+    Parameters: None
+    Returns: baseline or None
+    Purpose: Loads the stored baseline if there is one.
+    '''
+    def load_baseline(self):
+        if not os.path.exists(self.baseline_path()):
+            return None
+        with open(self.baseline_path(), encoding="utf-8") as f:
+            return json.load(f)
+
+'''
+Name: compare
+Parameters: report, baseline, time_tolerance=TIME_TOLERANCE, bytes_tolerance=BYTES_TOLERANCE
+Returns: regressions
+Purpose: Lists everything in report that is worse than the baseline.
+Any extra external call is a regression, since replayed runs make the
+same calls every time. Wall time and bytes are allowed some slack.
+'''
+def compare(report, baseline, time_tolerance=TIME_TOLERANCE, bytes_tolerance=BYTES_TOLERANCE):
+    regressions = []
+    for scenario, current in report["scenarios"].items():
+        previous = baseline["scenarios"].get(scenario)
+        if not current["ok"]:
+            regressions.append(f"{scenario}: failed")
+            continue
+        if previous is None or not previous["ok"]:
+            continue
+
+        for endpoint, count in current["calls"].items():
+            before = previous["calls"].get(endpoint, 0)
+            if count > before:
+                regressions.append(f"{scenario}: {endpoint} called {count} times, baseline {before}")
+
+        p50, before = current["wall"]["p50"], previous["wall"]["p50"]
+        if p50 > before * (1 + time_tolerance) and p50 - before > TIME_FLOOR:
+            regressions.append(f"{scenario}: p50 {p50:.3f}s, baseline {before:.3f}s")
+
+        for direction in ("sent", "received"):
+            size, before = current["bytes"][direction], previous["bytes"][direction]
+            if size > before * (1 + bytes_tolerance):
+                regressions.append(f"{scenario}: {size} bytes {direction}, baseline {before}")
+    return regressions
+
+'''
+Name: missing_from
+Parameters: report, baseline
+Returns: missing
+Purpose: Lists the scenarios in report that compare can't check
+because the baseline has no passing run of them.
+'''
+def missing_from(report, baseline):
+    missing = []
+    for scenario in report["scenarios"]:
+        previous = baseline["scenarios"].get(scenario)
+        if previous is None or not previous["ok"]:
+            missing.append(scenario)
+    return missing
+
+'''
+Name: print_report
+Parameters: report
+Returns: None
+Purpose: Prints a short summary of each scenario.
+'''
+def print_report(report):
+    for scenario, summary in report["scenarios"].items():
+        if not summary["ok"]:
+            print(f"{scenario:<16} FAILED after {summary['runs']} runs")
+            continue
+        wall = summary["wall"]
+        print(f"{scenario:<16} p50 {wall['p50']:.3f}s  p95 {wall['p95']:.3f}s  "
+              f"calls {summary['total_calls']:<5} sent {summary['bytes']['sent']:<9} "
+              f"items {summary['items']}")
+        for endpoint, count in summary["calls"].items():
+            print(f"    {count:>5}  {endpoint}")
+        if summary["misses"]:
+            print(f"[WARNING] {scenario}: {summary['misses']} requests weren't in the cassette")
+
+'''
+Name: main
+Parameters: argv=None
+Returns: None
+Purpose: Command line entry point, e.g.
+"python Benchmarks.py record cassettes/bench" once with real
+credentials, then "python Benchmarks.py run cassettes/bench" offline.
+Exits with 1 if any scenario regressed against the baseline. A
+scenario with no baseline isn't a regression: it is reported as
+NO BASELINE, and only fails the run (exit 2) with --require-baseline.
+'''
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] == "_child":
+        scenario, settings, result_file = argv[1], json.loads(argv[2]), argv[3]
+        result = run_scenario(scenario, settings)
+        with open(result_file, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the recommenders against recorded API responses.")
+    parser.add_argument("command", choices=("record", "run"))
+    parser.add_argument("cassette_dir")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--genre", default=DEFAULT_SETTINGS["genre"])
+    parser.add_argument("--seed", type=int, default=DEFAULT_SETTINGS["seed"])
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help="baseline JSON file to compare with or save to (default benchmarks/baseline.json)")
+    parser.add_argument("--require-baseline", action="store_true",
+                        help="exit with 2 if any scenario has no baseline to compare with")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the scenarios' own output")
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.cassette_dir, {"genre": args.genre, "seed": args.seed},
+                          verbose=args.verbose, baseline_file=args.baseline)
+    if args.command == "record":
+        benchmark.record(args.scenarios)
+        return
+
+    report = benchmark.run(args.scenarios, args.repeat, args.latency, args.jitter)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    if args.save_baseline:
+        benchmark.save_baseline(report)
+        print(f"[INFO] Saved baseline to {benchmark.baseline_path()}")
+        return
+
+    baseline = benchmark.load_baseline() or {"scenarios": {}}
+    regressions = compare(report, baseline)
+    missing = missing_from(report, baseline)
+    for regression in regressions:
+        print(f"[ERROR] REGRESSION {regression}")
+    for scenario in missing:
+        print(f"[WARNING] NO BASELINE for {scenario} in {benchmark.baseline_path()}, "
+              "run it with --save-baseline to store one")
+    if regressions:
+        sys.exit(1)
+    if missing and args.require_baseline:
+        sys.exit(2)
+    if missing:
+        print(f"[INFO] No regressions, but {len(missing)} of {len(report['scenarios'])} scenarios weren't compared")
+    else:
+        print("[INFO] No regressions against the baseline")
+
+if __name__ == '__main__':
+    main()
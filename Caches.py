@@ -0,0 +1,849 @@
+# Import Libraries
+import argparse, asyncio, contextvars, functools, inspect, json, os, sqlite3, threading, time, zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import urlencode
+
+# Import Files
+from Metrics import get_metrics
+
+CACHE_FILE = os.getenv("SONGREC_CACHE_FILE", "songrec_cache.db")
+
+DAY = 24 * 60 * 60
+
+# method: (ttl, stale window) in seconds. Within the stale window an
+# expired entry is still served while it is refreshed in the background.
+METHOD_TTLS = {
+    "tag.getsimilar": (7 * DAY, 7 * DAY),
+    "tag.gettoptracks": (1 * DAY, 3 * DAY),
+    "tag.getinfo": (7 * DAY, 7 * DAY),
+    "tag.search": (7 * DAY, 7 * DAY),
+    "artist.getsimilar": (7 * DAY, 7 * DAY),
+    "spotify.artist_top_tracks": (1 * DAY, 0),
+    "spotify.track": (90 * DAY, 0),
+}
+DEFAULT_TTL = (1 * DAY, 1 * DAY)
+
+# a found URI rarely changes, a miss is retried sooner in case the
+# track is added to Spotify or the search improves
+URI_TTL = 90 * DAY
+NO_MATCH_TTL = 3 * DAY
+ARTIST_ID_TTL = 180 * DAY
+# every YouTube search costs 100 quota units, so misses are kept longer too
+VIDEO_ID_TTL = 180 * DAY
+VIDEO_NO_MATCH_TTL = 14 * DAY
+
+# how a track was searched for: "strict" uses track:/artist: filters
+# and "loose" is free text, which can match where a strict search missed
+QUERY_STYLES = ("strict", "loose")
+
+'''
+Name: ResponseCache
+Purpose: An on-disk SQLite cache of API responses keyed on the
+method and its normalised params. Payloads are stored as zlib
+compressed JSON and every method has its own TTL.
+'''
+class ResponseCache():
+    '''
+    Name: __init__
+    Parameters: path=CACHE_FILE, ttls=None
+    Returns: None
+    Purpose: Opens (or creates) the cache database and table.
+    '''
+    def __init__(self, path=CACHE_FILE, ttls=None):
+        self.path = path
+        self.ttls = dict(METHOD_TTLS if ttls is None else ttls)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                method TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                stale_until REAL NOT NULL,
+                payload BLOB NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_method ON responses (method)")
+        self.conn.commit()
+
+    '''
+    Name: make_key
+    Parameters: method, params
+    Returns: key
+    Purpose: Builds the cache key from the lower-cased method and its
+    params sorted and normalised, so "Rock" and "rock " share an entry.
+    '''
+    @staticmethod
+    def make_key(method, params):
+        normalised = []
+        for name, value in sorted(params.items()):
+            if isinstance(value, str):
+                value = " ".join(value.lower().split())
+            normalised.append((name, value))
+        return f"{method.lower()}?{urlencode(normalised)}"
+
+    '''
+    Name: get
+    Parameters: method, params
+    Returns: data, state
+    Purpose: Looks up a response. state is "fresh", "stale" (expired
+    but still inside its stale window) or None on a miss.
+    '''
+    def get(self, method, params):
+        key = self.make_key(method, params)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT expires_at, stale_until, payload FROM responses WHERE key = ?",
+                (key,)).fetchone()
+        metrics = get_metrics()
+        if row is None:
+            metrics.inc("songrec_cache_lookups_total", cache="responses", result="miss")
+            return None, None
+
+        expires_at, stale_until, payload = row
+        now = time.time()
+        if now > stale_until:
+            metrics.inc("songrec_cache_lookups_total", cache="responses", result="miss")
+            return None, None
+
+        data = json.loads(zlib.decompress(payload))
+        state = "fresh" if now <= expires_at else "stale"
+        metrics.inc("songrec_cache_lookups_total", cache="responses", result=state)
+        return data, state
+
+    '''
+    Name: set
+    Parameters: method, params, data
+    Returns: None
+    Purpose: Stores a response using the TTL for its method.
+    '''
+    def set(self, method, params, data):
+        ttl, stale = self.ttls.get(method.lower(), DEFAULT_TTL)
+        now = time.time()
+        payload = zlib.compress(json.dumps(data).encode("utf-8"))
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (self.make_key(method, params), method.lower(), now, now + ttl,
+                 now + ttl + stale, payload))
+            self.conn.commit()
+
+    '''
+    Name: purge
+    Parameters: method=None, expired_only=False
+    Returns: count
+    Purpose: Deletes cached responses, optionally only for one
+    method or only those past their stale window.
+    '''
+    def purge(self, method=None, expired_only=False):
+        sql = "DELETE FROM responses WHERE 1 = 1"
+        args = []
+        if method:
+            sql += " AND method = ?"
+            args.append(method.lower())
+        if expired_only:
+            sql += " AND stale_until < ?"
+            args.append(time.time())
+        with self.lock:
+            count = self.conn.execute(sql, args).rowcount
+            self.conn.commit()
+        return count
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns entry counts, stored bytes and how many entries
+    are fresh, stale or expired for every cached method.
+    '''
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT method, COUNT(*), SUM(LENGTH(payload)),
+                       SUM(expires_at >= ?),
+                       SUM(expires_at < ? AND stale_until >= ?),
+                       SUM(stale_until < ?)
+                FROM responses GROUP BY method ORDER BY method""",
+                (now, now, now, now)).fetchall()
+        return {
+            method: {"entries": count, "bytes": size, "fresh": fresh,
+                     "stale": stale, "expired": expired}
+            for method, count, size, fresh, stale, expired in rows
+        }
+
+    '''
+    Name: entries
+    Parameters: method=None, limit=50
+    Returns: entries
+    Purpose: Lists the most recently fetched cache keys with their ages.
+    '''
+    def entries(self, method=None, limit=50):
+        sql = "SELECT key, fetched_at, expires_at, LENGTH(payload) FROM responses"
+        args = []
+        if method:
+            sql += " WHERE method = ?"
+            args.append(method.lower())
+        sql += " ORDER BY fetched_at DESC LIMIT ?"
+        args.append(limit)
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+'''
+Name: normalise
+Parameters: text
+Returns: text lower-cased with whitespace collapsed
+Purpose: Normalises track and artist names before they are used as keys.
+'''
+def normalise(text):
+    return " ".join(str(text or "").casefold().split())
+
+'''
+Name: ResolutionCache
+Purpose: A durable map of normalised (title, artist) pairs to Spotify
+track URIs shared by every recommender, kept per query style so a
+strict search's miss doesn't hide what a loose search would find.
+Misses are cached too, with a shorter TTL, and hit/miss counters show
+how effective it is.
+'''
+class ResolutionCache():
+    '''
+    Name: __init__
+    Parameters: path=CACHE_FILE, ttl=URI_TTL, no_match_ttl=NO_MATCH_TTL
+    Returns: None
+    Purpose: Opens (or creates) the resolution table and resets the counters.
+    '''
+    def __init__(self, path=CACHE_FILE, ttl=URI_TTL, no_match_ttl=NO_MATCH_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.no_match_ttl = no_match_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(track_uris)")]
+        if columns and "style" not in columns:
+            self.conn.execute("ALTER TABLE track_uris RENAME TO track_uris_old")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS track_uris (
+                title TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                style TEXT NOT NULL,
+                uri TEXT,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (title, artist, style)
+            )""")
+        if columns and "style" not in columns:
+            # a match is good for either style, but an old miss can't
+            # say which search missed so those are dropped
+            for style in QUERY_STYLES:
+                self.conn.execute("""
+                    INSERT INTO track_uris SELECT title, artist, ?, uri, expires_at
+                    FROM track_uris_old WHERE uri IS NOT NULL""", (style,))
+            self.conn.execute("DROP TABLE track_uris_old")
+        self.conn.commit()
+
+    '''
+    Name: get
+    Parameters: title, artist, style="strict"
+    Returns: uri, found
+    Purpose: Looks up a track searched for in the given query style.
+    found is False on a miss; when found is True, uri is None if
+    Spotify previously had no match.
+    '''
+    def get(self, title, artist, style="strict"):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT uri, expires_at FROM track_uris WHERE title = ? AND artist = ? AND style = ?",
+                (normalise(title), normalise(artist), style)).fetchone()
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                result = "miss"
+            elif row[0] is None:
+                self.negative_hits += 1
+                result = "negative_hit"
+            else:
+                self.hits += 1
+                result = "hit"
+        get_metrics().inc("songrec_cache_lookups_total", cache="track_uris", result=result)
+        if result == "miss":
+            return None, False
+        return row[0], True
+
+    '''
+    Name: set
+    Parameters: title, artist, uri, style="strict"
+    Returns: None
+    Purpose: Stores a resolved URI, or None for "no match" which
+    expires sooner, for the query style that was searched.
+    '''
+    def set(self, title, artist, uri, style="strict"):
+        ttl = self.ttl if uri else self.no_match_ttl
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO track_uris VALUES (?, ?, ?, ?, ?)",
+                (normalise(title), normalise(artist), style, uri, time.time() + ttl))
+            self.conn.commit()
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns this process's hit/miss counters and the number
+    of stored matches and no-matches.
+    '''
+    def stats(self):
+        with self.lock:
+            matches, no_matches = self.conn.execute(
+                "SELECT COUNT(uri), COUNT(*) - COUNT(uri) FROM track_uris").fetchone()
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+                "stored_matches": matches,
+                "stored_no_matches": no_matches,
+            }
+
+    '''
+    Name: purge
+    Parameters: expired_only=False
+    Returns: count
+    Purpose: Deletes stored resolutions, optionally only expired ones.
+    '''
+    def purge(self, expired_only=False):
+        sql = "DELETE FROM track_uris"
+        args = []
+        if expired_only:
+            sql += " WHERE expires_at < ?"
+            args.append(time.time())
+        with self.lock:
+            count = self.conn.execute(sql, args).rowcount
+            self.conn.commit()
+        return count
+
+'''
+Name: ArtistIdCache
+Purpose: A durable map of normalised artist names to Spotify artist
+IDs, so UserRecs only has to search for an artist once. Names with no
+match are cached for a shorter time.
+'''
+class ArtistIdCache():
+    '''
+    Name: __init__
+    Parameters: path=CACHE_FILE, ttl=ARTIST_ID_TTL, no_match_ttl=NO_MATCH_TTL
+    Returns: None
+    Purpose: Opens (or creates) the artist ID table and resets the counters.
+    '''
+    def __init__(self, path=CACHE_FILE, ttl=ARTIST_ID_TTL, no_match_ttl=NO_MATCH_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.no_match_ttl = no_match_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS artist_ids (
+                name TEXT PRIMARY KEY,
+                artist_id TEXT,
+                expires_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    '''
+    Name: get
+    Parameters: name
+    Returns: artist_id, found
+    Purpose: Looks up an artist. found is False on a miss; when found
+    is True, artist_id is None if Spotify previously had no match.
+    '''
+    def get(self, name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT artist_id, expires_at FROM artist_ids WHERE name = ?",
+                (normalise(name),)).fetchone()
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                get_metrics().inc("songrec_cache_lookups_total", cache="artist_ids", result="miss")
+                return None, False
+            self.hits += 1
+        get_metrics().inc("songrec_cache_lookups_total", cache="artist_ids", result="hit")
+        return row[0], True
+
+    '''
+    Name: set
+    Parameters: name, artist_id
+    Returns: None
+    Purpose: Stores an artist ID, or None for "no match".
+    '''
+    def set(self, name, artist_id):
+        ttl = self.ttl if artist_id else self.no_match_ttl
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO artist_ids VALUES (?, ?, ?)",
+                (normalise(name), artist_id, time.time() + ttl))
+            self.conn.commit()
+
+'''
+Name: VideoIdCache
+Purpose: A durable map of Spotify track URIs to YouTube video IDs, so
+a track only has to be searched for on YouTube once. URIs with no
+matching video are stored as well, so they aren't searched again
+on every export.
+'''
+class VideoIdCache():
+    '''
+    Name: __init__
+    Parameters: path=CACHE_FILE, ttl=VIDEO_ID_TTL, no_match_ttl=VIDEO_NO_MATCH_TTL
+    Returns: None
+    Purpose: Opens (or creates) the video ID table and resets the counters.
+    '''
+    def __init__(self, path=CACHE_FILE, ttl=VIDEO_ID_TTL, no_match_ttl=VIDEO_NO_MATCH_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.no_match_ttl = no_match_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS video_ids (
+                uri TEXT PRIMARY KEY,
+                video_id TEXT,
+                expires_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    '''
+    Name: get
+    Parameters: uri
+    Returns: video_id, found
+    Purpose: Looks up a track. found is False on a miss; when found is
+    True, video_id is None if YouTube previously had no match.
+    '''
+    def get(self, uri):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT video_id, expires_at FROM video_ids WHERE uri = ?", (uri,)).fetchone()
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                result = "miss"
+            elif row[0] is None:
+                self.negative_hits += 1
+                result = "negative_hit"
+            else:
+                self.hits += 1
+                result = "hit"
+        get_metrics().inc("songrec_cache_lookups_total", cache="video_ids", result=result)
+        if result == "miss":
+            return None, False
+        return row[0], True
+
+    '''
+    Name: set
+    Parameters: uri, video_id
+    Returns: None
+    Purpose: Stores a video ID, or None for "no match".
+    '''
+    def set(self, uri, video_id):
+        ttl = self.ttl if video_id else self.no_match_ttl
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO video_ids VALUES (?, ?, ?)",
+                (uri, video_id, time.time() + ttl))
+            self.conn.commit()
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns this process's hit/miss counters and the number
+    of stored matches and no-matches.
+    '''
+    def stats(self):
+        with self.lock:
+            matches, no_matches = self.conn.execute(
+                "SELECT COUNT(video_id), COUNT(*) - COUNT(video_id) FROM video_ids").fetchone()
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+                "stored_matches": matches,
+                "stored_no_matches": no_matches,
+            }
+
+    '''
+    Name: purge
+    Parameters: expired_only=False
+    Returns: count
+    Purpose: Deletes stored video IDs, optionally only expired ones.
+    '''
+    def purge(self, expired_only=False):
+        sql = "DELETE FROM video_ids"
+        args = []
+        if expired_only:
+            sql += " WHERE expires_at < ?"
+            args.append(time.time())
+        with self.lock:
+            count = self.conn.execute(sql, args).rowcount
+            self.conn.commit()
+        return count
+
+'''
+Name: LRUCache
+Purpose: A small thread-safe in-memory cache that drops the least
+recently used entry once it holds maxsize entries.
+'''
+class LRUCache():
+    '''
+    Name: __init__
+    Parameters: maxsize=1024, name=None
+    Returns: None
+    Purpose: Creates the empty cache. Lookups are counted in the
+    metrics under name if one is given.
+    '''
+    def __init__(self, maxsize=1024, name=None):
+        self.maxsize = maxsize
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    '''
+    Name: get
+    Parameters: key
+    Returns: value or None
+    Purpose: Returns the value for key and marks it as recently used.
+    '''
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+        if self.name is not None:
+            get_metrics().inc("songrec_cache_lookups_total", cache=self.name,
+                              result="miss" if value is None else "hit")
+        return value
+
+    '''
+    Name: set
+    Parameters: key, value
+    Returns: None
+    Purpose: Stores a value, dropping the oldest entry if full.
+    '''
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+'''
+Name: RunMemo
+Purpose: Remembers every external fetch made during one
+recommendation run so each distinct request is only made once. If a
+second caller asks for a request that is still in flight it waits for
+the first one instead of sending its own (single-flight).
+'''
+class RunMemo():
+    '''
+    Name: __init__
+    Parameters: None
+    Returns: None
+    Purpose: Initialises the empty memo and its counters.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.async_results = {}
+        self.calls = 0
+        self.absorbed = 0
+
+    '''
+    Name: call
+    Parameters: key, fn, *args, **kwargs
+    Returns: fn(*args, **kwargs)
+    Purpose: Returns the result for key, only calling fn the first
+    time. If fn raises (even KeyboardInterrupt or SystemExit), callers
+    already waiting get the same exception but the key is forgotten so
+    a later retry makes a fresh request.
+    '''
+    def call(self, key, fn, *args, **kwargs):
+        with self.lock:
+            self.calls += 1
+            future = self.results.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.results[key] = future
+            else:
+                self.absorbed += 1
+                get_metrics().inc("songrec_memo_absorbed_total")
+
+        if owner:
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                with self.lock:
+                    self.results.pop(key, None)
+                future.set_exception(e)
+        return future.result()
+
+    '''
+    Name: acall
+    Parameters: key, fn, *args, **kwargs
+    Returns: await fn(*args, **kwargs)
+    Purpose: The async version of call, where fn is a coroutine function.
+    If the task making the request is cancelled the shared future is
+    cancelled too, and tasks that were waiting on it (but weren't
+    cancelled themselves) make the request again.
+    '''
+    async def acall(self, key, fn, *args, **kwargs):
+        self.calls += 1
+        while True:
+            future = self.async_results.get(key)
+            if future is None:
+                break
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+            finally:
+                if not future.cancelled():
+                    self.absorbed += 1
+                    get_metrics().inc("songrec_memo_absorbed_total")
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self.async_results[key] = future
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            if self.async_results.get(key) is future:
+                del self.async_results[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # marks the exception as retrieved when nobody else was waiting
+                future.exception()
+            raise
+        future.set_result(result)
+        return result
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns how many fetches were asked for, how many were
+    really made and how many duplicates were absorbed.
+    '''
+    def stats(self):
+        return {"calls": self.calls, "fetched": self.calls - self.absorbed,
+                "absorbed": self.absorbed}
+
+_current_memo = contextvars.ContextVar("run_memo", default=None)
+
+'''
+Name: memoized
+Parameters: key, fn, *args, **kwargs
+Returns: fn(*args, **kwargs)
+Purpose: Sends a fetch through the current run's memo, or just calls
+fn when there is no run in progress.
+'''
+def memoized(key, fn, *args, **kwargs):
+    memo = _current_memo.get()
+    if memo is None:
+        return fn(*args, **kwargs)
+    return memo.call(key, fn, *args, **kwargs)
+
+'''
+Name: amemoized
+Parameters: key, fn, *args, **kwargs
+Returns: await fn(*args, **kwargs)
+Purpose: The async version of memoized.
+'''
+async def amemoized(key, fn, *args, **kwargs):
+    memo = _current_memo.get()
+    if memo is None:
+        return await fn(*args, **kwargs)
+    return await memo.acall(key, fn, *args, **kwargs)
+
+'''
+Name: memoized_run
+Parameters: method
+Returns: wrapper
+Purpose: Decorator for rec_algorithm and arec_algorithm that gives
+every run its own RunMemo, then reports how many duplicate fetches
+it absorbed and keeps the stats on self.memo_stats.
+'''
+def memoized_run(method):
+    def report(self, memo):
+        self.memo_stats = memo.stats()
+        print(f"[DEBUG] Run memo: {memo.calls} requests, {memo.absorbed} duplicates absorbed")
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            memo = RunMemo()
+            token = _current_memo.set(memo)
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                _current_memo.reset(token)
+                report(self, memo)
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        memo = RunMemo()
+        token = _current_memo.set(memo)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _current_memo.reset(token)
+            report(self, memo)
+    return wrapper
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+'''
+Name: get_response_cache
+Parameters: None
+Returns: _response_cache
+Purpose: Returns the shared ResponseCache, opening it on first use.
+'''
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+_resolution_cache = None
+
+'''
+Name: get_resolution_cache
+Parameters: None
+Returns: _resolution_cache
+Purpose: Returns the shared ResolutionCache, opening it on first use.
+'''
+def get_resolution_cache():
+    global _resolution_cache
+    with _response_cache_lock:
+        if _resolution_cache is None:
+            _resolution_cache = ResolutionCache()
+        return _resolution_cache
+
+_artist_id_cache = None
+
+'''
+Name: get_artist_id_cache
+Parameters: None
+Returns: _artist_id_cache
+Purpose: Returns the shared ArtistIdCache, opening it on first use.
+'''
+def get_artist_id_cache():
+    global _artist_id_cache
+    with _response_cache_lock:
+        if _artist_id_cache is None:
+            _artist_id_cache = ArtistIdCache()
+        return _artist_id_cache
+
+_video_id_cache = None
+
+'''
+Name: get_video_id_cache
+Parameters: None
+Returns: _video_id_cache
+Purpose: Returns the shared VideoIdCache, opening it on first use.
+'''
+def get_video_id_cache():
+    global _video_id_cache
+    with _response_cache_lock:
+        if _video_id_cache is None:
+            _video_id_cache = VideoIdCache()
+        return _video_id_cache
+
+'''
+Name: main
+Parameters: argv=None
+Returns: None
+Purpose: Command line tool to inspect and purge the response cache,
+e.g. "python Caches.py stats" or "python Caches.py purge --expired".
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or purge the song rec response cache.")
+    parser.add_argument("--db", default=CACHE_FILE, help="path to the cache database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("stats", help="show entry counts per method")
+
+    list_parser = commands.add_parser("list", help="list cached keys")
+    list_parser.add_argument("--method")
+    list_parser.add_argument("--limit", type=int, default=50)
+
+    purge_parser = commands.add_parser("purge", help="delete cached entries")
+    purge_parser.add_argument("--method")
+    purge_parser.add_argument("--expired", action="store_true", help="only delete expired entries")
+
+    uri_parser = commands.add_parser("uris", help="show or purge the track URI cache")
+    uri_parser.add_argument("--purge", action="store_true")
+    uri_parser.add_argument("--expired", action="store_true", help="only purge expired entries")
+
+    video_parser = commands.add_parser("videos", help="show or purge the YouTube video ID cache")
+    video_parser.add_argument("--purge", action="store_true")
+    video_parser.add_argument("--expired", action="store_true", help="only purge expired entries")
+
+    args = parser.parse_args(argv)
+    cache = ResponseCache(args.db)
+
+    if args.command == "stats":
+        stats = cache.stats()
+        if not stats:
+            print("Cache is empty.")
+        for method, info in stats.items():
+            print(f"{method}: {info['entries']} entries, {info['bytes']} bytes "
+                  f"({info['fresh']} fresh, {info['stale']} stale, {info['expired']} expired)")
+    elif args.command == "list":
+        now = time.time()
+        for key, fetched_at, expires_at, size in cache.entries(args.method, args.limit):
+            age = int(now - fetched_at)
+            state = "fresh" if now <= expires_at else "expired"
+            print(f"{key}  age={age}s  {size}B  {state}")
+    elif args.command == "purge":
+        count = cache.purge(args.method, args.expired)
+        print(f"Purged {count} entries.")
+    elif args.command == "uris":
+        uri_cache = ResolutionCache(args.db)
+        if args.purge:
+            print(f"Purged {uri_cache.purge(args.expired)} entries.")
+        else:
+            stats = uri_cache.stats()
+            print(f"{stats['stored_matches']} matches, {stats['stored_no_matches']} no-matches stored")
+    elif args.command == "videos":
+        video_cache = VideoIdCache(args.db)
+        if args.purge:
+            print(f"Purged {video_cache.purge(args.expired)} entries.")
+        else:
+            stats = video_cache.stats()
+            print(f"{stats['stored_matches']} matches, {stats['stored_no_matches']} no-matches stored")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+# Import Libraries
+import os, threading
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.exceptions import SpotifyException
+
+# Import Files
+from Auths import SpotifyAuth, get_token_provider
+from Caches import ResponseCache, get_response_cache, memoized
+from Metrics import endpoint_label, get_metrics
+from RateLimits import get_rate_limiter
+
+# base URLs, overridable from the environment so the Replay.py stand-in
+# servers can take their place
+LASTFM_URL = os.getenv("LASTFM_URL", "http://ws.audioscrobbler.com/2.0/")
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+OPENWEATHER_URL = os.getenv("OPENWEATHER_URL", "http://api.openweathermap.org/data/2.5/")
+IPIFY_URL = os.getenv("IPIFY_URL", "https://api.ipify.org/")
+IP_API_URL = os.getenv("IP_API_URL", "http://ip-api.com/json/")
+
+'''
+Name: LastFMError
+Purpose: Raised when a Last.fm request fails, either because the
+HTTP request itself failed or because Last.fm sent back an error payload.
+Keeps the method, HTTP status and Last.fm error code so callers can
+decide how to handle it.
+'''
+class LastFMError(Exception):
+    def __init__(self, method, message, status_code=None, error_code=None):
+        super().__init__(f"{method}: {message}")
+        self.method = method
+        self.message = message
+        self.status_code = status_code
+        self.error_code = error_code
+
+'''
+Name: LastFMClient
+Purpose: A single Last.fm client with a pooled keep-alive session,
+so every recommender reuses the same open connections instead of
+paying a new TCP and DNS setup on every request.
+'''
+class LastFMClient():
+    '''
+    Name: __init__
+    Parameters: api_key, pool_size=10, timeout=10, cache=None
+    Returns: None
+    Purpose: Creates the pooled requests session that every
+    Last.fm call goes through, and keeps the optional response cache.
+    '''
+    def __init__(self, api_key, pool_size=10, timeout=10, cache=None):
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self.limiter = get_rate_limiter()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+    '''
+    Name: warm_up
+    Parameters: connections=2
+    Returns: threads
+    Purpose: Opens connections to Last.fm in background threads so
+    they are already in the pool by the time the first real request
+    is made, e.g. while Spotify authentication is still running.
+    '''
+    def warm_up(self, connections=2):
+        def _open():
+            try:
+                self.session.head(LASTFM_URL, timeout=self.timeout)
+            except requests.RequestException:
+                pass
+
+        threads = []
+        for _ in range(min(connections, self.pool_size)):
+            thread = threading.Thread(target=_open, daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    '''
+    Name: call
+    Parameters: method, **params
+    Returns: data
+    Purpose: Returns the response for a Last.fm API method, served
+    from the run memo or the cache when possible. Stale entries are
+    returned straight away and refreshed in the background.
+    '''
+    def call(self, method, **params):
+        key = ("lastfm", self.api_key, ResponseCache.make_key(method, params))
+        return memoized(key, self._call, method, params)
+
+    '''
+    Name: _call
+    Parameters: method, params
+    Returns: data
+    Purpose: Looks the response up in the cache, fetching it on a miss.
+    '''
+    def _call(self, method, params):
+        if self.cache is None:
+            return self.fetch(method, **params)
+
+        data, state = self.cache.get(method, params)
+        if state == "stale":
+            self._refresh_in_background(method, params)
+        if data is not None:
+            return data
+
+        data = self.fetch(method, **params)
+        self.cache.set(method, params, data)
+        return data
+
+    '''
+    Name: _refresh_in_background
+    Parameters: method, params
+    Returns: None
+    Purpose: Re-fetches a stale cache entry on a background thread,
+    making sure the same entry is only refreshed once at a time.
+    '''
+    def _refresh_in_background(self, method, params):
+        key = self.cache.make_key(method, params)
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def _refresh():
+            try:
+                self.cache.set(method, params, self.fetch(method, **params))
+            except LastFMError as e:
+                print(f"[WARNING] Couldn't refresh cached {method}: {e}")
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+    '''
+    Name: fetch
+    Parameters: method, **params
+    Returns: data
+    Purpose: Calls a Last.fm API method with URL-encoded params and
+    returns the decoded JSON, raising LastFMError on any failure.
+    '''
+    def fetch(self, method, **params):
+        query = {"method": method, **params, "api_key": self.api_key, "format": "json"}
+        self.limiter.acquire("lastfm", method)
+        try:
+            with get_metrics().external_call("lastfm", method):
+                response = self.session.get(LASTFM_URL, params=query, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise LastFMError(method, str(e)) from e
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+
+        if isinstance(data, dict) and "error" in data:
+            if data["error"] == 29:
+                # Last.fm's "rate limit exceeded" error
+                get_metrics().inc("songrec_rate_limited_total", provider="lastfm")
+            raise LastFMError(method, data.get("message", "Unknown error"),
+                              response.status_code, data["error"])
+        if response.status_code != 200:
+            raise LastFMError(method, f"HTTP {response.status_code}", response.status_code)
+        if data is None:
+            raise LastFMError(method, "Response was not valid JSON", response.status_code)
+
+        return data
+
+_lastfm_clients = {}
+_lastfm_lock = threading.Lock()
+
+'''
+Name: get_lastfm_client
+Parameters: api_key
+Returns: client
+Purpose: Returns the shared LastFMClient for this api key, creating
+it the first time so every recommender uses the same connection pool
+and the same on-disk response cache.
+'''
+def get_lastfm_client(api_key):
+    with _lastfm_lock:
+        client = _lastfm_clients.get(api_key)
+        if client is None:
+            client = LastFMClient(api_key, cache=get_response_cache())
+            _lastfm_clients[api_key] = client
+        return client
+
+'''
+Name: SpotifyClient
+Purpose: The spotipy client shared by every component. It always
+sends the current token from the SpotifyTokenProvider rather than one
+frozen when it was created, keeps a larger keep-alive connection pool,
+and if Spotify rejects the token with a 401 it refreshes it and retries
+the request once.
+'''
+class SpotifyClient(spotipy.Spotify):
+    '''
+    Name: __init__
+    Parameters: token_provider, pool_size=10, timeout=10
+    Returns: None
+    Purpose: Builds spotipy's retrying session and swaps in a bigger
+    connection pool with the same retry rules.
+    '''
+    def __init__(self, token_provider, pool_size=10, timeout=10):
+        super().__init__(requests_timeout=timeout)
+        self.prefix = SPOTIFY_API_URL
+        self.token_provider = token_provider
+        self.limiter = get_rate_limiter()
+
+        retries = self._session.get_adapter("https://").max_retries
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    '''
+    Name: _auth_headers
+    Parameters: None
+    Returns: headers
+    Purpose: Uses the provider's current token for every request.
+    '''
+    def _auth_headers(self):
+        return {"Authorization": f"Bearer {self.token_provider.get_token()}"}
+
+    '''
+    Name: _internal_call
+    Parameters: method, url, payload, params
+    Returns: results
+    Purpose: Sends the request through the rate limiter, refreshing
+    the token and trying once more if Spotify answers 401.
+    '''
+    def _internal_call(self, method, url, payload, params):
+        metrics = get_metrics()
+        endpoint = f"{method} {endpoint_label(url)}"
+        self.limiter.acquire("spotify")
+        try:
+            # spotipy removes content_type from params, so keep the original for a retry
+            with metrics.external_call("spotify", endpoint):
+                return super()._internal_call(method, url, payload, dict(params))
+        except SpotifyException as e:
+            if e.http_status != 401:
+                raise
+            print("[DEBUG] Spotify token was rejected. Refreshing now...")
+            metrics.inc("songrec_retries_total", provider="spotify", reason="401")
+            self.token_provider.refresh()
+            self.limiter.acquire("spotify")
+            with metrics.external_call("spotify", endpoint):
+                return super()._internal_call(method, url, payload, params)
+
+_spotify_clients = {}
+_spotify_lock = threading.Lock()
+
+'''
+Name: get_spotify_client
+Parameters: spotify_auth=None
+Returns: client
+Purpose: Returns the shared SpotifyClient for this SpotifyAuth's
+token file, creating it the first time.
+'''
+def get_spotify_client(spotify_auth=None):
+    if spotify_auth is None:
+        spotify_auth = SpotifyAuth()
+    with _spotify_lock:
+        client = _spotify_clients.get(spotify_auth.token_file)
+        if client is None:
+            client = SpotifyClient(get_token_provider(spotify_auth))
+            _spotify_clients[spotify_auth.token_file] = client
+        return client
@@ -1,68 +1,97 @@
 # Import Libraries
-from fontTools.misc.psOperators import PSOperators
-from spotipy import SpotifyOAuth
-import spotipy
+import argparse
 
 # Import files
-from APIs import SpotifyAPI, YoutubeAPI, LastFMAPI
-from NEA.songRecSystem.Other import random_album_picker
-from Recommendations import GenreRecs, UserRecs, SeasonRecs, WeatherRecs
+# the API, recommender and client modules are imported the first time
+# a mode needs them so the first prompt shows up straight away
 from Auths import LastFMAuth, SpotifyAuth, WeatherAPI
-import Other
+from Profiling import add_profile_arguments, profiler_from_args
 
 '''
 Name: main
-Parameters: None
+Parameters: argv=None
 Returns: None
 Purpose: This function calls other functions to start the program.
+With --profile the recommendation cycles are profiled and a per-stage
+breakdown is printed when the user quits.
 '''
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Song recommendation system.")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # Auth objects, which only read credentials
+    lastfm_key = LastFMAuth().get_credentials()
+    open_weather_key = WeatherAPI().get_credentials()
+    spotify_auth = SpotifyAuth()
+    objects = {}
+
     '''
     Name: object_inst
-    Parameters: None
-    Returns: genre, user, season, weather, spotifyAPI, youtubeAPI, sp
-    Purpose: Instantiates objects of all the classes needed.
+    Parameters: name
+    Returns: object
+    Purpose: Instantiates one of the objects a mode needs: "sp", a
+    recommender ("genre", "user", "season", "weather"), "spotifyAPI"
+    or "youtubeAPI".
     '''
-    def object_inst():
-        # Auth objects
-        lastfm = LastFMAuth()
-        lastfm_key = lastfm.get_credentials()
-
-        open_weather = WeatherAPI()
-        open_weather_key = open_weather.get_credentials()
-
-        spotify_auth = SpotifyAuth()
-        access_token = spotify_auth.get_access_token()
-        sp = spotipy.Spotify(auth=access_token)
+    def object_inst(name):
+        if name == "sp":
+            from Clients import get_lastfm_client, get_spotify_client
+
+            # opens last.fm connections in the background while spotify auth runs
+            get_lastfm_client(lastfm_key).warm_up()
+            # one spotify client shared by everything, so they share a connection pool and token
+            sp = get_spotify_client(spotify_auth)
+            test_spotify_auth(sp)
+            return sp
+
+        if name == "spotifyAPI":
+            from APIs import SpotifyAPI
+            return SpotifyAPI(get_object("sp"))
+
+        if name == "youtubeAPI":
+            from APIs import YoutubeAPI
+            youtubeAPI = YoutubeAPI()
+            test_youtube_auth(youtubeAPI)
+            return youtubeAPI
 
         # Recommendation Objects
-        genre = GenreRecs(lastfm_key, None, spotify_auth)
-        user = UserRecs(lastfm_key, None, spotify_auth)
-        season = SeasonRecs(lastfm_key, None, spotify_auth)
-        weather = WeatherRecs(open_weather_key, lastfm_key, spotify_auth)
+        from Recommendations import GenreRecs, SeasonRecs, UserRecs, WeatherRecs
 
-        # API instantiation
-        spotifyAPI = SpotifyAPI()
-        youtubeAPI = YoutubeAPI()
+        sp = get_object("sp")
+        if name == "genre":
+            return GenreRecs(lastfm_key, None, spotify_auth, sp)
+        if name == "user":
+            return UserRecs(lastfm_key, None, spotify_auth, sp)
+        if name == "season":
+            return SeasonRecs(lastfm_key, None, spotify_auth, sp)
+        return WeatherRecs(open_weather_key, lastfm_key, spotify_auth, sp)
 
-        return genre, user, season, weather, spotifyAPI, youtubeAPI, sp
+    '''
+    Name: get_object
+    Parameters: name
+    Returns: objects[name]
+    Purpose: Returns the named object, instantiating it the first time
+    it is needed so modes that are never chosen cost nothing.
+    '''
+    def get_object(name):
+        if name not in objects:
+            objects[name] = object_inst(name)
+        return objects[name]
 
     '''
     Name: test_spotify_auth
-    Parameters: None
+    Parameters: sp
     Returns: None
     Purpose: Tests if the user is successfully authenticated
     on Spotify before continuing.
     '''
-    def test_spotify_auth():
+    def test_spotify_auth(sp):
         try:
             print("[DEBUG] Testing Spotify authentication...")
-            spotify = SpotifyAPI()
-            user_id, user_info, user_name = spotify.get_user_info()
-            # print("[DEBUG] USER ID:",user_id)
+            user_info = sp.me()
             # print("[DEBUG] USER INFO:",user_info)
-            # print("[DEBUG] USERNAME:", user_name)
-            print(f"[DEBUG] Spotify Auth Successful: {user_name}")
+            print(f"[DEBUG] Spotify Auth Successful: {user_info.get('display_name', 'Unknown User')}")
         except Exception as e:
             print(f"[DEBUG] Spotify Auth Failed: {e}")
 
@@ -70,15 +99,14 @@ def main():
 
     '''
     Name: test_youtube_auth
-    Parameters: None
+    Parameters: youtube
     Returns: None
     Purpose: Tests if the user is successfully authenticated
     on YouTube before continuing.
     '''
-    def test_youtube_auth():
+    def test_youtube_auth(youtube):
         try:
             print("[DEBUG] Testing YouTube authentication...")
-            youtube = YoutubeAPI()
             user_name, _ = youtube.get_user_info()
             print(f"[DEBUG] YouTube Auth Successful: {user_name}")
         except Exception as e:
@@ -87,52 +115,57 @@ def main():
 
     '''
     Name: recommendations
-    Parameters: genre, user, season, weather, spotifyAPI, youtubeAPI
+    Parameters: None
     Returns: None
     Purpose: This calls the recommendation algorithms from Recommendations.py
-    and it also displays the CLI input questions. 
+    and it also displays the CLI input questions.
     '''
-    def recommendations(genre, user, season, weather, spotifyAPI, youtubeAPI):
+    def recommendations():
         end = False
 
         while not end:
             while True:
                 rec_choice = input("What type of recommendations? (Genre / User / Album / Seasonal / Weather)")
                 if rec_choice.lower().startswith("g"):
-                    recs, uris, playlist_name  = genre.generate_recs()
-                    break
+                    rec_type = "genre"
                 elif rec_choice.lower().startswith("u"):
-                    recs, uris, playlist_name = user.generate_recs()
-                    break
+                    rec_type = "user"
                 elif rec_choice.lower().startswith("a"):
-                    random_album_picker(None, None, sp)
+                    from Other import random_album_picker
+                    random_album_picker(None, None, get_object("sp"))
                     break
                 elif rec_choice.lower().startswith("s"):
-                    recs, uris, playlist_name = season.generate_recs()
-                    break
+                    rec_type = "season"
                 elif rec_choice.lower().startswith("w"):
-                    recs, uris, playlist_name = weather.generate_recs()
-                    break
+                    rec_type = "weather"
                 else:
                     print("[DEBUG] Invalid recommendation input. ")
                     continue
 
+                recommender = get_object(rec_type)
+                recs, uris, playlist_name = recommender.generate_recs()
+                track_info = recommender.track_info
+                break
+
             if not rec_choice.lower().startswith("a"):
                 if input("Would you like to add the recommendations to a playlist? ").lower().startswith("y"):
                     APIChoice = input("Youtube or Spotify or Both?")
                     if APIChoice.lower().startswith("y"):
-                        video_ids = youtubeAPI.uris_to_ids(spotifyAPI, uris)
-                        youtubeAPI.add_to_playlist(playlist_name, video_ids)
+                        youtubeAPI = get_object("youtubeAPI")
+                        video_ids = youtubeAPI.uris_to_ids(get_object("spotifyAPI"), uris, track_info)
+                        youtubeAPI.add_to_playlist(playlist_name, video_ids, summary=True)
                     elif APIChoice.lower().startswith("s"):
                         if uris:
                             print("URIs to add:", uris)
-                            spotifyAPI.add_to_playlist(playlist_name, uris)
+                            get_object("spotifyAPI").add_to_playlist(playlist_name, uris, sync=True)
                         else:
                             print("[ERROR] No songs to add. ")
                     else:
-                        spotifyAPI.add_to_playlist(playlist_name, uris)
-                        video_ids = youtubeAPI.uris_to_ids(spotifyAPI, uris)
-                        youtubeAPI.add_to_playlist(playlist_name, video_ids)
+                        spotifyAPI = get_object("spotifyAPI")
+                        spotifyAPI.add_to_playlist(playlist_name, uris, sync=True)
+                        youtubeAPI = get_object("youtubeAPI")
+                        video_ids = youtubeAPI.uris_to_ids(spotifyAPI, uris, track_info)
+                        youtubeAPI.add_to_playlist(playlist_name, video_ids, summary=True)
 
             while True:
                 user_input = input("Press Q to end recommendations, or press Enter to continue: ").strip().lower()
@@ -146,10 +179,15 @@ def main():
 
                 print("Invalid input, please only press Q or enter!")
 
-    genre, user, season, weather, spotifyapi, youtubeapi, sp = object_inst()
-    test_spotify_auth()
-    test_youtube_auth()
-    recommendations(genre, user, season, weather, spotifyapi, youtubeapi)
+    profiler = profiler_from_args(args)
+    if profiler is None:
+        recommendations()
+    else:
+        # time spent at the input() prompts isn't inside any stage, so
+        # it only shows up in the total wall time
+        with profiler:
+            recommendations()
+        profiler.print_report()
 
 
 
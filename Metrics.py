@@ -0,0 +1,465 @@
+# Import Libraries
+import atexit, bisect, contextvars, functools, inspect, json, os, re, sys, threading, time
+from collections import deque
+from collections.abc import Coroutine
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# finished top-level traces kept for /metrics
+MAX_TRACES = 20
+# child spans kept per span; the rest are only counted
+MAX_CHILDREN = 500
+
+# set to write the metrics to a file when the program exits
+METRICS_FILE = os.getenv("SONGREC_METRICS_FILE")
+
+HELP = {
+    "songrec_external_call_seconds": "Time taken by calls to external APIs.",
+    "songrec_external_calls_total": "Calls to external APIs by outcome.",
+    "songrec_span_seconds": "Time spent in each recommendation stage.",
+    "songrec_cache_lookups_total": "Cache lookups by cache and result.",
+    "songrec_memo_absorbed_total": "Duplicate requests absorbed by the run memo.",
+    "songrec_retries_total": "Requests retried, by provider and reason.",
+    "songrec_rate_limited_total": "429 (rate limited) responses by provider.",
+}
+
+_current_span = contextvars.ContextVar("trace_span", default=None)
+# the TaskClock of the task whose step is running on this thread
+_clocks = threading.local()
+
+'''
+Name: endpoint_label
+Parameters: path
+Returns: label
+Purpose: Turns a URL path into a metric label by dropping the query
+and collapsing segments that look like IDs (8+ characters with a
+digit in them), so every track lookup shares one label.
+'''
+def endpoint_label(path):
+    path = re.sub(r"^[a-z]+://[^/]+", "", path).split("?", 1)[0]
+    return re.sub(r"/(?=[^/]*\d)[^/]{8,}", "/{id}", "/" + path.strip("/"))
+
+'''
+Name: TaskClock
+Purpose: Counts the CPU time one asyncio task has used, by adding up
+the thread CPU time of each step between the task resuming and
+suspending again. Other tasks running on the loop while it waits
+aren't counted.
+'''
+class TaskClock():
+    __slots__ = ("cpu", "resumed")
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.resumed = None
+
+    '''
+    Name: now
+    Parameters: None
+    Returns: cpu
+    Purpose: Returns the task's CPU time so far, including the step
+    that is running now.
+    '''
+    def now(self):
+        return self.cpu + (time.thread_time() - self.resumed)
+
+'''
+Name: _ClockedCoroutine
+Purpose: Wraps a task's coroutine so every step the task takes is
+timed on the task's TaskClock.
+'''
+class _ClockedCoroutine(Coroutine):
+    __slots__ = ("coro", "clock")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.clock = TaskClock()
+
+    '''
+    Name: _step
+    Parameters: method, *args
+    Returns: result
+    Purpose: Runs one step of the coroutine on the task's clock.
+    '''
+    def _step(self, method, *args):
+        previous = getattr(_clocks, "current", None)
+        _clocks.current = self.clock
+        self.clock.resumed = time.thread_time()
+        try:
+            return method(*args)
+        finally:
+            self.clock.cpu += time.thread_time() - self.clock.resumed
+            _clocks.current = previous
+
+    def send(self, value):
+        return self._step(self.coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self.coro.throw, *args)
+
+    def close(self):
+        return self.coro.close()
+
+    def __await__(self):
+        return self.coro.__await__()
+
+'''
+Name: task_factory
+Parameters: loop, coro, **kwargs
+Returns: task
+Purpose: Event loop task factory (loop.set_task_factory) that gives
+every task its own TaskClock, so spans inside tasks get the CPU time
+of their own task rather than of the whole loop thread.
+'''
+def task_factory(loop, coro, **kwargs):
+    import asyncio
+    return asyncio.Task(_ClockedCoroutine(coro), loop=loop, **kwargs)
+
+'''
+Name: _cpu_clock
+Parameters: None
+Returns: clock, cpu
+Purpose: Returns the clock CPU time is measured on here and its
+reading: the running task's TaskClock inside a task made by
+task_factory, otherwise the thread. Tasks on a loop without the
+factory share the thread with every other task, so they get
+(None, None) and their spans are wall time only.
+'''
+def _cpu_clock():
+    clock = getattr(_clocks, "current", None)
+    if clock is not None:
+        return clock, clock.now()
+    # asyncio is only checked if something already imported it
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is not None and asyncio._get_running_loop() is not None:
+        return None, None
+    return threading.get_ident(), time.thread_time()
+
+'''
+Name: Span
+Purpose: One timed section of a run. Spans nest: a span started while
+another is open becomes its child, including across worker threads
+started with contextvars.copy_context() and asyncio tasks. cpu is the
+CPU time the span's own thread, or its own task on the engine loop,
+used while it was open, or None if that couldn't be measured; clock
+says which thread or task that was. kind is "call" for external API
+calls and "stage" otherwise.
+'''
+class Span():
+    def __init__(self, name, labels, parent, kind="stage"):
+        self.name = name
+        self.labels = labels
+        self.parent = parent
+        self.kind = kind
+        self.thread = threading.get_ident()
+        self.clock = None
+        self.start = time.time()
+        self.duration = None
+        self.cpu = None
+        self.error = None
+        self.children = []
+        self.dropped = 0
+
+    '''
+    Name: to_dict
+    Parameters: None
+    Returns: span
+    Purpose: Returns the span and its children as plain data.
+    '''
+    def to_dict(self):
+        span = {
+            "name": self.name,
+            "labels": self.labels,
+            "start": round(self.start, 6),
+            "seconds": None if self.duration is None else round(self.duration, 6),
+            "cpu_seconds": None if self.cpu is None else round(self.cpu, 6),
+            "children": [child.to_dict() for child in list(self.children)],
+        }
+        if self.error:
+            span["error"] = self.error
+        if self.dropped:
+            span["dropped_children"] = self.dropped
+        return span
+
+'''
+Name: Metrics
+Purpose: Thread-safe counters, histograms and recent trace trees for
+the whole program. It can be read as Prometheus text or JSON.
+'''
+class Metrics():
+    '''
+    Name: __init__
+    Parameters: buckets=BUCKETS, max_traces=MAX_TRACES
+    Returns: None
+    Purpose: Creates the empty registry.
+    '''
+    def __init__(self, buckets=BUCKETS, max_traces=MAX_TRACES):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.traces = deque(maxlen=max_traces)
+        self.listeners = []
+
+    '''
+    Name: inc
+    Parameters: name, value=1, **labels
+    Returns: None
+    Purpose: Adds value to a counter.
+    '''
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    '''
+    Name: observe
+    Parameters: name, seconds, **labels
+    Returns: None
+    Purpose: Records one timing in a histogram.
+    '''
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0, 0.0, [0] * len(self.buckets)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            if index < len(self.buckets):
+                histogram[2][index] += 1
+
+    '''
+    Name: _finish_span
+    Parameters: span
+    Returns: None
+    Purpose: Attaches a finished span to its parent, or keeps it as a
+    trace if it has no parent.
+    '''
+    def _finish_span(self, span):
+        with self.lock:
+            if span.parent is None:
+                self.traces.append(span)
+                listeners = list(self.listeners)
+            else:
+                listeners = []
+                if len(span.parent.children) < MAX_CHILDREN:
+                    span.parent.children.append(span)
+                else:
+                    span.parent.dropped += 1
+        for listener in listeners:
+            listener(span)
+
+    '''
+    Name: add_listener
+    Parameters: listener
+    Returns: None
+    Purpose: Calls listener(span) with every finished top-level span.
+    '''
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    '''
+    Name: remove_listener
+    Parameters: listener
+    Returns: None
+    Purpose: Stops calling a listener added with add_listener.
+    '''
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    '''
+    Name: span
+    Parameters: name, metric="songrec_span_seconds", kind="stage", **labels
+    Returns: span
+    Purpose: Context manager that times a block as a span. Labels are
+    inherited from the enclosing span, and the time is also recorded
+    in the metric histogram unless metric is None.
+    '''
+    @contextmanager
+    def span(self, name, metric="songrec_span_seconds", kind="stage", **labels):
+        parent = _current_span.get()
+        if parent is not None:
+            labels = dict(parent.labels, **labels)
+        span = Span(name, labels, parent, kind)
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        span.clock, cpu_started = _cpu_clock()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            if span.clock is not None:
+                span.cpu = _cpu_clock()[1] - cpu_started
+            _current_span.reset(token)
+            self._finish_span(span)
+            if metric is not None:
+                self.observe(metric, span.duration, span=name, **labels)
+
+    '''
+    Name: external_call
+    Parameters: provider, endpoint
+    Returns: span
+    Purpose: Context manager around one request to an external API. It
+    records the call's time and outcome and adds it to the current
+    trace.
+    '''
+    @contextmanager
+    def external_call(self, provider, endpoint):
+        outcome = "error"
+        started = time.perf_counter()
+        try:
+            with self.span(f"{provider} {endpoint}", metric=None, kind="call") as span:
+                yield span
+            outcome = "ok"
+        finally:
+            labels = {"provider": provider, "endpoint": endpoint}
+            self.observe("songrec_external_call_seconds", time.perf_counter() - started, **labels)
+            self.inc("songrec_external_calls_total", outcome=outcome, **labels)
+
+    '''
+    Name: reset
+    Parameters: None
+    Returns: None
+    Purpose: Clears every counter, histogram and trace.
+    '''
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.traces.clear()
+
+    '''
+    Name: to_dict
+    Parameters: None
+    Returns: metrics
+    Purpose: Returns everything as JSON-friendly data.
+    '''
+    def to_dict(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (count, total, list(buckets))
+                          for key, (count, total, buckets) in self.histograms.items()}
+            traces = list(self.traces)
+
+        data = {"counters": {}, "histograms": {}, "traces": [span.to_dict() for span in traces]}
+        for (name, labels), value in sorted(counters.items()):
+            data["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), (count, total, buckets) in sorted(histograms.items()):
+            cumulative, running = {}, 0
+            for bound, bucket in zip(self.buckets, buckets):
+                running += bucket
+                cumulative[str(bound)] = running
+            data["histograms"].setdefault(name, []).append({
+                "labels": dict(labels), "count": count, "sum": round(total, 6),
+                "mean": round(total / count, 6) if count else 0.0, "buckets": cumulative,
+            })
+        return data
+
+    '''
+    Name: prometheus_text
+    Parameters: None
+    Returns: text
+    Purpose: Returns the counters and histograms in the Prometheus text
+    exposition format.
+    '''
+    def prometheus_text(self):
+        data = self.to_dict()
+        lines = []
+        for name, series in data["counters"].items():
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for item in series:
+                lines.append(f"{name}{_format_labels(item['labels'])} {item['value']}")
+        for name, series in data["histograms"].items():
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for item in series:
+                for bound, count in item["buckets"].items():
+                    lines.append(f"{name}_bucket{_format_labels(item['labels'], le=bound)} {count}")
+                lines.append(f"{name}_bucket{_format_labels(item['labels'], le='+Inf')} {item['count']}")
+                lines.append(f"{name}_sum{_format_labels(item['labels'])} {item['sum']}")
+                lines.append(f"{name}_count{_format_labels(item['labels'])} {item['count']}")
+        return "\n".join(lines) + "\n"
+
+    '''
+    Name: write
+    Parameters: path
+    Returns: None
+    Purpose: Writes the metrics to a file, as JSON if the path ends in
+    .json and Prometheus text otherwise.
+    '''
+    def write(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            if path.endswith(".json"):
+                json.dump(self.to_dict(), f, indent=1)
+            else:
+                f.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+'''
+Name: _format_labels
+Parameters: labels, **extra
+Returns: text
+Purpose: Formats labels as {name="value",...} with Prometheus escaping.
+'''
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+'''
+Name: get_metrics
+Parameters: None
+Returns: _metrics
+Purpose: Returns the shared Metrics registry. If SONGREC_METRICS_FILE
+is set the metrics are written there when the program exits.
+'''
+def get_metrics():
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+            if METRICS_FILE:
+                atexit.register(_metrics.write, METRICS_FILE)
+        return _metrics
+
+'''
+Name: traced
+Parameters: name, **labels
+Returns: decorator
+Purpose: Decorator that runs a function (or coroutine function) inside
+a span with the given name and labels.
+'''
+def traced(name, **labels):
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with get_metrics().span(name, **labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_metrics().span(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,64 +1,77 @@
 import random, requests
-from PIL import Image as PILImage
-import requests
 from io import BytesIO
-from rich.console import Console
+
+from Clients import get_spotify_client
+from Metrics import get_metrics
+from RateLimits import get_rate_limiter
+
+'''
+Name: generate_albums
+Parameters: sp
+Returns: None or Chosen
+Purpose: This uses the Spotify API object to
+generate a random album from the user's saved
+library.
+'''
+def generate_albums(sp):
+    saved_albums = sp.current_user_saved_albums(limit=50)
+    albums = saved_albums['items']
+    if not albums:
+        return None
+    album_list = [item['album'] for item in albums]
+    num = min(15, len(album_list))
+    chosen = random.sample(album_list, num)
+    return chosen
+
+'''
+Name: get_album_art
+Parameters: sp=None
+Returns: None or album
+Purpose: This picks one random album from the user's
+saved library and returns its name, artists and album
+art url as a dict, without displaying anything.
+sp defaults to the shared SpotifyClient.
+'''
+def get_album_art(sp=None):
+    if sp is None:
+        sp = get_spotify_client()
+
+    albums = generate_albums(sp)
+    if not albums:
+        return None
+    album = random.choice(albums)
+    return {
+        "name": album['name'],
+        "artist": ", ".join(artist['name'] for artist in album['artists']),
+        "image_url": album['images'][0]['url'] if album['images'] else None,
+        "uri": album.get('uri'),
+    }
+
 '''
 Name: random_album_picker
-Parameters: api_key1, api_key2, sp
+Parameters: api_key1, api_key2, sp=None
 Returns: None
-Purpose: This function holds the multiple methods
-needed for the random album picker. 
+Purpose: This displays the album art of a random
+saved album in a new window view whilst displaying
+the album and artist name in the terminal.
+sp defaults to the shared SpotifyClient.
 '''
-def random_album_picker(api_key1, api_key2, sp):
-    '''
-    Name: generate_albums
-    Parameters: None
-    Returns: None or Chosen
-    Purpose: This uses the Spotify API object to
-    generate a random album from the user's saved
-    library.
-    '''
-    def generate_albums():
-        saved_albums = sp.current_user_saved_albums(limit=50)
-        albums = saved_albums['items']
-        if not albums:
-            return None
-        album_list = [item['album'] for item in albums]
-        num = min(15, len(album_list))
-        chosen = random.sample(album_list, num)
-        return chosen
-
-    '''
-    Name: get_album_art
-    Parameters: None
-    Returns: name, artist, image_url
-    Purpose: This gets the album art for the 
-    one random album by searching for a url. 
-    '''
-    def get_album_art():
-        albums = generate_albums()
-        album = random.choice(albums)
-        name = album['name']
-        artist = ", ".join(artist['name'] for artist in album['artists'])
-        image_url = album['images'][0]['url'] if album['images'] else None
-        return name, artist, image_url
+def random_album_picker(api_key1, api_key2, sp=None):
+    album = get_album_art(sp)
+    if album is None:
+        print("[DEBUG] No saved albums to pick from.")
+        return
 
-    '''
-    Name: display
-    Parameters: None
-    Returns: None
-    Purpose: This displays the album art in a new window
-    view whilst displaying the album and artist name in the terminal
-    '''
-    def display():
-        name, artist, image_url = get_album_art()
-        if image_url:
-            response = requests.get(image_url)
-            img = PILImage.open(BytesIO(response.content))
+    if album["image_url"]:
+        # only needed to show the album, so not imported at start up
+        from PIL import Image as PILImage
+        from rich.console import Console
 
-            console = Console()
-            console.print(f"{name} - {artist}")
-            img.show()
+        get_rate_limiter().acquire("spotify-cdn")
+        with get_metrics().external_call("spotify-cdn", "/image"):
+            response = requests.get(album["image_url"])
+        img = PILImage.open(BytesIO(response.content))
 
-    display()
+        console = Console()
+        console.print(f"{album['name']} - {album['artist']}")
+        img.show()
@@ -0,0 +1,346 @@
+# Import Libraries
+import os, sys, threading, time
+
+# Import Files
+from Metrics import get_metrics
+
+# seconds between stack samples for the flamegraph dump
+SAMPLE_INTERVAL = 0.005
+# frames kept per sampled stack
+MAX_STACK_DEPTH = 64
+
+'''
+Name: add_profile_arguments
+Parameters: parser
+Returns: None
+Purpose: Adds the --profile options shared by the entry points.
+'''
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help="print a per-stage wall/CPU/socket wait breakdown when done")
+    parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+                        help="how many of the slowest external calls to list (default 10)")
+    parser.add_argument("--flamegraph", metavar="FILE",
+                        help="also write sampled stacks here in collapsed (flamegraph.pl / speedscope) format")
+
+'''
+Name: profiler_from_args
+Parameters: args
+Returns: profiler
+Purpose: Returns a Profiler for the parsed --profile options, or None
+if profiling wasn't asked for.
+'''
+def profiler_from_args(args):
+    if not args.profile and not args.flamegraph:
+        return None
+    return Profiler(top=args.profile_top, stacks_file=args.flamegraph)
+
+'''
+Name: StackSampler
+Purpose: Background thread that records every other thread's Python
+stack at a fixed interval, counting identical stacks so they can be
+written out for a flamegraph.
+'''
+class StackSampler(threading.Thread):
+    '''
+    Name: __init__
+    Parameters: interval=SAMPLE_INTERVAL
+    Returns: None
+    Purpose: Creates the sampler. Call start() to begin sampling.
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    '''
+    Name: run
+    Parameters: None
+    Returns: None
+    Purpose: Samples until stop() is called.
+    '''
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    '''
+    Name: sample
+    Parameters: None
+    Returns: None
+    Purpose: Records the current stack of every thread but this one.
+    '''
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            frames = []
+            while frame is not None and len(frames) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            frames.append(names.get(ident, f"thread-{ident}"))
+            # collapsed stacks go root first, separated by ;
+            stack = ";".join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    '''
+    Name: stop
+    Parameters: None
+    Returns: None
+    Purpose: Stops sampling and waits for the thread to finish.
+    '''
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    '''
+    Name: write
+    Parameters: path
+    Returns: None
+    Purpose: Writes one "frame;frame;frame count" line per distinct
+    stack, the input format of flamegraph.pl and speedscope.
+    '''
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+'''
+Name: _cpu
+Parameters: span
+Returns: cpu
+Purpose: Returns the span's own CPU time, or 0 if it is wall time only.
+'''
+def _cpu(span):
+    return span.cpu or 0.0
+
+'''
+Name: _socket_wait
+Parameters: span
+Returns: seconds
+Purpose: Returns how long an external call spent not on the CPU.
+'''
+def _socket_wait(span):
+    return max(span.duration - _cpu(span), 0.0)
+
+'''
+Name: _other_clock_cpu
+Parameters: span
+Returns: cpu
+Purpose: Returns the CPU time of the span's descendants that were
+measured on a different clock (another thread, or another task on the
+engine loop) to their parent, which the span's own CPU time doesn't
+include. Descendants on the same clock are already in it.
+'''
+def _other_clock_cpu(span):
+    cpu = 0.0
+    for child in span.children:
+        if child.clock is not None and child.clock != span.clock:
+            cpu += _cpu(child) + _other_clock_cpu(child)
+        else:
+            cpu += _other_clock_cpu(child)
+    return cpu
+
+'''
+Name: _walk
+Parameters: span
+Returns: spans
+Purpose: Yields a span and all of its descendants.
+'''
+def _walk(span):
+    yield span
+    for child in span.children:
+        yield from _walk(child)
+
+'''
+Name: _stage_path
+Parameters: span
+Returns: path
+Purpose: Returns the names of the stages a span ran inside, outermost
+first, e.g. "rec_algorithm > candidates".
+'''
+def _stage_path(span):
+    names = []
+    parent = span.parent
+    while parent is not None:
+        names.append(parent.name)
+        parent = parent.parent
+    return " > ".join(reversed(names)) or "(no stage)"
+
+'''
+Name: Profiler
+Purpose: Profiles everything that runs between start() and stop() (or
+inside a with block) using the spans Metrics already records. Each
+stage gets its wall time, CPU time (across every thread it used) and
+time blocked on sockets, taken as external call time not spent on the
+CPU. Spans on the engine loop count the CPU of their own task only, and
+no stage is reported as using more CPU than the whole process did. It
+can also sample stacks for a flamegraph.
+'''
+class Profiler():
+    '''
+    Name: __init__
+    Parameters: top=10, stacks_file=None, interval=SAMPLE_INTERVAL
+    Returns: None
+    Purpose: Creates the profiler. Stacks are only sampled when
+    stacks_file is set.
+    '''
+    def __init__(self, top=10, stacks_file=None, interval=SAMPLE_INTERVAL):
+        self.top = top
+        self.stacks_file = stacks_file
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.spans = []
+        self.sampler = None
+        self.wall = None
+        self.cpu = None
+
+    '''
+    Name: _collect
+    Parameters: span
+    Returns: None
+    Purpose: Keeps each finished top-level span while profiling.
+    '''
+    def _collect(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    '''
+    Name: start
+    Parameters: None
+    Returns: None
+    Purpose: Starts collecting spans, and sampling stacks if asked to.
+    '''
+    def start(self):
+        get_metrics().add_listener(self._collect)
+        if self.stacks_file:
+            self.sampler = StackSampler(self.interval)
+            self.sampler.start()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+
+    '''
+    Name: stop
+    Parameters: None
+    Returns: None
+    Purpose: Stops profiling and writes the stack samples if asked to.
+    '''
+    def stop(self):
+        self.wall = time.perf_counter() - self._started
+        self.cpu = time.process_time() - self._cpu_started
+        get_metrics().remove_listener(self._collect)
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(self.stacks_file)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    '''
+    Name: report
+    Parameters: None
+    Returns: report
+    Purpose: Returns the per-stage breakdown, the slowest external calls
+    and the totals for the profiled run as plain data.
+    '''
+    def report(self):
+        with self.lock:
+            roots = list(self.spans)
+
+        stages, calls = {}, []
+        for root in roots:
+            for span in _walk(root):
+                if span.kind == "call":
+                    calls.append(span)
+                    continue
+                span_calls = [s for s in _walk(span) if s.kind == "call"]
+                stage = stages.setdefault(span.name, {
+                    "count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                    "socket_wait_seconds": 0.0, "calls": 0, "errors": 0,
+                })
+                stage["count"] += 1
+                stage["errors"] += int(bool(span.error))
+                stage["wall_seconds"] += span.duration
+                stage["cpu_seconds"] += _cpu(span) + _other_clock_cpu(span)
+                stage["socket_wait_seconds"] += sum(_socket_wait(s) for s in span_calls)
+                stage["calls"] += len(span_calls)
+
+        # external calls made outside any stage still count towards the totals
+        loose = [span for span in roots if span.kind == "call"]
+        if loose:
+            stages["(no stage)"] = {
+                "count": len(loose),
+                "wall_seconds": sum(span.duration for span in loose),
+                "cpu_seconds": sum(_cpu(span) for span in loose),
+                "socket_wait_seconds": sum(_socket_wait(span) for span in loose),
+                "calls": len(loose),
+                "errors": sum(1 for span in loose if span.error),
+            }
+        process_cpu = self.cpu or 0.0
+        for stage in stages.values():
+            # a stage can't use more CPU than the process did, so more
+            # means its spans were counted twice somewhere
+            if stage["cpu_seconds"] > process_cpu:
+                stage["cpu_seconds"] = process_cpu
+                stage["cpu_capped"] = True
+            for key in ("wall_seconds", "cpu_seconds", "socket_wait_seconds"):
+                stage[key] = round(stage[key], 4)
+
+        calls.sort(key=lambda span: span.duration, reverse=True)
+        slowest = [{
+            "call": span.name,
+            "seconds": round(span.duration, 4),
+            "cpu_seconds": None if span.cpu is None else round(span.cpu, 4),
+            "stage": _stage_path(span),
+            "error": span.error,
+        } for span in calls[:self.top]]
+
+        return {
+            "wall_seconds": round(self.wall or 0.0, 4),
+            "cpu_seconds": round(self.cpu or 0.0, 4),
+            "socket_wait_seconds": round(sum(_socket_wait(span) for span in calls), 4),
+            "external_calls": len(calls),
+            "stages": dict(sorted(stages.items(), key=lambda item: item[1]["wall_seconds"], reverse=True)),
+            "slowest_calls": slowest,
+            "stack_samples": self.sampler.samples if self.sampler is not None else 0,
+        }
+
+    '''
+    Name: print_report
+    Parameters: file=sys.stdout
+    Returns: None
+    Purpose: Prints the report as tables.
+    '''
+    def print_report(self, file=sys.stdout):
+        report = self.report()
+        print(f"\n[PROFILE] {report['wall_seconds']:.2f}s wall, {report['cpu_seconds']:.2f}s CPU, "
+              f"{report['socket_wait_seconds']:.2f}s waiting on sockets over "
+              f"{report['external_calls']} external calls", file=file)
+        # stages are inclusive of the stages inside them, and CPU and
+        # socket wait are summed over threads so can be more than wall
+        print(f"{'stage':<28}{'count':>6}{'wall s':>10}{'cpu s':>10}{'socket s':>10}{'calls':>7}", file=file)
+        for name, stage in report["stages"].items():
+            print(f"{name[:27]:<28}{stage['count']:>6}{stage['wall_seconds']:>10.3f}"
+                  f"{stage['cpu_seconds']:>10.3f}{stage['socket_wait_seconds']:>10.3f}{stage['calls']:>7}",
+                  file=file)
+        capped = [name for name, stage in report["stages"].items() if stage.get("cpu_capped")]
+        if capped:
+            print(f"[WARNING] CPU of {', '.join(capped)} was more than the process used, capped at "
+                  f"{report['cpu_seconds']:.2f}s", file=file)
+
+        if report["slowest_calls"]:
+            print(f"\n[PROFILE] {len(report['slowest_calls'])} slowest external calls", file=file)
+            for call in report["slowest_calls"]:
+                error = f"  [{call['error']}]" if call["error"] else ""
+                print(f"{call['seconds']:>8.3f}s  {call['call'][:50]:<50}  {call['stage']}{error}", file=file)
+
+        if self.stacks_file:
+            print(f"\n[PROFILE] {report['stack_samples']} stack samples written to {self.stacks_file}", file=file)
@@ -0,0 +1,470 @@
+# Import Libraries
+import asyncio, contextlib, contextvars, heapq, itertools, sqlite3, threading, time
+from datetime import datetime, timedelta, timezone
+
+# Import Files
+from Caches import CACHE_FILE
+
+INTERACTIVE = 0
+BATCH = 1
+LANES = {"interactive": INTERACTIVE, "batch": BATCH}
+
+# provider: (units per second, burst size in units, daily unit quota or None)
+# a call costs one unit unless ENDPOINT_COSTS says otherwise
+PROVIDER_LIMITS = {
+    "lastfm": (5, 5, None),
+    # spotify counts requests over a rolling 30 second window
+    "spotify": (5, 30, None),
+    # one search every second, with bursts of five
+    "youtube": (100, 500, 10000),
+    "openweather": (1, 10, None),
+    "ip-api": (0.75, 5, None),
+}
+DEFAULT_LIMIT = (10, 10, None)
+
+# (provider, endpoint): units the call costs against the provider's budget
+ENDPOINT_COSTS = {
+    ("youtube", "search.list"): 100,
+    ("youtube", "playlistItems.insert"): 50,
+    ("youtube", "playlists.insert"): 50,
+}
+
+# share of a daily quota kept back for the interactive lane
+BATCH_RESERVE = 0.2
+
+_current_lane = contextvars.ContextVar("rate_limit_lane", default=INTERACTIVE)
+
+'''
+Name: QuotaExceeded
+Purpose: Raised when a call would go over a provider's daily quota,
+rather than waiting until the quota resets.
+'''
+class QuotaExceeded(Exception):
+    def __init__(self, provider, cost, remaining):
+        super().__init__(f"{provider}: call costs {cost} units but only {remaining} are left today")
+        self.provider = provider
+        self.cost = cost
+        self.remaining = remaining
+
+'''
+Name: lane
+Parameters: name
+Returns: None
+Purpose: Context manager that runs every call made inside it in the
+"interactive" or "batch" lane. Waiting interactive calls always go
+before waiting batch calls.
+'''
+@contextlib.contextmanager
+def lane(name):
+    token = _current_lane.set(LANES[name])
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+'''
+Name: _quota_day
+Parameters: None
+Returns: day
+Purpose: Google resets daily quotas at midnight Pacific time, so
+usage is counted per Pacific day (taken as UTC-8).
+'''
+def _quota_day():
+    return (datetime.now(timezone.utc) - timedelta(hours=8)).strftime("%Y-%m-%d")
+
+'''
+Name: ProviderBudget
+Purpose: A token bucket for one provider, with an optional daily unit
+quota that is kept in the cache database so it is shared between runs.
+Callers queue by (lane, arrival) and only the head of the queue may
+take tokens, so interactive calls never wait behind batch calls. Quota
+units are reserved when a call joins the queue, so callers waiting at
+the same time can't overspend it between them.
+'''
+class ProviderBudget():
+    '''
+    Name: __init__
+    Parameters: name, rate, capacity, daily_quota=None, quota_store=None
+    Returns: None
+    Purpose: Starts with a full bucket and an empty queue.
+    '''
+    def __init__(self, name, rate, capacity, daily_quota=None, quota_store=None):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.daily_quota = daily_quota
+        self.quota_store = quota_store
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.queue = []
+        self.calls = 0
+        self.units = 0
+        self.waited = 0.0
+
+    '''
+    Name: _refill
+    Parameters: None
+    Returns: None
+    Purpose: Adds the tokens earned since the last refill.
+    '''
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    '''
+    Name: remaining_quota
+    Parameters: None
+    Returns: remaining or None
+    Purpose: Returns today's quota units that are neither used nor
+    reserved by a queued call, or None if the provider has no daily quota.
+    '''
+    def remaining_quota(self):
+        if self.daily_quota is None:
+            return None
+        return self.daily_quota - self.quota_store.used(self.name)
+
+    '''
+    Name: _reserve_quota
+    Parameters: cost, priority
+    Returns: day or None
+    Purpose: Reserves the call's units out of today's quota and returns
+    the day they were counted against, or raises QuotaExceeded if they
+    don't fit. Batch calls can't use the share kept back for interactive ones.
+    '''
+    def _reserve_quota(self, cost, priority):
+        if self.daily_quota is None:
+            return None
+        limit = self.daily_quota
+        if priority == BATCH:
+            limit -= int(self.daily_quota * BATCH_RESERVE)
+        day = self.quota_store.reserve(self.name, cost, limit)
+        if day is None:
+            raise QuotaExceeded(self.name, cost, max(limit - self.quota_store.used(self.name), 0))
+        return day
+
+    '''
+    Name: _try_take
+    Parameters: entry, cost
+    Returns: wait
+    Purpose: Takes the call's tokens if it is at the head of the queue
+    and enough have built up, returning 0. Otherwise returns roughly
+    how long to wait before trying again. Must hold the condition.
+    '''
+    def _try_take(self, entry, cost):
+        self._refill()
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            return pause
+        if self.queue[0] is not entry:
+            return 0.05
+
+        # a call costing more than the bucket holds goes once it is full
+        # and leaves the bucket in debt, so the calls after it wait longer
+        needed = min(cost, self.capacity)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+
+        heapq.heappop(self.queue)
+        self.tokens -= cost
+        self.calls += 1
+        self.units += cost
+        self.condition.notify_all()
+        return 0
+
+    '''
+    Name: _enqueue
+    Parameters: cost, sequence
+    Returns: entry
+    Purpose: Reserves the call's quota and joins the queue in the
+    current lane.
+    '''
+    def _enqueue(self, cost, sequence):
+        priority = _current_lane.get()
+        day = self._reserve_quota(cost, priority)
+        entry = [priority, sequence, cost, day]
+        heapq.heappush(self.queue, entry)
+        return entry
+
+    '''
+    Name: _leave
+    Parameters: entry
+    Returns: None
+    Purpose: Removes a call that gave up (e.g. was cancelled) from the
+    queue and gives back the quota it reserved.
+    '''
+    def _leave(self, entry):
+        if entry in self.queue:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            _, _, cost, day = entry
+            if day is not None:
+                self.quota_store.add(self.name, -cost, day)
+            self.condition.notify_all()
+
+    '''
+    Name: acquire
+    Parameters: cost, sequence
+    Returns: waited
+    Purpose: Blocks until the call may be sent and returns how long
+    it waited.
+    '''
+    def acquire(self, cost, sequence):
+        started = time.monotonic()
+        with self.condition:
+            entry = self._enqueue(cost, sequence)
+            try:
+                while True:
+                    wait = self._try_take(entry, cost)
+                    if wait == 0:
+                        break
+                    self.condition.wait(wait)
+            except BaseException:
+                self._leave(entry)
+                raise
+            waited = time.monotonic() - started
+            self.waited += waited
+        return waited
+
+    '''
+    Name: aacquire
+    Parameters: cost, sequence
+    Returns: waited
+    Purpose: The async version of acquire, sleeping on the event loop.
+    '''
+    async def aacquire(self, cost, sequence):
+        started = time.monotonic()
+        with self.condition:
+            entry = self._enqueue(cost, sequence)
+        try:
+            while True:
+                with self.condition:
+                    wait = self._try_take(entry, cost)
+                if wait == 0:
+                    break
+                await asyncio.sleep(min(wait, 0.25))
+        except BaseException:
+            with self.condition:
+                self._leave(entry)
+            raise
+        waited = time.monotonic() - started
+        with self.condition:
+            self.waited += waited
+        return waited
+
+    '''
+    Name: pause
+    Parameters: seconds
+    Returns: None
+    Purpose: Stops every call to this provider for a while, e.g. after
+    a 429 with a Retry-After header.
+    '''
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns the live state of the budget.
+    '''
+    def stats(self):
+        with self.condition:
+            self._refill()
+            waiting = {name: sum(1 for entry in self.queue if entry[0] == priority)
+                       for name, priority in LANES.items()}
+            return {
+                "tokens": round(self.tokens, 2),
+                "rate": self.rate,
+                "capacity": self.capacity,
+                "calls": self.calls,
+                "units": self.units,
+                "waited_seconds": round(self.waited, 3),
+                "waiting": waiting,
+                "paused_for": round(max(self.paused_until - time.monotonic(), 0), 2),
+                "daily_quota": self.daily_quota,
+                "remaining_quota": self.remaining_quota(),
+            }
+
+'''
+Name: QuotaStore
+Purpose: Counts quota units used per provider per day in the cache
+database, so several runs on the same day share one quota.
+'''
+class QuotaStore():
+    '''
+    Name: __init__
+    Parameters: path=CACHE_FILE
+    Returns: None
+    Purpose: Opens (or creates) the quota usage table.
+    '''
+    def __init__(self, path=CACHE_FILE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS quota_usage (
+                provider TEXT NOT NULL,
+                day TEXT NOT NULL,
+                used INTEGER NOT NULL,
+                PRIMARY KEY (provider, day)
+            )""")
+        self.conn.commit()
+
+    '''
+    Name: used
+    Parameters: provider
+    Returns: used
+    Purpose: Returns the units used or reserved by provider today.
+    '''
+    def used(self, provider):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT used FROM quota_usage WHERE provider = ? AND day = ?",
+                (provider, _quota_day())).fetchone()
+        return row[0] if row else 0
+
+    '''
+    Name: add
+    Parameters: provider, units, day=None
+    Returns: None
+    Purpose: Adds units to the provider's usage for day (today by
+    default). Negative units give back a reservation.
+    '''
+    def add(self, provider, units, day=None):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO quota_usage VALUES (?, ?, ?)
+                ON CONFLICT (provider, day) DO UPDATE SET used = used + excluded.used""",
+                (provider, day or _quota_day(), units))
+            self.conn.commit()
+
+    '''
+    Name: reserve
+    Parameters: provider, units, limit
+    Returns: day or None
+    Purpose: Adds units to today's usage only if it stays within limit,
+    in one statement so other runs sharing the database can't slip in
+    between the check and the add. Returns the day, or None if they
+    don't fit.
+    '''
+    def reserve(self, provider, units, limit):
+        if units > limit:
+            return None
+        day = _quota_day()
+        with self.lock:
+            cursor = self.conn.execute("""
+                INSERT INTO quota_usage VALUES (?, ?, ?)
+                ON CONFLICT (provider, day) DO UPDATE SET used = used + excluded.used
+                WHERE used + excluded.used <= ?""",
+                (provider, day, units, limit))
+            self.conn.commit()
+        return day if cursor.rowcount else None
+
+'''
+Name: RateLimiter
+Purpose: The scheduler every outbound API call goes through. Each
+provider has its own budget, each endpoint has a cost in units, and
+calls are let through in lane order as the budgets allow.
+'''
+class RateLimiter():
+    '''
+    Name: __init__
+    Parameters: limits=None, costs=None, quota_store=None
+    Returns: None
+    Purpose: Keeps the limits and costs; budgets are made on first use.
+    '''
+    def __init__(self, limits=None, costs=None, quota_store=None):
+        self.limits = dict(PROVIDER_LIMITS if limits is None else limits)
+        self.costs = dict(ENDPOINT_COSTS if costs is None else costs)
+        self.quota_store = quota_store
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.sequence = itertools.count()
+
+    '''
+    Name: budget
+    Parameters: provider
+    Returns: budget
+    Purpose: Returns the ProviderBudget for a provider.
+    '''
+    def budget(self, provider):
+        with self.lock:
+            budget = self.budgets.get(provider)
+            if budget is None:
+                rate, capacity, daily_quota = self.limits.get(provider, DEFAULT_LIMIT)
+                if daily_quota is not None and self.quota_store is None:
+                    self.quota_store = QuotaStore()
+                budget = ProviderBudget(provider, rate, capacity, daily_quota, self.quota_store)
+                self.budgets[provider] = budget
+            return budget
+
+    '''
+    Name: cost
+    Parameters: provider, endpoint
+    Returns: units
+    Purpose: Returns what one call to the endpoint costs.
+    '''
+    def cost(self, provider, endpoint):
+        return self.costs.get((provider, endpoint), 1)
+
+    '''
+    Name: acquire
+    Parameters: provider, endpoint=None, count=1
+    Returns: waited
+    Purpose: Blocks until count calls to the endpoint may be sent.
+    Raises QuotaExceeded if they would go over the daily quota.
+    '''
+    def acquire(self, provider, endpoint=None, count=1):
+        cost = self.cost(provider, endpoint) * count
+        return self.budget(provider).acquire(cost, next(self.sequence))
+
+    '''
+    Name: aacquire
+    Parameters: provider, endpoint=None, count=1
+    Returns: waited
+    Purpose: The async version of acquire.
+    '''
+    async def aacquire(self, provider, endpoint=None, count=1):
+        cost = self.cost(provider, endpoint) * count
+        return await self.budget(provider).aacquire(cost, next(self.sequence))
+
+    '''
+    Name: pause
+    Parameters: provider, seconds
+    Returns: None
+    Purpose: Holds back every call to a provider, e.g. after a 429.
+    '''
+    def pause(self, provider, seconds):
+        self.budget(provider).pause(seconds)
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns the live stats of every provider used so far.
+    '''
+    def stats(self):
+        with self.lock:
+            budgets = list(self.budgets.values())
+        return {budget.name: budget.stats() for budget in budgets}
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+'''
+Name: get_rate_limiter
+Parameters: None
+Returns: _limiter
+Purpose: Returns the RateLimiter shared by every client.
+'''
+def get_rate_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
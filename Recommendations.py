@@ -1,29 +1,118 @@
 from abc import ABC, abstractmethod
-import random, requests, socket
+import asyncio, random
 import datetime as dt
 from datetime import datetime, time
-import spotipy
-from oauthlib.uri_validate import userinfo
 from collections import defaultdict
-import ipapi
-import random
 
 from Auths import SpotifyAuth, YouTubeAuth, LastFMAuth
+from ArtistGraph import get_artist_graph
+from AsyncClients import AsyncSpotifyClient, get_async_http, get_async_lastfm_client, run_sync
+from Caches import amemoized, get_artist_id_cache, get_response_cache, memoized_run, normalise
+from Clients import (IP_API_URL, IPIFY_URL, OPENWEATHER_URL, LastFMError,
+                     get_lastfm_client, get_spotify_client)
+from Metrics import traced
+from Resolution import TrackResolver
+from Scoring import SCORING_MODES, PageRankScorer
 
 class BaseRecs(ABC):
     def __init__(self, api_key1, api_key2, credentials):
         self.api_key1 = api_key1
         self.api_key2 = api_key2
         self.credentials = credentials
+        # uri -> (name, artist) for the last run's tracks, passed on to exports
+        self.track_info = {}
 
     @abstractmethod
     def rec_algorithm(self, param1, param2):
         pass
 
+    @abstractmethod
+    async def arec_algorithm(self, param1, param2):
+        pass
+
     @abstractmethod
     def generate_recs(self):
         pass
 
+'''
+Name: GenreSelection
+Purpose: Holds the tracks picked so far in a genre run and the rules
+for picking more.
+'''
+class GenreSelection():
+    '''
+    Name: __init__
+    Parameters: limit
+    Returns: None
+    Purpose: Initialises the empty selection for a run of limit tracks.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.all_tracks = []
+        self.uris = []
+        self.seen_titles = set()
+        self.artist_counts = {}
+        self.max_per_artist = max(3, limit // 10)
+
+    '''
+    Name: remaining
+    Parameters: None
+    Returns: self.limit - len(self.all_tracks)
+    Purpose: How many more tracks are needed.
+    '''
+    def remaining(self):
+        return self.limit - len(self.all_tracks)
+
+    '''
+    Name: skip
+    Parameters: candidate
+    Returns: True or False
+    Purpose: A candidate is skipped if the same title and artist has
+    already been picked or the artist has hit their cap.
+    '''
+    def skip(self, candidate):
+        track_name, artist_name, _ = candidate
+        if f"{track_name} by {artist_name}" in self.seen_titles:
+            return True
+        return self.artist_counts.get(artist_name, 0) >= self.max_per_artist
+
+    '''
+    Name: accept
+    Parameters: candidate, uri
+    Returns: True or False
+    Purpose: Adds a candidate that was found on Spotify.
+    '''
+    def accept(self, candidate, uri):
+        track_name, artist_name, _ = candidate
+        if not uri:
+            return False
+        combined = f"{track_name} by {artist_name}"
+        self.uris.append(uri)
+        self.all_tracks.append(combined)
+        self.seen_titles.add(combined)
+        self.artist_counts[artist_name] = self.artist_counts.get(artist_name, 0) + 1
+        return True
+
+    '''
+    Name: top_up
+    Parameters: tracks
+    Returns: None
+    Purpose: Fills any remaining places with Last.fm tracks that
+    weren't found on Spotify.
+    '''
+    @traced("dedup")
+    def top_up(self, tracks):
+        for t in tracks:
+            track_name = t.get('name')
+            artist_name = t.get('artist', {}).get('name', '')
+            combined = f"{track_name} by {artist_name}"
+            if combined not in self.seen_titles:
+                self.all_tracks.append(combined)
+                self.uris.append(None)
+                self.seen_titles.add(combined)
+            if self.remaining() <= 0:
+                break
+
 '''
 Name: GenreRecs
 Purpose: This creates the genre recs objects in order 
@@ -33,143 +122,107 @@ Inherits from BaseRecs class.
 class GenreRecs(BaseRecs):
     '''
     Name: __init__
-    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth
+    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None
     Returns: None
     Purpose: Initialises any variables needed for any
     methods within genre recs such as api keys.
     '''
-    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth):
+    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None):
         super().__init__(api_key1, api_key2=None, credentials=None)
         self.lastfm_api_key = api_key1
+        self.lastfm = get_lastfm_client(self.lastfm_api_key)
+        self.alastfm = get_async_lastfm_client(self.lastfm_api_key)
 
+        self.sp = sp if sp is not None else get_spotify_client(spotify_auth)
+        self.asp = AsyncSpotifyClient(spotify_auth, get_async_http())
+        self.resolver = TrackResolver()
 
-        access_token = spotify_auth.get_access_token()
-        self.sp = spotipy.Spotify(auth=access_token)
+    '''
+    Name: _similar_genres_from
+    Parameters: data
+    Returns: [tag['name'] for tag in data.get('similarTags', {}).get('tag', [])]
+    Purpose: Reads the similar genre names from a tag.getSimilar response.
+    '''
+    @staticmethod
+    def _similar_genres_from(data):
+        return [tag['name'] for tag in data.get('similarTags', {}).get('tag', [])]
 
     '''
-    Name: rec_algorithm
-    Parameters: genre, limit
-    Returns: self.recommended_tracks, uris, playlist_name
-    Purpose: This is where the genre recommended songs
-    are generated. 
+    Name: aget_similar_genre
+    Parameters: genre
+    Returns: similar genre names or []
+    Purpose: Taking the genre, it generates similar genres
+    using the last.fm API.
     '''
-    def rec_algorithm(self, genre, limit):
-        '''
-        Name: get_similar_genres
-        Parameters: genre
-        Returns: [tag['name'] for tag in data.get('similarTags', {}).get('tag', [])] or []
-        Purpose: Taking the genre, it generates similar genres
-        using the last.fm API.
-        '''
-        def get_similar_genre(genre):
-            url = 'http://ws.audioscrobbler.com/2.0/'
-            params = {
-                'method': 'tag.getSimilar',
-                'tag': genre,
-                'api_key': self.lastfm_api_key,
-                'format': 'json'
-            }
-            try:
-                response = requests.get(url, params=params)
-                response.raise_for_status()
-                if response.status_code != 200:
-                    print(f"[ERROR] Status Code: {response.status_code}")
-                data = response.json()
-                return [tag['name'] for tag in data.get('similarTags', {}).get('tag', [])]
-            except Exception as e:
-                print(f"[ERROR] Exception while getting last fm genres: {e}")
-                return []
-
-        '''
-        Name: get_top_tracks_for_genre
-        Parameters: genre_tag
-        Returns: data.get('tracks', {}).get('track', []) or []
-        Purpose: For the genres, it generates the top songs for wch 
-        of these genres using Last.FM API.
-        '''
-        def get_top_tracks_for_genre(genre_tag):
-            url = 'http://ws.audioscrobbler.com/2.0/'
-            params = {
-                'method': 'tag.getTopTracks',
-                'tag': genre_tag,
-                'api_key': self.lastfm_api_key,
-                'format': 'json',
-                'limit': limit * 2,
-            }
-            try:
-                response = requests.get(url, params=params)
-                response.raise_for_status()
-                data = response.json()
-                return data.get('tracks', {}).get('track', [])
-            except Exception as e:
-                print(f"[ERROR] Exception while getting top tracks for genre: {e}")
-                return []
-
-        similar_genres = get_similar_genre(genre)
+    @traced("candidates")
+    async def aget_similar_genre(self, genre):
+        try:
+            return self._similar_genres_from(await self.alastfm.call('tag.getSimilar', tag=genre))
+        except LastFMError as e:
+            print(f"[ERROR] Exception while getting last fm genres: {e}")
+            return []
+
+    '''
+    Name: aget_top_tracks_for_genre
+    Parameters: genre_tag, limit
+    Returns: data.get('tracks', {}).get('track', []) or []
+    Purpose: For the genres, it generates the top songs for each
+    of these genres using Last.FM API.
+    '''
+    @traced("candidates")
+    async def aget_top_tracks_for_genre(self, genre_tag, limit):
+        try:
+            data = await self.alastfm.call('tag.getTopTracks', tag=genre_tag, limit=limit * 2)
+            return data.get('tracks', {}).get('track', [])
+        except LastFMError as e:
+            print(f"[ERROR] Exception while getting top tracks for genre: {e}")
+            return []
+
+    '''
+    Name: _genres_to_use
+    Parameters: genre, similar_genres
+    Returns: genres_to_use
+    Purpose: Removes similar genres that aren't real genres and
+    picks the genres the tracks will come from.
+    '''
+    def _genres_to_use(self, genre, similar_genres):
         ignore = {'music', 'songs', 'favourites', 'all', 'unknown'}
         similar_genres = [g for g in similar_genres if g not in ignore and len(g) > 2]
         print(similar_genres)
-        # weights main genre heavier than similar genres to avoid inaccurate genres
-        genres_to_use = [genre] * 2 + similar_genres[:2]
+        # main genre goes first so it fills most of the playlist
+        genres_to_use = list(dict.fromkeys([genre] + similar_genres[:2]))
         print(f"[DEBUG] Genres: {genres_to_use}")
+        return genres_to_use
 
-        all_tracks = []
-        seen_titles = set()
-        artist_counts = {}
-        uris = []
-
-        for tag in genres_to_use:
-            if len(all_tracks) >= limit:
-                break
-
-            tracks = get_top_tracks_for_genre(tag)
-            for t in tracks:
-                track_name = t.get('name')
-                artist_name = t.get('artist', {}).get('name', '')
-                combined = f"{track_name} by {artist_name}"
-                if combined in seen_titles:
-                    continue
-
-                max_per_artist = max(3, limit // 10)
-                if artist_counts.get(artist_name, 0) >= max_per_artist:
-                    continue
-
-                try:
-                    query = f"track:{track_name} artist:{artist_name}"
-                    results = self.sp.search(q=query, type='track', limit=1)
-                    items = results.get('tracks', {}).get('items', [])
-                    if items:
-                        uri = items[0].get('uri')
-                        uris.append(uri)
-                        all_tracks.append(combined)
-                        seen_titles.add(combined)
-                        artist_counts[artist_name] = artist_counts.get(artist_name, 0) + 1
-                except Exception as e:
-                    print(f"[ERROR] Couldn't fetch URI for {combined}: {e}")
-
-                if len(all_tracks) >= limit:
-                    break
-
-            if len(all_tracks) < limit:
-                print(f"[WARNING] Only found {len(all_tracks)} valid URIS, topping up with non-spotify tracks")
-                for tag in genres_to_use:
-                    if len(all_tracks) >= limit:
-                        break
-                    tracks = get_top_tracks_for_genre(tag)
-                    for t in tracks:
-                        track_name = t.get('name')
-                        artist_name = t.get('artist', {}).get('name', '')
-                        combined = f"{track_name} by {artist_name}"
-                        if combined not in seen_titles:
-                            all_tracks.append(combined)
-                            uris.append(None)
-                            seen_titles.add(combined)
-                        if len(all_tracks) >= limit:
-                            break
+    '''
+    Name: _candidates
+    Parameters: tracks
+    Returns: candidates
+    Purpose: Turns Last.fm tracks into (track, artist, query)
+    candidates for the track resolver.
+    '''
+    @staticmethod
+    def _candidates(tracks):
+        candidates = []
+        for t in tracks:
+            track_name = t.get('name')
+            artist_name = t.get('artist', {}).get('name', '')
+            query = f"track:{track_name} artist:{artist_name}"
+            candidates.append((track_name, artist_name, query))
+        return candidates
 
+    '''
+    Name: _finish
+    Parameters: genre, selection
+    Returns: self.recommended_tracks, uris, playlist_name
+    Purpose: Shuffles and prints the picked tracks.
+    '''
+    @traced("shuffle")
+    def _finish(self, genre, selection):
+        print(f"[DEBUG] URI cache: {self.resolver.cache.stats()}")
         playlist_name = f"{genre} songs"
 
-        paired = list(zip(all_tracks, uris))
+        paired = list(zip(selection.all_tracks, selection.uris))
         random.shuffle(paired)
         if paired:
             all_tracks, uris = zip(*paired)
@@ -178,6 +231,7 @@ class GenreRecs(BaseRecs):
             all_tracks, uris = [], []
 
         self.recommended_tracks = all_tracks
+        self.track_info = self.resolver.pop_resolved(uris)
         #print(f"[DEBUG] Recommended tracks: {self.recommended_tracks}")
 
         print(playlist_name)
@@ -187,6 +241,53 @@ class GenreRecs(BaseRecs):
 
         return self.recommended_tracks, uris, playlist_name
 
+    '''
+    Name: rec_algorithm
+    Parameters: genre, limit
+    Returns: self.recommended_tracks, uris, playlist_name
+    Purpose: This is where the genre recommended songs
+    are generated. It is a thin wrapper that runs arec_algorithm on
+    the shared async engine.
+    '''
+    def rec_algorithm(self, genre, limit):
+        return run_sync(self.arec_algorithm(genre, limit))
+
+    '''
+    Name: arec_algorithm
+    Parameters: genre, limit
+    Returns: self.recommended_tracks, uris, playlist_name
+    Purpose: Generates the genre recommendations. The top tracks for
+    every genre are fetched at once and Spotify searches run as
+    concurrent tasks.
+    '''
+    @traced("rec_algorithm", recommender="genre")
+    @memoized_run
+    async def arec_algorithm(self, genre, limit):
+        similar_genres = await self.aget_similar_genre(genre)
+        genres_to_use = self._genres_to_use(genre, similar_genres)
+        selection = GenreSelection(limit)
+
+        tracks_by_tag = await asyncio.gather(
+            *(self.aget_top_tracks_for_genre(tag, limit) for tag in genres_to_use))
+
+        for tracks in tracks_by_tag:
+            if selection.remaining() <= 0:
+                break
+
+            await self.resolver.aresolve_many(self.asp, self._candidates(tracks),
+                                              selection.remaining(), selection.skip,
+                                              selection.accept)
+
+        # only once every genre has been searched on Spotify
+        if selection.remaining() > 0:
+            print(f"[WARNING] Only found {len(selection.all_tracks)} valid URIS, topping up with non-spotify tracks")
+            for tracks in tracks_by_tag:
+                if selection.remaining() <= 0:
+                    break
+                selection.top_up(tracks)
+
+        return self._finish(genre, selection)
+
     '''
     Name: generate_recs
     Parameters: 
@@ -200,17 +301,13 @@ class GenreRecs(BaseRecs):
             genre = input("Enter a genre: ")
 
             def check_genre_exists(genre: str) -> bool:
-                url = "http://ws.audioscrobbler.com/2.0/"
-                params = {
-                    "method": "tag.getInfo",
-                    "tag": genre.lower(),
-                    "api_key": self.lastfm_api_key,
-                    "format": "json"
-                }
-                response = requests.get(url, params=params).json()
-
-                if "error" in response:
-                    print("[ERROR] Genre tag doesn't exist within last.fm")
+                try:
+                    response = self.lastfm.call("tag.getInfo", tag=genre.lower())
+                except LastFMError as e:
+                    if e.error_code is not None:
+                        print("[ERROR] Genre tag doesn't exist within last.fm")
+                    else:
+                        print(f"[ERROR] Couldn't check genre on last.fm: {e}")
                     return False
 
                 tag_info = response.get("tag", {})
@@ -228,14 +325,10 @@ class GenreRecs(BaseRecs):
                 print("[DEBUG] Genre doesn't exist")
 
                 def search_similar(genre: str):
-                    url = "http://ws.audioscrobbler.com/2.0/"
-                    params = {
-                        "method": "tag.search",
-                        "tag": genre.lower(),
-                        "api_key": self.lastfm_api_key,
-                        "format": "json"
-                    }
-                    response = requests.get(url, params=params).json()
+                    try:
+                        response = self.lastfm.call("tag.search", tag=genre.lower())
+                    except LastFMError:
+                        return []
 
                     if "results" in response and "tagmatches" in response["results"]:
                         matches = response["results"]["tagmatches"]["tag"]
@@ -272,55 +365,149 @@ Inherits from BaseRecs class.
 class UserRecs(BaseRecs):
     '''
     Name: __init__
-    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth
+    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None
     Returns: None
     Purpose: Initialises any variables needed to use in any of
     the user recs methods such as the api_keys.
     '''
-    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth):
+    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None):
         super().__init__(api_key1, api_key2=None, credentials=None)
         self.lastfm_api_key = api_key1
+        self.lastfm = get_lastfm_client(self.lastfm_api_key)
+        self.alastfm = get_async_lastfm_client(self.lastfm_api_key)
+
+        self.sp = sp if sp is not None else get_spotify_client(spotify_auth)
+        self.asp = AsyncSpotifyClient(spotify_auth, get_async_http())
 
-        access_token = spotify_auth.get_access_token()
-        self.sp = spotipy.Spotify(auth=access_token)
+        self.market = "US"
+        self.artist_ids = get_artist_id_cache()
+        self.cache = get_response_cache()
+        self.graph = get_artist_graph()
+        self.hops = 1
+        self.scorer = PageRankScorer(self.graph)
 
     '''
-    Name: rec_algorithm
-    Parameters: param1, param2
-    Returns: final_results, final_results_uris, playlist_name
-    Purpose: This is the main algorithm where the user recs songs
-    are generated from using Last.FM and Spotify APIs.
+    Name: aget_similar_artists
+    Parameters: top_artist
+    Returns: sim_names or None
+    Purpose: Gets the names of artists similar to top_artist from
+    the local artist graph, only asking Last.fm if the artist is
+    unseen or their edges are stale. Returns None if the request
+    failed and there are no old edges to fall back on. Stale edges
+    are fetched straight from Last.fm, skipping the response cache
+    which would return the same old data.
     '''
-    def rec_algorithm(self, param1, param2):
-        time_range = param1
+    @traced("candidates")
+    async def aget_similar_artists(self, top_artist):
+        if not self.graph.is_stale(top_artist):
+            return [name for name, _ in self.graph.similar(top_artist)]
 
-        # Temp
-        top_artist_limit = param2
-        total_tracks_limit = 30
+        try:
+            data = await amemoized(("lastfm.fetch", "artist.getsimilar", normalise(top_artist)),
+                                   self.alastfm.fetch, "artist.getsimilar", artist=top_artist)
+        except LastFMError as e:
+            print(f"[WARNING] Failed to get similar artists for {top_artist}: {e}")
+            return self._stale_similar_artists(top_artist)
 
+        return [name for name, _ in self.graph.set_similar_from_lastfm(top_artist, data)]
 
-        #print("[DEBUG] Fetching user's top artists...")
-        top_artists = self.sp.current_user_top_artists(limit=top_artist_limit, time_range=time_range)
-        top_artist_names = [artist['name'] for artist in top_artists['items']]
-        print(f"[DEBUG] Top artists: {top_artist_names}")
+    '''
+    Name: _stale_similar_artists
+    Parameters: top_artist
+    Returns: sim_names or None
+    Purpose: Falls back to the artist's old edges in the local graph
+    when Last.fm can't be reached, or None if there aren't any.
+    '''
+    def _stale_similar_artists(self, top_artist):
+        similars = self.graph.similar(top_artist)
+        return [name for name, _ in similars] if similars else None
+
+    '''
+    Name: _expand_locally
+    Parameters: top_artist_names, artist_to_similars
+    Returns: artist_to_similars
+    Purpose: When self.hops is more than 1, adds each top artist's
+    further neighbours from the local artist graph after its direct
+    similar artists. No requests are made for the extra hops.
+    '''
+    def _expand_locally(self, top_artist_names, artist_to_similars):
+        if self.hops <= 1:
+            return artist_to_similars
+
+        expanded = {}
+        for top_artist, sim_names in artist_to_similars.items():
+            further = [name for name, _ in self.graph.neighbourhood([top_artist], hops=self.hops)]
+            expanded[top_artist] = list(dict.fromkeys(
+                sim_names + [name for name in further if name not in top_artist_names]))
+        return expanded
+
+    '''
+    Name: aget_artist_id
+    Parameters: artist_name
+    Returns: artist_id or None
+    Purpose: Gets the Spotify ID of an artist, from the artist ID
+    cache if possible, otherwise by searching Spotify.
+    '''
+    async def aget_artist_id(self, artist_name):
+        artist_id, found = self.artist_ids.get(artist_name)
+        if found:
+            return artist_id
+
+        search_results = await amemoized(("spotify.artist_search", artist_name),
+                                         self.asp.search, q=artist_name, type='artist', limit=1)
+        items = search_results['artists']['items']
+        artist_id = items[0]['id'] if items else None
 
+        self.artist_ids.set(artist_name, artist_id)
+        return artist_id
+
+    '''
+    Name: aget_top_tracks
+    Parameters: artist_id
+    Returns: top_tracks
+    Purpose: Gets an artist's top tracks in self.market, cached for a
+    day per artist and market.
+    '''
+    async def aget_top_tracks(self, artist_id):
+        params = {"artist_id": artist_id, "market": self.market}
+        top_tracks, _ = self.cache.get("spotify.artist_top_tracks", params)
+        if top_tracks is None:
+            results = await amemoized(("spotify.artist_top_tracks", artist_id, self.market),
+                                      self.asp.artist_top_tracks, artist_id, country=self.market)
+            top_tracks = results['tracks']
+            self.cache.set("spotify.artist_top_tracks", params, top_tracks)
+        return top_tracks
+
+    '''
+    Name: aget_artist_top_tracks
+    Parameters: artist_name
+    Returns: top_tracks or None
+    Purpose: Finds the artist on Spotify and returns their top
+    tracks, or None if the artist couldn't be found.
+    '''
+    @traced("candidates")
+    async def aget_artist_top_tracks(self, artist_name):
+        artist_id = await self.aget_artist_id(artist_name)
+        if artist_id is None:
+            print(f"[ERROR] No artist found for search query {artist_name}")
+            return None
+        return await self.aget_top_tracks(artist_id)
+
+    '''
+    Name: _rank_similar_artists
+    Parameters: top_artist_names, artist_to_similars, top_artist_limit
+    Returns: final_similar_artists
+    Purpose: Weights every similar artist by the rank of the top
+    artists it is similar to, always keeping each top artist's
+    closest match.
+    '''
+    def _rank_similar_artists(self, top_artist_names, artist_to_similars, top_artist_limit):
         weighted_similar_artists = defaultdict(int)
-        artist_to_similars = {}
 
         for rank, top_artist in enumerate(top_artist_names):
             weight = top_artist_limit - rank  # higher rank = more weight
-            url = f"http://ws.audioscrobbler.com/2.0/?method=artist.getsimilar&artist={top_artist}&api_key={self.lastfm_api_key}&format=json"
-            response = requests.get(url)
-            if response.status_code == 200:
-                data = response.json()
-                similars = data.get("similarartists", {}).get("artist", [])
-                sim_names = [sim['name'] for sim in similars]
-                artist_to_similars[top_artist] = sim_names
-                for name in sim_names:
-                    weighted_similar_artists[name] += weight
-            elif response.status_code != 200:
-                print(f"[WARNING] Failed to get similar artists for {top_artist}")
-                continue
+            for name in artist_to_similars.get(top_artist, []):
+                weighted_similar_artists[name] += weight
 
         sorted_similars = sorted(weighted_similar_artists.items(), key=lambda x: x[1], reverse=True)
         similar_artists = [name for name, _ in sorted_similars]
@@ -343,42 +530,84 @@ class UserRecs(BaseRecs):
             print("No final similar artists found, using top artists instead.")
             final_similar_artists = top_artist_names
 
+        return final_similar_artists
+
+    '''
+    Name: _rank_by_pagerank
+    Parameters: top_artist_names, top_artist_limit
+    Returns: final_similar_artists
+    Purpose: Ranks every artist in the local graph by personalised
+    PageRank seeded with the top artists, weighted by their rank, so
+    Last.fm's match scores and artists several hops away both count.
+    '''
+    def _rank_by_pagerank(self, top_artist_names, top_artist_limit):
+        seeds = {name: top_artist_limit - rank for rank, name in enumerate(top_artist_names)}
+        ranked = self.scorer.rank(seeds, limit=top_artist_limit * 2)
+        final_similar_artists = [name for name, _ in ranked]
+
+        if not final_similar_artists:
+            print("No final similar artists found, using top artists instead.")
+            final_similar_artists = top_artist_names
+
+        return final_similar_artists
+
+    '''
+    Name: _rank
+    Parameters: scoring, top_artist_names, artist_to_similars, top_artist_limit
+    Returns: final_similar_artists
+    Purpose: Picks the similar artists with the chosen scoring mode,
+    either "rank" (weighted by top artist rank) or "pagerank".
+    '''
+    @traced("ranking")
+    def _rank(self, scoring, top_artist_names, artist_to_similars, top_artist_limit):
+        if scoring not in SCORING_MODES:
+            raise ValueError(f"Unknown scoring mode {scoring}, expected one of {SCORING_MODES}")
+        if scoring == "pagerank":
+            return self._rank_by_pagerank(top_artist_names, top_artist_limit)
+        return self._rank_similar_artists(top_artist_names, artist_to_similars, top_artist_limit)
+
+    '''
+    Name: _select_tracks
+    Parameters: final_similar_artists, top_tracks, total_tracks_limit
+    Returns: recommended_tracks
+    Purpose: Takes an even share of top tracks from each artist,
+    skipping tracks that were already picked.
+    '''
+    @traced("dedup")
+    def _select_tracks(self, final_similar_artists, top_tracks, total_tracks_limit):
         recommended_tracks = []
         seen_track_uris = set()
         tracks_per_artist = max(total_tracks_limit // len(final_similar_artists), 1)
 
-        for artist_name in final_similar_artists:
-            #print(f"[DEBUG] Searching for artist on Spotify {artist_name}")
-            search_results = self.sp.search(q=artist_name, type='artist', limit=1)
-            #print(f"[DEBUG] Spotify search result FOR {artist_name}.")
-
-            if search_results['artists']['items']:
-                artist_id = search_results['artists']['items'][0]['id']
-                #print(f"[DEBUG] Artist ID for {artist_name}: {artist_id}")
-
-                top_tracks = self.sp.artist_top_tracks(artist_id)['tracks']
-                #print(f"[DEBUG] Top tracks for {artist_name}: {top_tracks}")
+        for artist_tracks in top_tracks:
+            selected = 0
+            for track in artist_tracks or []:
+                if track['uri'] not in seen_track_uris and selected < tracks_per_artist:
+                    recommended_tracks.append(track)
+                    seen_track_uris.add(track['uri'])
+                    selected += 1
 
-                selected = 0
-                for track in top_tracks:
-                    if track['uri'] not in seen_track_uris and selected < tracks_per_artist:
-                        recommended_tracks.append(track)
-                        seen_track_uris.add(track['uri'])
-                        selected += 1
-            else:
-                print(f"[ERROR] No artist found for search query {artist_name}")
+        return recommended_tracks[:total_tracks_limit]
 
-        recommended_tracks = recommended_tracks[:total_tracks_limit]
+    '''
+    Name: _finish
+    Parameters: recommended_tracks, user_info
+    Returns: final_results, final_results_uris, playlist_name
+    Purpose: Formats and prints the picked tracks.
+    '''
+    @traced("finish")
+    def _finish(self, recommended_tracks, user_info):
         #print(f"[DEBUG] Tracks being added to recommendations: {recommended_tracks}")
 
         final_results = []
         final_results_uris = []
+        self.track_info = {}
         for track in recommended_tracks:
             artist_names = ", ".join(artist['name'] for artist in track['artists'])
             final_results.append(f"{track['name']} by {artist_names}")
             final_results_uris.append(track['uri'])
+            self.track_info[track['uri']] = (track['name'], artist_names)
 
-        user_info = self.sp.me()
         username = user_info.get('display_name', 'Unknown User')
         playlist_name = f"{username}'s playlist"
 
@@ -390,6 +619,59 @@ class UserRecs(BaseRecs):
         #print(f"[DEBUG] Final recommended tracks: {final_results}")
         return final_results, final_results_uris, playlist_name
 
+    '''
+    Name: rec_algorithm
+    Parameters: param1, param2, scoring="rank"
+    Returns: final_results, final_results_uris, playlist_name
+    Purpose: This is the main algorithm where the user recs songs
+    are generated from using Last.FM and Spotify APIs. It is a thin
+    wrapper that runs arec_algorithm on the shared async engine.
+    scoring picks how similar artists are ranked, "rank" or "pagerank".
+    '''
+    def rec_algorithm(self, param1, param2, scoring="rank"):
+        return run_sync(self.arec_algorithm(param1, param2, scoring=scoring))
+
+    '''
+    Name: arec_algorithm
+    Parameters: param1, param2, scoring="rank"
+    Returns: final_results, final_results_uris, playlist_name
+    Purpose: Generates the user recommendations, fetching the similar
+    artists for every top artist, and the top tracks for every similar
+    artist, concurrently.
+    '''
+    @traced("rec_algorithm", recommender="user")
+    @memoized_run
+    async def arec_algorithm(self, param1, param2, scoring="rank"):
+        time_range = param1
+        top_artist_limit = param2
+        total_tracks_limit = 30
+
+        top_artists, user_info = await asyncio.gather(
+            self.asp.current_user_top_artists(limit=top_artist_limit, time_range=time_range),
+            self.asp.me())
+        top_artist_names = [artist['name'] for artist in top_artists['items']]
+        print(f"[DEBUG] Top artists: {top_artist_names}")
+
+        similars = await asyncio.gather(
+            *(self.aget_similar_artists(top_artist) for top_artist in top_artist_names))
+        artist_to_similars = {
+            top_artist: sim_names
+            for top_artist, sim_names in zip(top_artist_names, similars)
+            if sim_names is not None
+        }
+        # saving writes the whole graph, so it runs off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.graph.save)
+        artist_to_similars = self._expand_locally(top_artist_names, artist_to_similars)
+
+        final_similar_artists = self._rank(
+            scoring, top_artist_names, artist_to_similars, top_artist_limit)
+
+        top_tracks = await asyncio.gather(
+            *(self.aget_artist_top_tracks(name) for name in final_similar_artists))
+        recommended_tracks = self._select_tracks(final_similar_artists, top_tracks, total_tracks_limit)
+
+        return self._finish(recommended_tracks, user_info)
+
     '''
     Name: generate_recs
     Parameters: None
@@ -412,26 +694,29 @@ Inherits from BaseRecs class.
 class SeasonRecs(BaseRecs):
     '''
     Name: __init__
-    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth
+    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None
     Returns: None
     Purpose: This initialises any variables needed for
     the seasonal recs methods to work such as api keys.
     '''
-    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth):
+    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None):
         super().__init__(api_key1, api_key2=None, credentials=None)
         self.lastfm_api_key = api_key1
+        self.lastfm = get_lastfm_client(self.lastfm_api_key)
+        self.alastfm = get_async_lastfm_client(self.lastfm_api_key)
 
-        access_token = spotify_auth.get_access_token()
-        self.sp = spotipy.Spotify(auth=access_token)
+        self.sp = sp if sp is not None else get_spotify_client(spotify_auth)
+        self.asp = AsyncSpotifyClient(spotify_auth, get_async_http())
+        self.resolver = TrackResolver()
 
     '''
-    Name: rec_algorithm
-    Parameters: param1, param2
-    Returns: recommendations, uris, playlist_name
-    Purpoose: This is the main algorithm where the 
-    seasonal recommendations are generated.
+    Name: _pick_genre
+    Parameters: None
+    Returns: random_genre, genre, descrip, tod
+    Purpose: Works out the time of day and season and picks a
+    random genre to match.
     '''
-    def rec_algorithm(self, param1, param2):
+    def _pick_genre(self):
         hour = dt.datetime.now().hour
         if 5 <= hour < 12:
             tod = "morning"
@@ -472,41 +757,45 @@ class SeasonRecs(BaseRecs):
             genre = ["classical", "trip-hop", "post-rock", "industrial", "death+metal"]
 
         random_genre = random.choice(genre)
+        return random_genre, genre, descrip, tod
 
-        url = 'http://ws.audioscrobbler.com/2.0/'
-        params = {
-            'method': 'tag.gettoptracks',
-            'tag': random_genre,
-            'api_key': self.lastfm_api_key,
-            'format': 'json',
-            'limit': 30
-        }
-        response = requests.get(url, params=params)
-
-        if response.status_code != 200:
-            print(f"[ERROR] Failed to get recommendations for {genre}")
-            print(f"Status code: {response.status_code}")
-            print(f"Response text: {response.text}")
-            return []
-
-        data = response.json()
+    '''
+    Name: _resolve_tracks
+    Parameters: data
+    Returns: recommendations, uris, candidates, accept
+    Purpose: Sets up the Spotify lookups for a tag.gettoptracks response.
+    '''
+    def _resolve_tracks(self, data):
         tracks = data.get('tracks', {}).get('track', [])
         recommendations = []
         uris = []
+
+        def accept(candidate, uri):
+            name, artist, _ = candidate
+            recommendations.append(f"{name} by {artist}")
+            if uri:
+                uris.append(uri)
+            return bool(uri)
+
+        candidates = []
         for track in tracks:
             name = track.get('name')
             artist = track.get('artist', {}).get('name')
-            recommendations.append(f"{name} by {artist}")
-            query = f"{name} {artist}"
+            candidates.append((name, artist, f"{name} {artist}"))
 
-            result = self.sp.search(q=query, type='track', limit=30)
-            #print(f"[DEBUG] Searching for track on spotify: {name} by {artist}")
-            items = result['tracks']['items']
-            if items:
-                uri = items[0]['uri']
-                uris.append(uri)
+        return recommendations, uris, candidates, accept
 
+    '''
+    Name: _finish
+    Parameters: recommendations, uris, random_genre, descrip, tod
+    Returns: recommendations, uris, playlist_name
+    Purpose: Names and prints the playlist.
+    '''
+    @traced("finish")
+    def _finish(self, recommendations, uris, random_genre, descrip, tod):
+        print(f"[DEBUG] URI cache: {self.resolver.cache.stats()}")
         playlist_name = f"{random_genre} songs on a {descrip} {tod}"
+        self.track_info = self.resolver.pop_resolved(uris)
 
         print(playlist_name)
 
@@ -515,6 +804,41 @@ class SeasonRecs(BaseRecs):
 
         return recommendations, uris, playlist_name
 
+    '''
+    Name: rec_algorithm
+    Parameters: param1, param2
+    Returns: recommendations, uris, playlist_name
+    Purpoose: This is the main algorithm where the
+    seasonal recommendations are generated. It is a thin wrapper that
+    runs arec_algorithm on the shared async engine.
+    '''
+    def rec_algorithm(self, param1, param2):
+        return run_sync(self.arec_algorithm(param1, param2))
+
+    '''
+    Name: arec_algorithm
+    Parameters: param1, param2
+    Returns: recommendations, uris, playlist_name
+    Purpose: Generates the seasonal recommendations.
+    '''
+    @traced("rec_algorithm", recommender="season")
+    @memoized_run
+    async def arec_algorithm(self, param1, param2):
+        random_genre, genre, descrip, tod = self._pick_genre()
+
+        try:
+            data = await self.alastfm.call('tag.gettoptracks', tag=random_genre, limit=30)
+        except LastFMError as e:
+            print(f"[ERROR] Failed to get recommendations for {genre}")
+            print(f"Status code: {e.status_code}")
+            print(f"Error: {e.message}")
+            return [], [], ""
+
+        recommendations, uris, candidates, accept = self._resolve_tracks(data)
+        await self.resolver.aresolve_many(self.asp, candidates, accept=accept)
+
+        return self._finish(recommendations, uris, random_genre, descrip, tod)
+
     '''
     Name: generate_recs
     Parameters: None
@@ -525,7 +849,7 @@ class SeasonRecs(BaseRecs):
     def generate_recs(self):
         recs, uris, playlist_name = self.rec_algorithm(None, None)
         return recs, uris, playlist_name
-        
+
 
 '''
 Name: WeatherRecs
@@ -536,65 +860,53 @@ Inherits from BaseRecs class.
 class WeatherRecs(BaseRecs):
     '''
     Name: __init__
-    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth
+    Parameters: api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None
     Returns: None
     Purpose: Initialises any variables needed for any weather recs
     methods to work such as multiple api keys.
     '''
-    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth):
+    def __init__(self, api_key1, api_key2, spotify_auth: SpotifyAuth, sp=None):
         super().__init__(api_key1, api_key2, credentials=None)
         self.OPEN_WEATHER_KEY = api_key1
         self.last_fm_api_key = api_key2
+        self.lastfm = get_lastfm_client(self.last_fm_api_key)
+        self.alastfm = get_async_lastfm_client(self.last_fm_api_key)
 
-        access_token = spotify_auth.get_access_token()
-        self.sp = spotipy.Spotify(auth=access_token)
+        self.sp = sp if sp is not None else get_spotify_client(spotify_auth)
+        self.asp = AsyncSpotifyClient(spotify_auth, get_async_http())
+        self.resolver = TrackResolver()
 
     '''
-    Name: rec_algorithm
-    Parameters: param1, param2
-    Returns: recommendations, uris, playlist_name
-    Purpose: This is the main algorithm where
-    all the songs will be generated based on the weather and
-    location suing multiple APIs. 
+    Name: aget_location
+    Parameters: None
+    Returns: city or None
+    Purpose: This gets the current city of the
+    user's computer using its IP address.
     '''
-    def rec_algorithm(self, param1, param2):
-        print(f"[DEBUG] Starting weather recommendations")
-
-        '''
-        Name: get_location
-        Parameters: None
-        Returns: city or None
-        Purpose: This gets the current city of the 
-        user's computer using its IP address. 
-        '''
-        def get_location():
-            ip = requests.get("https://api.ipify.org").text
-            print(f"[DEBUG] Public IP: {ip}")
-
-            url = f"http://ip-api.com/json/{ip}?fields=city"
-            response = requests.get(url)
+    @traced("location")
+    async def aget_location(self):
+        http = get_async_http()
+        _, _, ip_data = await http.get(IPIFY_URL, params={"format": "json"})
+        ip = ip_data["ip"]
+        print(f"[DEBUG] Public IP: {ip}")
 
-            if response.status_code != 200:
-                print(f"[ERROR] Failed to get location. Status code: {response.status_code}")
-                return None
+        status, _, data = await http.get(f"{IP_API_URL}{ip}", params={"fields": "city"})
 
-            data = response.json()
-            city = data['city']
-            print(f"[DEBUG] City: {city}")
-            return city
+        if status != 200:
+            print(f"[ERROR] Failed to get location. Status code: {status}")
+            return None
 
-        city = get_location()
+        city = data['city']
+        print(f"[DEBUG] City: {city}")
+        return city
 
-        country_code = "GB"
-
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city},{country_code}&appid={self.OPEN_WEATHER_KEY}"
-        response = requests.get(url)
-
-        if response.status_code != 200:
-            print(f"[ERROR] Failed to get weather data. Status code :{response.status_code}")
-            return [], [], ""
-
-        data = response.json()
+    '''
+    Name: _genres_for_weather
+    Parameters: data
+    Returns: weather, genre
+    Purpose: Picks the genres that match the current weather.
+    '''
+    def _genres_for_weather(self, data):
         weather = data['weather'][0]['main'].lower()
         #weather = ""
         detailed_weather = data['weather'][0]['description'].lower()
@@ -617,64 +929,45 @@ class WeatherRecs(BaseRecs):
             genre = genre_mapping.get(weather, ['pop'])
 
         print(f"[DEBUG] Selected genres: {genre}")
-        genre_string = ", ".join(genre)
-
-        url = 'http://ws.audioscrobbler.com/2.0/'
-        params = {
-            'method': 'tag.gettoptracks',
-            'api_key': self.last_fm_api_key,
-            'format': 'json',
-        }
-
-        recommendations = []
-        uris = []
-        tracks_per_genre = 30 // len(genre)
-
-        for single_genre in genre:
-            #print(f"[DEBUG] Fetching tracks for genre: {single_genre}")
-            params['tag'] = single_genre
-            params['limit'] = tracks_per_genre
-            response = requests.get(url, params=params)
-            if response.status_code != 200:
-                print(f"[ERROR] Failed to get tracks for genre {single_genre}")
-                continue
-
-            data = response.json()
-            tracks = data.get('tracks', {}).get('track', [])
-            if not tracks:
-                print(f"[ERROR] No tracks found for genre: {single_genre}")
-                continue
-
-            count = 0
+        return weather, genre
 
-            for track in tracks:
-                if count >= tracks_per_genre:
-                    break
+    '''
+    Name: _candidates
+    Parameters: single_genre, data
+    Returns: candidates
+    Purpose: Turns a tag.gettoptracks response into (track, artist,
+    query) candidates for the track resolver.
+    '''
+    def _candidates(self, single_genre, data):
+        tracks = data.get('tracks', {}).get('track', [])
+        if not tracks:
+            print(f"[ERROR] No tracks found for genre: {single_genre}")
 
-                name = track.get('name')
-                artist = track.get('artist', {}).get('name')
-                if not name or not artist:
-                    print(f"[WARNING] Skipping track with missing name or artist.")
-                recommendations.append(f"{name} by {artist}")
-                query = f"{name} {artist}"
-                #print(f"[DEBUG] Searching for track on spotify: {name} by {artist}")
-                result = self.sp.search(q=query, type='track', limit=5)
-                items = result.get('tracks', {}).get('items', [])
-                if items:
-                    uri = items[0]['uri']
-                    if uri not in uris:
-                        uris.append(uri)
-                        count += 1
-                        if count >= tracks_per_genre:
-                            break
+        candidates = []
+        for track in tracks:
+            name = track.get('name')
+            artist = track.get('artist', {}).get('name')
+            if not name or not artist:
+                print(f"[WARNING] Skipping track with missing name or artist.")
+            candidates.append((name, artist, f"{name} {artist}"))
+        return candidates
 
+    '''
+    Name: _finish
+    Parameters: recommendations, uris, weather
+    Returns: recommendations, uris, playlist_name
+    Purpose: Trims, shuffles and prints the recommendations.
+    '''
+    @traced("shuffle")
+    def _finish(self, recommendations, uris, weather):
+        print(f"[DEBUG] URI cache: {self.resolver.cache.stats()}")
         playlist_name = f"Songs for {weather}"
         recommendations = recommendations[:30]
         random.shuffle(recommendations)
         uris = uris[:30]
+        self.track_info = self.resolver.pop_resolved(uris)
         #print(f"[DEBUG] Final recommendations: {recommendations}")
         #print(len(recommendations))
-        genre_string = ", ".join(genre)
 
         print(playlist_name)
 
@@ -683,6 +976,73 @@ class WeatherRecs(BaseRecs):
 
         return recommendations, uris, playlist_name
 
+    '''
+    Name: rec_algorithm
+    Parameters: param1, param2
+    Returns: recommendations, uris, playlist_name
+    Purpose: This is the main algorithm where
+    all the songs will be generated based on the weather and
+    location suing multiple APIs. It is a thin wrapper that runs
+    arec_algorithm on the shared async engine.
+    '''
+    def rec_algorithm(self, param1, param2):
+        return run_sync(self.arec_algorithm(param1, param2))
+
+    '''
+    Name: arec_algorithm
+    Parameters: param1, param2
+    Returns: recommendations, uris, playlist_name
+    Purpose: Generates the weather recommendations. The top tracks for
+    every matching genre are fetched at once.
+    '''
+    @traced("rec_algorithm", recommender="weather")
+    @memoized_run
+    async def arec_algorithm(self, param1, param2):
+        print(f"[DEBUG] Starting weather recommendations")
+
+        city = await self.aget_location()
+
+        country_code = "GB"
+
+        status, _, data = await get_async_http().get(
+            OPENWEATHER_URL + "weather",
+            params={"q": f"{city},{country_code}", "appid": self.OPEN_WEATHER_KEY})
+
+        if status != 200:
+            print(f"[ERROR] Failed to get weather data. Status code :{status}")
+            return [], [], ""
+
+        weather, genre = self._genres_for_weather(data)
+
+        recommendations = []
+        uris = []
+        tracks_per_genre = 30 // len(genre)
+
+        def accept(candidate, uri):
+            name, artist, _ = candidate
+            recommendations.append(f"{name} by {artist}")
+            if uri and uri not in uris:
+                uris.append(uri)
+                return True
+            return False
+
+        responses = await asyncio.gather(
+            *(self.alastfm.call('tag.gettoptracks', tag=single_genre, limit=tracks_per_genre)
+              for single_genre in genre),
+            return_exceptions=True)
+
+        for single_genre, data in zip(genre, responses):
+            if isinstance(data, LastFMError):
+                print(f"[ERROR] Failed to get tracks for genre {single_genre}: {data}")
+                continue
+            if isinstance(data, BaseException):
+                raise data
+
+            candidates = self._candidates(single_genre, data)
+            await self.resolver.aresolve_many(self.asp, candidates, tracks_per_genre, accept=accept)
+
+        return self._finish(recommendations, uris, weather)
+
     '''
     Name: generate_recs
     Parameters: None
@@ -693,4 +1053,3 @@ class WeatherRecs(BaseRecs):
     def generate_recs(self):
         recs, uris, playlist_name = self.rec_algorithm(None, None)
         return recs, uris, playlist_name
-
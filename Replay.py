@@ -0,0 +1,525 @@
+# Import Libraries
+import argparse, base64, hashlib, json, os, random, re, subprocess, sys, tempfile, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import requests
+
+# provider: (environment variable read by the clients, real base URL)
+UPSTREAMS = {
+    "lastfm": ("LASTFM_URL", "http://ws.audioscrobbler.com/2.0/"),
+    "spotify": ("SPOTIFY_API_URL", "https://api.spotify.com/v1/"),
+    "spotify-accounts": ("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com/"),
+    "youtube": ("YOUTUBE_API_URL", "https://youtube.googleapis.com/"),
+    "openweather": ("OPENWEATHER_URL", "http://api.openweathermap.org/data/2.5/"),
+    "ipify": ("IPIFY_URL", "https://api.ipify.org/"),
+    "ip-api": ("IP_API_URL", "http://ip-api.com/json/"),
+}
+
+# left out of request matching and never written to a cassette
+REDACTED_PARAMS = {"api_key", "appid", "key", "client_id", "client_secret", "code", "refresh_token"}
+REDACTED_FIELDS = {"access_token", "refresh_token"}
+# response headers worth replaying
+KEPT_HEADERS = {"content-type", "retry-after", "etag"}
+# request headers that shouldn't be passed on when recording
+DROPPED_HEADERS = {"host", "content-length", "accept-encoding", "connection"}
+
+BASE_URL_MARKER = "{{base_url}}"
+
+'''
+Name: _redact
+Parameters: value
+Returns: value
+Purpose: Replaces tokens in a decoded JSON response so recorded
+cassettes don't hold working credentials.
+'''
+def _redact(value):
+    if isinstance(value, dict):
+        return {k: "replay-token" if k in REDACTED_FIELDS else _redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact(v) for v in value]
+    return value
+
+'''
+Name: _body_key
+Parameters: body, content_type
+Returns: key
+Purpose: Returns the part of a request body used to match it to a
+recording. Form and JSON bodies are compared by their fields (minus
+secrets); YouTube batch bodies have their random boundary, Content-ID
+prefix and auth headers stripped first.
+'''
+def _body_key(body, content_type):
+    if not body:
+        return ""
+    text = body.decode("utf-8", "replace")
+    if "x-www-form-urlencoded" in content_type:
+        return sorted((k, v) for k, v in parse_qsl(text, keep_blank_values=True)
+                      if k not in REDACTED_PARAMS)
+    if "json" in content_type:
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    if "multipart" in content_type:
+        text = re.sub(r"=+\d+==", "", text)
+        text = re.sub(r"<[^<>+]+\+", "<+", text)
+        text = re.sub(r"(?im)^authorization: .*$", "", text)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+'''
+Name: _content_id_base
+Parameters: body
+Returns: base or None
+Purpose: Returns the random Content-ID prefix of a batch request.
+'''
+def _content_id_base(body):
+    match = re.search(rb"Content-ID: <([^<>+]+)\+", body or b"")
+    return match.group(1).decode() if match else None
+
+'''
+Name: endpoint_name
+Parameters: provider, path, query
+Returns: name
+Purpose: Names the endpoint a request went to for call counting.
+Last.fm is counted by its method parameter. Elsewhere, path segments
+that look like IDs (8+ characters with a digit in them) are collapsed
+so every track lookup counts as the same endpoint.
+'''
+def endpoint_name(provider, path, query):
+    if provider == "lastfm":
+        return dict(query).get("method", path)
+    return re.sub(r"/(?=[^/]*\d)[^/]{8,}", "/{id}", path.rstrip("/")) or "/"
+
+'''
+Name: StandInServer
+Purpose: A local HTTP server that takes the place of one external API.
+In record mode it passes every request on to the real API and saves
+the response to a cassette. In replay mode it answers from the
+cassette instead, optionally with added latency, jitter, 429s and
+5xx errors so retries and rate limiting can be exercised offline.
+'''
+class StandInServer():
+    '''
+    Name: __init__
+    Parameters: provider, cassette_path, mode="replay", latency=0.0, jitter=0.0,
+    throttle_rate=0.0, error_rate=0.0, retry_after=1, seed=None, port=0
+    Returns: None
+    Purpose: Loads the cassette (if there is one) and sets up the
+    fault settings. The server isn't started until start().
+    '''
+    def __init__(self, provider, cassette_path, mode="replay", latency=0.0, jitter=0.0,
+                 throttle_rate=0.0, error_rate=0.0, retry_after=1, seed=None, port=0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown mode {mode!r}")
+        self.provider = provider
+        self.upstream = UPSTREAMS[provider][1]
+        self.cassette_path = cassette_path
+        self.mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.port = port
+        self.lock = threading.Lock()
+        self.server = None
+        self.session = requests.Session()
+
+        self.interactions = []
+        self.by_key = {}
+        self.reset()
+        if mode == "replay" and os.path.exists(cassette_path):
+            self.load()
+
+    '''
+    Name: reset
+    Parameters: None
+    Returns: None
+    Purpose: Clears the counters and starts every request's replay from
+    its first recording again, so repeated runs see the same responses.
+    '''
+    def reset(self):
+        with self.lock:
+            self.cursors = {}
+            self.endpoints = Counter()
+            self.counts = {"requests": 0, "recorded": 0, "replayed": 0, "misses": 0,
+                           "throttled": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0}
+
+    '''
+    Name: url
+    Parameters: None
+    Returns: url
+    Purpose: The base URL the clients should use instead of the real one.
+    '''
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/"
+
+    '''
+    Name: load
+    Parameters: None
+    Returns: None
+    Purpose: Reads the cassette and indexes its interactions by request.
+    '''
+    def load(self):
+        with open(self.cassette_path, encoding="utf-8") as f:
+            self.interactions = json.load(f)["interactions"]
+        for interaction in self.interactions:
+            self.by_key.setdefault(interaction["key"], []).append(interaction)
+
+    '''
+    Name: save
+    Parameters: None
+    Returns: None
+    Purpose: Writes the recorded interactions to the cassette.
+    '''
+    def save(self):
+        if self.mode != "record":
+            return
+        os.makedirs(os.path.dirname(self.cassette_path) or ".", exist_ok=True)
+        temp_path = self.cassette_path + ".tmp"
+        with self.lock:
+            data = {"provider": self.provider, "upstream": self.upstream,
+                    "interactions": list(self.interactions)}
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+        os.replace(temp_path, self.cassette_path)
+
+    '''
+    Name: start
+    Parameters: None
+    Returns: None
+    Purpose: Starts serving on a background thread.
+    '''
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, headers, payload = stand_in.handle(self.command, self.path, dict(self.headers), body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True,
+                         name=f"stand-in-{self.provider}").start()
+
+    '''
+    Name: stop
+    Parameters: None
+    Returns: None
+    Purpose: Stops the server and saves the cassette when recording.
+    '''
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.save()
+
+    '''
+    Name: handle
+    Parameters: method, path, headers, body
+    Returns: status, headers, payload
+    Purpose: Answers one request by recording or replaying it.
+    '''
+    def handle(self, method, path, headers, body):
+        headers = {name.lower(): value for name, value in headers.items()}
+        parts = urlsplit(path)
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                       if k not in REDACTED_PARAMS)
+        key = json.dumps([method, parts.path, query,
+                          _body_key(body, headers.get("content-type", ""))])
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["bytes_received"] += len(body)
+            self.endpoints[f"{method} {endpoint_name(self.provider, parts.path, query)}"] += 1
+
+        if self.mode == "record":
+            status, response_headers, payload = self._record(method, path, headers, body, key)
+        else:
+            status, response_headers, payload = self._replay(key, body)
+        with self.lock:
+            self.counts["bytes_sent"] += len(payload)
+        return status, response_headers, payload
+
+    '''
+    Name: _record
+    Parameters: method, path, headers, body, key
+    Returns: status, headers, payload
+    Purpose: Sends the request to the real API and keeps the response.
+    Links back to the real API in the response (like Spotify's "next"
+    URLs) are pointed at this server so paging stays recorded too.
+    '''
+    def _record(self, method, path, headers, body, key):
+        forward = {name: value for name, value in headers.items() if name not in DROPPED_HEADERS}
+        try:
+            response = self.session.request(method, self.upstream + path.lstrip("/"), headers=forward,
+                                            data=body or None, timeout=30, allow_redirects=False)
+        except requests.RequestException as e:
+            print(f"[ERROR] {self.provider} upstream request failed: {e}")
+            return 502, {"Content-Type": "application/json"}, json.dumps({"error": str(e)}).encode()
+
+        response_headers = {name: value for name, value in response.headers.items()
+                            if name.lower() in KEPT_HEADERS}
+        content = response.content
+        stored = {"encoding": "base64", "body": base64.b64encode(content).decode()}
+        try:
+            text = content.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+        else:
+            if "json" in response.headers.get("Content-Type", ""):
+                try:
+                    text = json.dumps(_redact(json.loads(text)))
+                except ValueError:
+                    pass
+            text = text.replace(self.upstream, BASE_URL_MARKER)
+            stored = {"encoding": "text", "body": text}
+            content = text.replace(BASE_URL_MARKER, self.url).encode("utf-8")
+
+        interaction = {
+            "key": key,
+            "method": method,
+            "path": urlsplit(path).path,
+            "status": response.status_code,
+            "headers": response_headers,
+            "content_id_base": _content_id_base(body),
+            **stored,
+        }
+        with self.lock:
+            self.interactions.append(interaction)
+            self.counts["recorded"] += 1
+        return response.status_code, response_headers, content
+
+    '''
+    Name: _replay
+    Parameters: key, body
+    Returns: status, headers, payload
+    Purpose: Answers from the cassette after the configured delay. Each
+    request gets its recordings in the order they were made, and the
+    last one is repeated once they run out. Requests that were never
+    recorded get a 404.
+    '''
+    def _replay(self, key, body):
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = self.random.random()
+        if roll < self.throttle_rate:
+            with self.lock:
+                self.counts["throttled"] += 1
+            return 429, {"Content-Type": "application/json", "Retry-After": str(self.retry_after)}, \
+                json.dumps({"error": {"status": 429, "message": "Too many requests"}}).encode()
+        if roll < self.throttle_rate + self.error_rate:
+            with self.lock:
+                self.counts["errors"] += 1
+            return 503, {"Content-Type": "application/json"}, \
+                json.dumps({"error": {"status": 503, "message": "Service unavailable"}}).encode()
+
+        with self.lock:
+            recordings = self.by_key.get(key)
+            if not recordings:
+                self.counts["misses"] += 1
+            else:
+                cursor = self.cursors.get(key, 0)
+                self.cursors[key] = cursor + 1
+                interaction = recordings[min(cursor, len(recordings) - 1)]
+                self.counts["replayed"] += 1
+        if not recordings:
+            print(f"[WARNING] No {self.provider} recording for {key}")
+            return 404, {"Content-Type": "application/json"}, \
+                json.dumps({"error": {"status": 404, "message": "Not recorded"}}).encode()
+
+        if interaction["encoding"] == "text":
+            text = interaction["body"].replace(BASE_URL_MARKER, self.url)
+            recorded_base, base = interaction.get("content_id_base"), _content_id_base(body)
+            if recorded_base and base:
+                text = text.replace(recorded_base, base)
+            payload = text.encode("utf-8")
+        else:
+            payload = base64.b64decode(interaction["body"])
+        return interaction["status"], dict(interaction["headers"]), payload
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns this server's request counters, including calls
+    per endpoint.
+    '''
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, endpoints=dict(self.endpoints))
+
+'''
+Name: StandIns
+Purpose: Starts one StandInServer per provider against a cassette
+directory and gives back the environment variables that point the
+clients at them. The base URLs are read when Clients.py, Auths.py and
+APIs.py are imported, so either run the program as a child process
+with environ() or enter this before importing them.
+'''
+class StandIns():
+    '''
+    Name: __init__
+    Parameters: cassette_dir, mode="replay", providers=None, **options
+    Returns: None
+    Purpose: Creates the servers. options are passed to each one.
+    '''
+    def __init__(self, cassette_dir, mode="replay", providers=None, **options):
+        self.cassette_dir = cassette_dir
+        self.servers = {
+            provider: StandInServer(provider, os.path.join(cassette_dir, provider + ".json"),
+                                    mode=mode, **options)
+            for provider in (providers or UPSTREAMS)
+        }
+        self._saved_environ = {}
+
+    '''
+    Name: start
+    Parameters: None
+    Returns: self
+    Purpose: Starts every server.
+    '''
+    def start(self):
+        for server in self.servers.values():
+            server.start()
+        return self
+
+    '''
+    Name: stop
+    Parameters: None
+    Returns: None
+    Purpose: Stops every server, saving cassettes when recording.
+    '''
+    def stop(self):
+        for server in self.servers.values():
+            server.stop()
+
+    '''
+    Name: environ
+    Parameters: None
+    Returns: env
+    Purpose: Returns the base URL environment variables for the servers.
+    '''
+    def environ(self):
+        return {UPSTREAMS[provider][0]: server.url for provider, server in self.servers.items()}
+
+    '''
+    Name: stats
+    Parameters: None
+    Returns: stats
+    Purpose: Returns each server's request counters.
+    '''
+    def stats(self):
+        return {provider: server.stats() for provider, server in self.servers.items()}
+
+    '''
+    Name: reset
+    Parameters: None
+    Returns: None
+    Purpose: Resets every server's counters and replay position.
+    '''
+    def reset(self):
+        for server in self.servers.values():
+            server.reset()
+
+    def __enter__(self):
+        self.start()
+        env = self.environ()
+        self._saved_environ = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        return self
+
+    def __exit__(self, *exc):
+        for name, value in self._saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.stop()
+
+'''
+Name: main
+Parameters: argv=None
+Returns: None
+Purpose: Command line entry point. Runs a command against the stand-in
+servers, e.g.
+"python Replay.py record cassettes/rock -- python Batch.py jobs.jsonl"
+"python Replay.py replay cassettes/rock --latency 0.05 --throttle-rate 0.05 -- python Batch.py jobs.jsonl"
+With no command the servers run until Ctrl-C and the variables to
+export are printed.
+'''
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    command = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, command = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description="Record or replay the external APIs on local servers.")
+    parser.add_argument("mode", choices=("record", "replay"))
+    parser.add_argument("cassette_dir")
+    parser.add_argument("--providers", nargs="+", choices=sorted(UPSTREAMS))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each replayed response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds on top of latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    # start from empty local caches so every run makes the same requests
+    parser.add_argument("--warm", action="store_true", help="keep using the normal cache and artist graph files")
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.mode == "replay":
+        options = {"latency": args.latency, "jitter": args.jitter, "throttle_rate": args.throttle_rate,
+                   "error_rate": args.error_rate, "retry_after": args.retry_after, "seed": args.seed}
+
+    stand_ins = StandIns(args.cassette_dir, args.mode, args.providers, **options).start()
+    env = stand_ins.environ()
+    with tempfile.TemporaryDirectory(prefix="songrec-replay-") as scratch:
+        if not args.warm:
+            env["SONGREC_CACHE_FILE"] = os.path.join(scratch, "songrec_cache.db")
+            env["ARTIST_GRAPH_FILE"] = os.path.join(scratch, "artist_graph.npz")
+
+        returncode = 0
+        try:
+            if command:
+                returncode = subprocess.call(command, env=dict(os.environ, **env))
+            else:
+                for name, value in env.items():
+                    print(f"export {name}={value}")
+                print("[INFO] Serving, press Ctrl-C to stop", file=sys.stderr)
+                while True:
+                    time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stand_ins.stop()
+
+    print(json.dumps(stand_ins.stats(), indent=1), file=sys.stderr)
+    sys.exit(returncode)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# Import Libraries
+import asyncio, threading, weakref
+from collections import deque
+
+# Import Files
+from Caches import amemoized, get_resolution_cache, normalise
+from Metrics import traced
+
+# Spotify searches in flight at once across every TrackResolver
+MAX_SEARCHES = 8
+
+'''
+Name: query_style
+Parameters: query
+Returns: style
+Purpose: Returns "strict" for the default track:/artist: search and
+"loose" for a free text one. They are cached apart because a loose
+search can find a track a strict one missed.
+'''
+def query_style(query):
+    if query is None or query.startswith("track:"):
+        return "strict"
+    return "loose"
+
+'''
+Name: TrackResolver
+Purpose: Turns Last.fm (track, artist) pairs into Spotify track
+URIs, checking the shared resolution cache before searching Spotify.
+Searches run concurrently, bounded by the search slots every resolver
+on the loop shares.
+'''
+class TrackResolver():
+    '''
+    Name: __init__
+    Parameters: cache=None, max_workers=8
+    Returns: None
+    Purpose: Keeps the resolution cache, which defaults to the cache
+    shared by every recommender. max_workers is how many candidates one
+    aresolve_many looks ahead; how many searches actually run at once
+    is capped by get_search_slots.
+    '''
+    def __init__(self, cache=None, max_workers=8):
+        self.cache = cache if cache is not None else get_resolution_cache()
+        self.max_workers = max_workers
+        # uri -> (name, artist) for the tracks resolved this run, so exports don't have to look them up
+        self.resolved = {}
+
+    '''
+    Name: pop_resolved
+    Parameters: uris
+    Returns: track_info
+    Purpose: Returns uri -> (name, artist) for the given URIs and
+    forgets everything resolved so far, so a long running process
+    doesn't keep every track it ever resolved.
+    '''
+    def pop_resolved(self, uris):
+        track_info = {uri: self.resolved[uri] for uri in uris if uri in self.resolved}
+        self.resolved = {}
+        return track_info
+
+    '''
+    Name: aresolve
+    Parameters: asp, name, artist, query=None
+    Returns: uri or None
+    Purpose: Returns the URI of the first Spotify search result for
+    the track, or None if there isn't one, searching with an
+    AsyncSpotifyClient. Both outcomes are cached, while search errors
+    are raised and not cached. 429s are already retried by AsyncHTTP.
+    '''
+    async def aresolve(self, asp, name, artist, query=None):
+        key = ("spotify.track", query_style(query), normalise(name), normalise(artist))
+        return await amemoized(key, self._aresolve, asp, name, artist, query)
+
+    '''
+    Name: _aresolve
+    Parameters: asp, name, artist, query
+    Returns: uri or None
+    Purpose: Checks the resolution cache, then searches Spotify.
+    '''
+    async def _aresolve(self, asp, name, artist, query):
+        style = query_style(query)
+        uri, found = self.cache.get(name, artist, style)
+        if found:
+            return uri
+
+        if query is None:
+            query = f"track:{name} artist:{artist}"
+        async with get_search_slots():
+            results = await asp.search(q=query, type='track', limit=1)
+        items = results.get('tracks', {}).get('items', [])
+        uri = items[0].get('uri') if items else None
+
+        self.cache.set(name, artist, uri, style)
+        return uri
+
+    '''
+    Name: aresolve_many
+    Parameters: asp, candidates, limit=None, skip=None, accept=None
+    Returns: accepted
+    Purpose: Resolves (name, artist, query) candidates concurrently but
+    hands the results to accept(candidate, uri) strictly in candidate
+    order, so the caller's dedup and per-artist caps behave exactly as
+    in a serial loop. skip(candidate) is checked before a search is
+    issued and again before accept. accept returns True when the track
+    counts towards limit (by default any found URI counts), and no more
+    searches are issued once limit is reached. Searches run as tasks on
+    the event loop, at most max_workers ahead, and returns how many
+    candidates were accepted.
+    '''
+    @traced("resolution")
+    async def aresolve_many(self, asp, candidates, limit=None, skip=None, accept=None):
+        window = deque()
+        candidates = iter(candidates)
+        exhausted = False
+        accepted = 0
+
+        while True:
+            while (not exhausted and len(window) < self.max_workers
+                   and (limit is None or accepted < limit)):
+                candidate = next(candidates, None)
+                if candidate is None:
+                    exhausted = True
+                    break
+                if skip and skip(candidate):
+                    continue
+                window.append((candidate, asyncio.ensure_future(self.aresolve(asp, *candidate))))
+
+            if not window:
+                break
+
+            candidate, task = window.popleft()
+            if skip and skip(candidate):
+                task.cancel()
+                continue
+
+            try:
+                uri = await task
+            except Exception as e:
+                print(f"[ERROR] Couldn't fetch URI for {candidate[0]} by {candidate[1]}: {e}")
+                uri = None
+
+            if uri is not None:
+                self.resolved[uri] = (candidate[0], candidate[1])
+            counted = accept(candidate, uri) if accept else uri is not None
+            if counted:
+                accepted += 1
+
+            if limit is not None and accepted >= limit:
+                for _, pending in window:
+                    pending.cancel()
+                break
+
+        return accepted
+
+_search_slots = weakref.WeakKeyDictionary()
+_search_slots_lock = threading.Lock()
+
+'''
+Name: get_search_slots
+Parameters: None
+Returns: semaphore
+Purpose: Returns the running loop's semaphore that caps Spotify
+searches in flight at MAX_SEARCHES, however many recommenders are
+resolving tracks at once. asyncio semaphores belong to one loop, so
+each loop gets its own.
+'''
+def get_search_slots():
+    loop = asyncio.get_running_loop()
+    with _search_slots_lock:
+        slots = _search_slots.get(loop)
+        if slots is None:
+            slots = _search_slots[loop] = asyncio.Semaphore(MAX_SEARCHES)
+        return slots
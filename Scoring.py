@@ -0,0 +1,122 @@
+# Import Libraries
+import threading
+import numpy as np
+from scipy import sparse
+
+# Import Files
+from Caches import normalise
+
+SCORING_MODES = ("rank", "pagerank")
+
+'''
+Name: transition_matrix
+Parameters: indptr, indices, weights
+Returns: transition, dangling
+Purpose: Builds the column-stochastic random walk matrix from the
+graph's CSR arrays. Each artist's out-edges are scaled by their match
+weights so they sum to 1. dangling marks artists with no out-edges.
+'''
+def transition_matrix(indptr, indices, weights):
+    count = len(indptr) - 1
+    adjacency = sparse.csr_matrix(
+        (weights.astype(np.float64), indices, indptr), shape=(count, count))
+    out_weight = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = np.divide(1.0, out_weight, out=np.zeros_like(out_weight), where=out_weight > 0)
+    transition = (sparse.diags(scale) @ adjacency).T.tocsr()
+    return transition, out_weight == 0
+
+'''
+Name: personalized_pagerank
+Parameters: transition, dangling, restart, alpha=0.85, tol=1e-6, max_iter=100
+Returns: scores
+Purpose: Random walk with restart. At each step the walker follows a
+similar-artist edge with probability alpha, or jumps back to a seed
+artist (picked from the restart vector) otherwise. Walkers that reach
+an artist with no edges also jump back to the seeds.
+'''
+def personalized_pagerank(transition, dangling, restart, alpha=0.85, tol=1e-6, max_iter=100):
+    restart = restart / restart.sum()
+    scores = restart.copy()
+    for _ in range(max_iter):
+        dangling_mass = scores[dangling].sum()
+        updated = alpha * (transition @ scores + dangling_mass * restart) + (1 - alpha) * restart
+        converged = np.abs(updated - scores).sum() < tol
+        scores = updated
+        if converged:
+            break
+    return scores
+
+'''
+Name: PageRankScorer
+Purpose: Scores every artist in an ArtistGraph by personalised
+PageRank from a set of weighted seed artists. The sparse matrix is
+only rebuilt when the graph has changed since the last call.
+'''
+class PageRankScorer():
+    '''
+    Name: __init__
+    Parameters: graph, alpha=0.85, tol=1e-6, max_iter=100
+    Returns: None
+    Purpose: Keeps the graph and the random walk settings.
+    '''
+    def __init__(self, graph, alpha=0.85, tol=1e-6, max_iter=100):
+        self.graph = graph
+        self.alpha = alpha
+        self.tol = tol
+        self.max_iter = max_iter
+        self.lock = threading.Lock()
+        self._version = None
+        self._names = []
+        self._index = {}
+        self._transition = None
+        self._dangling = None
+
+    '''
+    Name: _matrix
+    Parameters: None
+    Returns: names, index, transition, dangling
+    Purpose: Returns the transition matrix for the current graph,
+    rebuilding it if the graph has changed.
+    '''
+    def _matrix(self):
+        with self.lock:
+            if self._version != self.graph.version:
+                version, names, indptr, indices, weights = self.graph.snapshot()
+                self._transition, self._dangling = transition_matrix(indptr, indices, weights)
+                self._names = names
+                self._index = {normalise(name): i for i, name in enumerate(names)}
+                self._version = version
+            return self._names, self._index, self._transition, self._dangling
+
+    '''
+    Name: rank
+    Parameters: seed_weights, limit, exclude=()
+    Returns: [(name, score)]
+    Purpose: Returns the limit highest scoring artists for the seeds,
+    given as {artist name: weight}. Seeds and anything in exclude are
+    left out of the results.
+    '''
+    def rank(self, seed_weights, limit, exclude=()):
+        names, index, transition, dangling = self._matrix()
+
+        restart = np.zeros(len(names))
+        for name, weight in seed_weights.items():
+            i = index.get(normalise(name))
+            if i is not None:
+                restart[i] += weight
+        if not restart.any():
+            return []
+
+        scores = personalized_pagerank(transition, dangling, restart,
+                                       self.alpha, self.tol, self.max_iter)
+        for name in list(seed_weights) + list(exclude):
+            i = index.get(normalise(name))
+            if i is not None:
+                scores[i] = 0
+
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return []
+        top = np.argpartition(scores, -limit)[-limit:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(names[i], float(scores[i])) for i in top if scores[i] > 0]
@@ -0,0 +1,411 @@
+# Import Libraries
+import argparse, threading, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import Flask, Response, jsonify, request
+
+# Import Files
+from Auths import SpotifyAuthError, YouTubeAuthError
+from Batch import EXPORTS, RECOMMENDERS, BatchRunner, JobError
+from Metrics import get_metrics
+from RateLimits import QuotaExceeded, get_rate_limiter
+from Scoring import SCORING_MODES
+
+# endpoint: seconds a response is reused for (0 means never cached)
+ENDPOINT_TTLS = {
+    "genre": 10 * 60,
+    "user": 30 * 60,
+    "season": 60 * 60,
+    "weather": 10 * 60,
+    "album": 0,
+}
+REQUEST_TIMEOUT = 120
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+# same bounds as the CLI prompts, Spotify returns at most 50 items a page
+MAX_LIMIT = 49
+
+'''
+Name: EndpointCache
+Purpose: Keeps each endpoint's recent responses in memory, keyed by
+the request parameters, for that endpoint's TTL. Identical requests
+that arrive while the first one is still running wait for its result
+instead of running the recommender again.
+'''
+class EndpointCache():
+    '''
+    Name: __init__
+    Parameters: ttls=ENDPOINT_TTLS, maxsize=256
+    Returns: None
+    Purpose: Creates the empty cache.
+    '''
+    def __init__(self, ttls=ENDPOINT_TTLS, maxsize=256):
+        self.ttls = ttls
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    '''
+    Name: get_or_submit
+    Parameters: endpoint, params, executor, fn, *args
+    Returns: future, cached
+    Purpose: Returns the cached or in-flight future for these params,
+    or submits fn to the executor if there isn't one. cached is True
+    when no new work was started.
+    '''
+    def get_or_submit(self, endpoint, params, executor, fn, *args):
+        ttl = self.ttls.get(endpoint, 0)
+        if ttl <= 0:
+            return executor.submit(fn, *args), False
+
+        key = (endpoint, tuple(sorted(params.items())))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                future, expires_at = entry
+                if not future.done() or now < expires_at:
+                    return future, True
+
+            future = executor.submit(fn, *args)
+            self.entries[key] = (future, now + ttl)
+            if len(self.entries) > self.maxsize:
+                self._evict(now)
+
+        # failed requests aren't kept, so the next one tries again
+        future.add_done_callback(lambda f: self._drop_failed(key, f))
+        return future, False
+
+    '''
+    Name: _drop_failed
+    Parameters: key, future
+    Returns: None
+    Purpose: Removes a finished future from the cache if it raised.
+    '''
+    def _drop_failed(self, key, future):
+        if future.exception() is None:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is future:
+                del self.entries[key]
+
+    '''
+    Name: _evict
+    Parameters: now
+    Returns: None
+    Purpose: Drops expired entries, then the oldest finished ones until
+    the cache is back under maxsize. Called with the lock held.
+    '''
+    def _evict(self, now):
+        for key, (future, expires_at) in list(self.entries.items()):
+            if future.done() and expires_at <= now:
+                del self.entries[key]
+        for key, (future, _) in list(self.entries.items()):
+            if len(self.entries) <= self.maxsize:
+                break
+            if future.done():
+                del self.entries[key]
+
+    '''
+    Name: clear
+    Parameters: endpoint=None
+    Returns: None
+    Purpose: Forgets every cached response, or just one endpoint's.
+    '''
+    def clear(self, endpoint=None):
+        with self.lock:
+            for key in list(self.entries):
+                if endpoint is None or key[0] == endpoint:
+                    del self.entries[key]
+
+    '''
+    Name: size
+    Parameters: None
+    Returns: size
+    Purpose: Returns how many responses are cached or in flight.
+    '''
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+'''
+Name: RecommendationService
+Purpose: Holds everything the HTTP service shares between requests:
+the BatchRunner (so auth, clients and recommenders are only created
+once), the worker pool the recommenders run on, the response cache and
+the request counters shown on /metrics.
+'''
+class RecommendationService():
+    '''
+    Name: __init__
+    Parameters: workers=4, runner=None, ttls=ENDPOINT_TTLS
+    Returns: None
+    Purpose: Authenticates, builds the shared clients and builds every
+    worker thread's recommenders up front so no request has to. The
+    YouTube API is still only built on the first YouTube export.
+    '''
+    def __init__(self, workers=4, runner=None, ttls=ENDPOINT_TTLS):
+        self.runner = runner if runner is not None else BatchRunner(workers=workers)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="service")
+        self.cache = EndpointCache(ttls)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self._warm_up()
+
+    '''
+    Name: _warm_up
+    Parameters: None
+    Returns: None
+    Purpose: Builds each worker thread's recommenders, since the runner
+    keeps one set per thread.
+    '''
+    def _warm_up(self):
+        barrier = threading.Barrier(self.workers)
+
+        def build():
+            # every task waits for the others, so each one gets its own thread
+            barrier.wait()
+            for kind in RECOMMENDERS:
+                self.runner.recommender(kind)
+
+        for future in [self.executor.submit(build) for _ in range(self.workers)]:
+            future.result()
+
+    '''
+    Name: _count
+    Parameters: endpoint, seconds, cached, error=False
+    Returns: None
+    Purpose: Updates an endpoint's request counters.
+    '''
+    def _count(self, endpoint, seconds, cached, error=False):
+        with self.lock:
+            counter = self.counters.setdefault(endpoint, {
+                "requests": 0, "errors": 0, "cache_hits": 0,
+                "total_seconds": 0.0, "max_seconds": 0.0,
+            })
+            counter["requests"] += 1
+            counter["errors"] += int(error)
+            counter["cache_hits"] += int(cached)
+            counter["total_seconds"] += seconds
+            counter["max_seconds"] = max(counter["max_seconds"], seconds)
+
+    '''
+    Name: recommend
+    Parameters: kind, params
+    Returns: result, cached
+    Purpose: Runs a recommender on the worker pool, reusing a cached or
+    in-flight result for the same parameters when there is one.
+    '''
+    def recommend(self, kind, params):
+        if kind == "album":
+            future, cached = self.cache.get_or_submit(kind, params, self.executor, self._album)
+        else:
+            job = dict(params, type=kind)
+            future, cached = self.cache.get_or_submit(kind, params, self.executor, self._recommend, job)
+        return future.result(timeout=REQUEST_TIMEOUT), cached
+
+    '''
+    Name: _recommend
+    Parameters: job
+    Returns: result
+    Purpose: Runs one recommender job on a worker thread.
+    '''
+    def _recommend(self, job):
+        recs, uris, playlist_name, _ = self.runner.recommend(job)
+        return {"playlist_name": playlist_name, "tracks": recs, "uris": uris}
+
+    '''
+    Name: _album
+    Parameters: None
+    Returns: album
+    Purpose: Picks a random saved album on a worker thread.
+    '''
+    def _album(self):
+        from Other import get_album_art
+
+        album = get_album_art(self.runner.sp)
+        if album is None:
+            raise JobError("no saved albums to pick from")
+        return album
+
+    '''
+    Name: export
+    Parameters: target, playlist_name, uris
+    Returns: exported
+    Purpose: Adds tracks to a Spotify and/or YouTube playlist on the
+    worker pool. Exports are never cached.
+    '''
+    def export(self, target, playlist_name, uris):
+        future = self.executor.submit(self.runner.export, target, playlist_name, uris, None)
+        return future.result(timeout=REQUEST_TIMEOUT)
+
+    '''
+    Name: metrics
+    Parameters: None
+    Returns: metrics
+    Purpose: Returns the request counters, cache size, worker pool
+    settings, rate limiter state and the instrumentation counters,
+    timings and recent traces.
+    '''
+    def metrics(self):
+        with self.lock:
+            endpoints = {name: dict(counter) for name, counter in self.counters.items()}
+        for counter in endpoints.values():
+            counter["mean_seconds"] = round(counter["total_seconds"] / counter["requests"], 4)
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "workers": self.workers,
+            "cached_responses": self.cache.size(),
+            "endpoints": endpoints,
+            "rate_limits": get_rate_limiter().stats(),
+            "instrumentation": get_metrics().to_dict(),
+        }
+
+    '''
+    Name: shutdown
+    Parameters: None
+    Returns: None
+    Purpose: Waits for running requests and stops the worker pool.
+    '''
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+'''
+Name: _recommend_params
+Parameters: kind, args
+Returns: params
+Purpose: Picks out and checks the query parameters each recommender
+takes, so that unrelated parameters don't split the cache and bad ones
+are a 400 rather than failing inside the recommender.
+'''
+def _recommend_params(kind, args):
+    if kind == "genre":
+        if not args.get("genre"):
+            raise JobError("genre is required")
+        return {"genre": args["genre"].strip().lower(), "limit": _limit_param(args, "limit", 30)}
+    if kind == "user":
+        time_range = args.get("time_range", "medium_term")
+        if time_range not in TIME_RANGES:
+            raise JobError(f"unknown time_range {time_range!r}, expected one of {TIME_RANGES}")
+        scoring = args.get("scoring", "rank")
+        if scoring not in SCORING_MODES:
+            raise JobError(f"unknown scoring {scoring!r}, expected one of {SCORING_MODES}")
+        return {
+            "time_range": time_range,
+            "top_artist_limit": _limit_param(args, "top_artist_limit", 10),
+            "scoring": scoring,
+        }
+    return {}
+
+'''
+Name: _limit_param
+Parameters: args, name, default
+Returns: limit
+Purpose: Reads a count query parameter and checks it is between 1 and
+MAX_LIMIT.
+'''
+def _limit_param(args, name, default):
+    try:
+        limit = int(args.get(name, default))
+    except ValueError as e:
+        raise JobError(f"invalid number: {e}")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise JobError(f"{name} must be between 1 and {MAX_LIMIT}")
+    return limit
+
+'''
+Name: create_app
+Parameters: service
+Returns: app
+Purpose: Builds the Flask app with the recommendation, export, health
+and metrics endpoints around an already started service.
+'''
+def create_app(service):
+    app = Flask(__name__)
+
+    '''
+    Name: respond
+    Parameters: endpoint, fn
+    Returns: response
+    Purpose: Runs fn for a request, timing it and turning errors into
+    JSON error responses with a fitting status code.
+    '''
+    def respond(endpoint, fn):
+        started = time.time()
+        cached = False
+        try:
+            body, cached = fn()
+            status = 200
+        except JobError as e:
+            body, status = {"error": str(e)}, 400
+        except QuotaExceeded as e:
+            body, status = {"error": str(e)}, 429
+        except (SpotifyAuthError, YouTubeAuthError) as e:
+            body, status = {"error": str(e)}, 503
+        except TimeoutError:
+            body, status = {"error": "request timed out"}, 504
+        except Exception as e:
+            print(f"[ERROR] {endpoint} request failed: {type(e).__name__}: {e}")
+            body, status = {"error": f"{type(e).__name__}: {e}"}, 502
+        service._count(endpoint, time.time() - started, cached, error=status != 200)
+        if status == 200:
+            body = dict(body, cached=cached)
+        return jsonify(body), status
+
+    @app.get("/recommend/<kind>")
+    def recommend(kind):
+        if kind not in ENDPOINT_TTLS:
+            return jsonify({"error": f"unknown recommender {kind!r}"}), 404
+        return respond(kind, lambda: service.recommend(kind, _recommend_params(kind, request.args)))
+
+    @app.post("/export")
+    def export():
+        def run():
+            body = request.get_json(silent=True) or {}
+            target = body.get("target", "spotify")
+            if target is None or target not in EXPORTS:
+                raise JobError(f"unknown target {target!r}")
+            if not body.get("playlist_name") or not isinstance(body.get("uris"), list):
+                raise JobError("playlist_name and a list of uris are required")
+            return {"export": service.export(target, body["playlist_name"], body["uris"])}, False
+        return respond("export", run)
+
+    @app.get("/health")
+    def health():
+        return jsonify({"status": "ok", "uptime_seconds": round(time.time() - service.started, 1)})
+
+    @app.get("/metrics")
+    def metrics():
+        # ?format=prometheus for scrapers, JSON otherwise
+        if request.args.get("format") == "prometheus":
+            return Response(get_metrics().prometheus_text(), mimetype="text/plain; version=0.0.4")
+        return jsonify(service.metrics())
+
+    return app
+
+'''
+Name: main
+Parameters: argv=None
+Returns: None
+Purpose: Command line entry point for the HTTP service, e.g.
+"python Service.py --port 5000 --workers 4".
+'''
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve song recommendations over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    service = RecommendationService(workers=args.workers)
+    app = create_app(service)
+    try:
+        # requests only wait on the worker pool, so flask's threads stay cheap
+        app.run(host=args.host, port=args.port, threaded=True)
+    finally:
+        service.shutdown()
+
+if __name__ == '__main__':
+    main()